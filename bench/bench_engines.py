@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#  Compares ingestion + aggregation throughput of log processing engines.
+#  Usage: ./bench/bench_engines.py [NUMBER_OF_LOGS]
+
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+src_dir = os.path.join(rwd, '..', 'src')
+if src_dir not in sys.path:
+    sys.path.append(src_dir)
+
+from lib.columnar import LogColumns, ParticipantColumns  # noqa: E402
+from lib.database import LogFileData  # noqa: E402
+from lib.event import CaEvent  # noqa: E402
+from lib.extras import Setts  # noqa: E402
+from lib.parallel import get_partitioned_summaries  # noqa: E402
+
+USERS = 2000
+EVENTS = 500
+FIRST_TIMESTAMP = datetime(2016, 5, 26, 16, 37, 46, 106000)
+
+
+def get_log_entries(count):
+    """ Log entries as they come from MongoDB, with projection. """
+    for i in range(count):
+        timestamp = FIRST_TIMESTAMP + timedelta(seconds=i)
+        yield {'eventId': 400 + i % EVENTS,
+               'userId': str(116777777777777758951 + (i * 7) % USERS),
+               'action': 'join' if i % 3 else 'leave',
+               'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+                            + 'Z'}
+
+
+def run_objects(log_entries, summarized=False):
+    ca_events_holder = {}
+    for log_entry in log_entries:
+        event_id = log_entry['eventId']
+        try:
+            ca_event = ca_events_holder[event_id]
+        except KeyError:
+            ca_event = CaEvent(event_id=event_id, summarized=summarized)
+            ca_events_holder[event_id] = ca_event
+        ca_event.add_participant(log_entry)
+    return read_timestamps(ca_events_holder=ca_events_holder)
+
+
+def run_columnar(log_entries):
+    columns = LogColumns.from_logs(selected_logs=log_entries)
+    participants = ParticipantColumns.from_log_columns(columns=columns)
+    # CaEvents are built like in `get_ca_event_list_from_columns`
+    ca_events_holder = {}
+    for summary in participants.iter_summaries():
+        event_id = summary['eventId']
+        try:
+            ca_event = ca_events_holder[event_id]
+        except KeyError:
+            ca_event = CaEvent(event_id=event_id, summarized=True)
+            ca_events_holder[event_id] = ca_event
+        ca_event.add_participant_summary(summary=summary)
+    return read_timestamps(ca_events_holder=ca_events_holder)
+
+
+def read_timestamps(ca_events_holder):
+    # Aggregation happens when timestamps are read
+    for ca_event in ca_events_holder.values():
+        for participant in ca_event._participants_handler \
+                ._participant_dict.values():
+            participant.timestamp
+    return len(ca_events_holder)
+
+
+def run_serial_file(db_logs):
+    return run_objects(db_logs.get_data(stream=True), summarized=True)
+
+
+def run_parallel_file(db_logs, workers):
+    summaries = get_partitioned_summaries(db_logs=db_logs, workers=workers)
+    return len(summaries)
+
+
+def write_logs_export(path, log_entries):
+    with open(path, 'w') as f:
+        for log_entry in log_entries:
+            f.write(json.dumps(dict(log_entry, message='events')) + '\n')
+
+
+def measure(name, func, log_entries, count=None):
+    start = time.perf_counter()
+    func(log_entries)
+    elapsed = time.perf_counter() - start
+    count = len(log_entries) if count is None else count
+    print('  %-24s %8.3f s %12.0f logs/s' % (name, elapsed, count / elapsed))
+    return elapsed
+
+
+def main(count):
+    # Details are not fetched in the benchmark
+    Setts.COUCH_PREFETCH.value = False
+    log_entries = list(get_log_entries(count=count))
+
+    print('Ingestion + aggregation of %s logs:' % count)
+    objects = measure('objects', run_objects, log_entries)
+    measure('objects, summarized',
+            lambda logs: run_objects(logs, summarized=True), log_entries)
+    columnar = measure('columnar', run_columnar, log_entries)
+    print('  columnar speedup: %.1fx' % (objects / columnar))
+
+    print('Reading + aggregation of %s logs from export, %s CPUs:' % (
+        count, os.cpu_count()))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'ca-analytics.log')
+        write_logs_export(path=path, log_entries=log_entries)
+        db_logs = LogFileData(path=path)
+        measure('serial, summarized', run_serial_file, db_logs, count=count)
+        for workers in (1, 2, 4, 8):
+            measure('parallel, %s workers' % workers,
+                    lambda db: run_parallel_file(db, workers=workers),
+                    db_logs, count=count)
+
+
+if __name__ == '__main__':
+    main(count=int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#  Measures memory taken by one instance of our models.
+#  Usage: ./bench/bench_models_memory.py [NUMBER_OF_OBJECTS]
+
+import gc
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+src_dir = os.path.join(rwd, '..', 'src')
+if src_dir not in sys.path:
+    sys.path.append(src_dir)
+
+from lib.event import CaEvent  # noqa: E402
+from lib.extras import Setts  # noqa: E402
+from lib.participants import CaParticipant, CaParticipantLogEntry  # noqa
+
+USERS = 100
+EVENTS = 10
+FIRST_TIMESTAMP = datetime(2016, 5, 26, 16, 37, 46, 106000)
+
+
+def get_log_entries(count):
+    """ Log entries as they come from MongoDB, with projection. """
+    for i in range(count):
+        timestamp = FIRST_TIMESTAMP + timedelta(seconds=i)
+        yield {'eventId': 400 + i % EVENTS,
+               'userId': str(116777777777777758951 + i % USERS),
+               'action': 'join' if i % 2 else 'leave',
+               'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+                            + 'Z'}
+
+
+def measure(factory, count):
+    """ Return average number of bytes allocated by one `factory()` call. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [factory(i) for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat
+                    in after.compare_to(before, 'filename'))
+    # List holding the objects doesn't count
+    allocated -= sys.getsizeof(objects)
+    return allocated / count
+
+
+def main(count):
+    # Details stubs are shared, they are not what we measure
+    Setts.COUCH_PREFETCH.value = False
+    for log_entry in get_log_entries(count=USERS * EVENTS):
+        Setts.details_provider[log_entry['eventId']]
+        Setts.details_provider[log_entry['userId']]
+
+    log_entries = list(get_log_entries(count=count))
+
+    def log_entry_factory(i):
+        return CaParticipantLogEntry(log_entry=log_entries[i])
+
+    def parsed_log_entry_factory(i):
+        entry = CaParticipantLogEntry(log_entry=log_entries[i])
+        entry.timestamp
+        return entry
+
+    def participant_factory(i):
+        participant = CaParticipant()
+        participant.add(log_entry=log_entries[i])
+        return participant
+
+    def event_factory(i):
+        return CaEvent(event_id=log_entries[i]['eventId'])
+
+    results = (
+        ('Raw MongoDB log entry (dict)',
+         measure(lambda i: dict(log_entries[i]), count)),
+        ('CaParticipantLogEntry',
+         measure(log_entry_factory, count)),
+        ('CaParticipantLogEntry, timestamp parsed',
+         measure(parsed_log_entry_factory, count)),
+        ('CaParticipant with one log',
+         measure(participant_factory, count)),
+        ('CaEvent without participants',
+         measure(event_factory, count)),
+    )
+
+    print('Average memory per object, %s objects each:' % count)
+    for name, size in results:
+        print('  %-42s %8.1f B' % (name, size))
+
+
+if __name__ == '__main__':
+    main(count=int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
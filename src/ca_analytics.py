@@ -2,14 +2,27 @@
 # (c) 2016 Alek
 #  Exports Circle Anywhere analytical information
 
+import itertools
 import logging
 import os
 import sys
 from os.path import join as j
 
-from lib.database import init_db
-from lib.engine import get_ca_event_list
-from lib.extras import configure_argparse, Setts, OutputHandler
+from lib.database import AggregateState, MongoFields, close_db, init_db
+from lib.engine import (
+    get_ca_event_list,
+    get_ca_event_list_columnar,
+    get_ca_event_list_from_segments,
+    get_ca_event_list_from_summaries,
+    get_ca_event_list_incremental,
+    get_ca_event_list_parallel,
+    iter_ca_events_sorted,
+    sort_output_events,
+)
+from lib.extras import configure_argparse, get_chunks, Setts, OutputHandler
+from lib.pipeline import Pipeline
+from lib.segments import LogSegments
+from lib.timestamps import log_parser_stats
 
 rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
 if rwd not in sys.path:
@@ -18,25 +31,183 @@ if rwd not in sys.path:
 log = logging.getLogger(__name__)
 
 
+def get_event_list():
+    db_mongo = Setts._DB_MONGO.value
+    if Setts.INCREMENTAL.value:
+        return get_event_list_incremental()
+    if Setts.SEGMENTS.value:
+        segments = LogSegments(directory=Setts.SEGMENTS.value)
+        record_arrays = segments.read(event_ids=Setts.EVENT.value,
+                                      user_ids=Setts.USER.value,
+                                      date_from=Setts.DATE_FROM.value,
+                                      date_to=Setts.DATE_TO.value)
+        return get_ca_event_list_from_segments(record_arrays=record_arrays)
+    if Setts.MONGO_AGGREGATE.value:
+        summaries = db_mongo.get_participant_summaries(
+            event_ids=Setts.EVENT.value, user_ids=Setts.USER.value,
+            date_from=Setts.DATE_FROM.value, date_to=Setts.DATE_TO.value,
+            batch_size=Setts.MONGO_BATCH_SIZE.value,
+            scan_workers=Setts.MONGO_SCAN_WORKERS.value)
+        return get_ca_event_list_from_summaries(
+            participant_summaries=summaries)
+
+    if Setts.ENGINE.value == Setts.ENGINE.PARALLEL:
+        # Workers read logs themselves
+        return get_ca_event_list_parallel(
+            db_logs=db_mongo, workers=Setts.WORKERS.value,
+            event_ids=Setts.EVENT.value, user_ids=Setts.USER.value,
+            date_from=Setts.DATE_FROM.value, date_to=Setts.DATE_TO.value,
+            batch_size=Setts.MONGO_BATCH_SIZE.value)
+
+    sort_by_event = Setts.ENGINE.value == Setts.ENGINE.SORTED
+    db_data = db_mongo.get_data(event_ids=Setts.EVENT.value,
+                                user_ids=Setts.USER.value,
+                                date_from=Setts.DATE_FROM.value,
+                                date_to=Setts.DATE_TO.value,
+                                stream=(Setts.STREAM.value or sort_by_event or
+                                        Setts.PIPELINE.value),
+                                batch_size=Setts.MONGO_BATCH_SIZE.value,
+                                extra_fields=Setts.MONGO_EXTRA_FIELDS.value,
+                                scan_workers=Setts.MONGO_SCAN_WORKERS.value,
+                                sort_by_event=sort_by_event)
+    if Setts.PIPELINE.value:
+        return get_event_list_pipelined(db_data=db_data)
+
+    if not db_mongo.FILTERS_DATE:
+        db_data = db_mongo.filter_date(data=db_data,
+                                       date_from=Setts.DATE_FROM.value,
+                                       date_to=Setts.DATE_TO.value)
+    return build_event_list(db_data=db_data)
+
+
+def build_event_list(db_data):
+    """ Turn selected logs into CaEvents with `Setts.ENGINE`. """
+    if Setts.ENGINE.value == Setts.ENGINE.SORTED:
+        ca_events = iter_ca_events_sorted(selected_logs=db_data,
+                                          summarized=Setts.SUMMARIZE.value)
+        if Setts.ORDER_BY.events_by_id:
+            # Already in output order, events are written as they come
+            return ca_events
+        return sort_output_events(event_list=ca_events)
+    if Setts.ENGINE.value == Setts.ENGINE.COLUMNAR:
+        return get_ca_event_list_columnar(selected_logs=db_data)
+    return get_ca_event_list(selected_logs=db_data,
+                             summarized=Setts.SUMMARIZE.value)
+
+
+def get_event_list_pipelined(db_data):
+    """
+    Run reading, date filtering and building of events in separate threads,
+      connected by bounded queues, so they overlap with each other and with
+      writing the output. Logs go through in chunks of
+      `Setts.MONGO_BATCH_SIZE`.
+
+    :return: lazy stream of CaEvents
+    """
+    db_mongo = Setts._DB_MONGO.value
+    pipeline = Pipeline(queue_size=Setts.PIPELINE_QUEUE_SIZE.value)
+    pipeline.add_stage(
+        name='fetch',
+        function=lambda logs: get_chunks(logs,
+                                         size=Setts.MONGO_BATCH_SIZE.value))
+    if not db_mongo.FILTERS_DATE:
+        pipeline.add_stage(
+            name='filter',
+            function=lambda chunks: (
+                db_mongo.filter_date(data=chunk,
+                                     date_from=Setts.DATE_FROM.value,
+                                     date_to=Setts.DATE_TO.value)
+                for chunk in chunks))
+    pipeline.add_stage(
+        name='aggregate',
+        function=lambda chunks: build_event_list(
+            db_data=itertools.chain.from_iterable(chunks)))
+    return pipeline.run(source=db_data, consumer_name='write')
+
+
+def get_event_list_incremental():
+    """
+    Fetch only logs after the checkpoint of `Setts.INCREMENTAL` state. Logs
+      newer than `Setts.INCREMENTAL_LAG` are left for the next run, see
+      `MongoData.get_settled_id`.
+    """
+    db_mongo = Setts._DB_MONGO.value
+    signature = AggregateState.get_signature(event_ids=Setts.EVENT.value,
+                                             user_ids=Setts.USER.value,
+                                             date_from=Setts.DATE_FROM.value,
+                                             date_to=Setts.DATE_TO.value)
+    state = AggregateState(path=Setts.INCREMENTAL.value, signature=signature,
+                           rebuild=Setts.REBUILD.value)
+    try:
+        extra_fields = list(Setts.MONGO_EXTRA_FIELDS.value or [])
+        db_data = db_mongo.get_data(
+            event_ids=Setts.EVENT.value, user_ids=Setts.USER.value,
+            date_from=Setts.DATE_FROM.value, date_to=Setts.DATE_TO.value,
+            stream=True, batch_size=Setts.MONGO_BATCH_SIZE.value,
+            extra_fields=extra_fields + [MongoFields.ID],
+            scan_workers=Setts.MONGO_SCAN_WORKERS.value,
+            after_id=state.high_water,
+            before_id=db_mongo.get_settled_id(
+                lag=Setts.INCREMENTAL_LAG.value))
+        return get_ca_event_list_incremental(selected_logs=db_data,
+                                             state=state)
+    finally:
+        state.close()
+
+
+def export_segments():
+    """ Append logs inserted since the previous export to segments. """
+    if not Setts.SEGMENTS.value:
+        raise RuntimeError('Directory of segments to export to is not set. '
+                           'Use --segments DIR.')
+    segments = LogSegments(directory=Setts.SEGMENTS.value)
+    db_mongo = Setts._DB_MONGO.value
+    exported = segments.export(
+        db_logs=db_mongo, batch_size=Setts.MONGO_BATCH_SIZE.value,
+        before_id=db_mongo.get_settled_id(lag=Setts.INCREMENTAL_LAG.value))
+    print('* Exported %s logs to "%s"' % (exported, segments.directory))
+
+
+def manage_indexes():
+    """ Report (and create) indexes of MongoDB logs collection. """
+    if Setts.LOGS_EXPORT.value:
+        raise RuntimeError('Indexes can be managed only in MongoDB, not in '
+                           'logs export.')
+    db_mongo = Setts._DB_MONGO.value
+    if Setts.MONGO_INDEXES.value == Setts.MONGO_INDEXES.CREATE:
+        for name in db_mongo.create_indexes():
+            print('* Created index %s' % name)
+    for name, keys in db_mongo.get_missing_indexes():
+        print('* Missing index %s %s' % (name, keys))
+    for shape, index in db_mongo.explain_questions():
+        print('* Query by %s uses %s' % (shape, index))
+
+
 def evaluate_arguments():
-    db_data = Setts._DB_MONGO.value.get_data(event_ids=Setts.EVENT.value,
-                                             user_ids=Setts.USER.value)
-    db_data = Setts._DB_MONGO.value.filter_date(
-        data=db_data, date_from=Setts.DATE_FROM.value,
-        date_to=Setts.DATE_TO.value)
-
-    event_list = get_ca_event_list(selected_logs=db_data)
-
-    printer = OutputHandler(ca_events_list=event_list)
-    if Setts.OUT_DEST.value:
-        if Setts.OUT_DEST.value.endswith('csv'):
-            printer.write_csv(f_path=Setts.OUT_DEST.value)
-        elif Setts.OUT_DEST.value.endswith('json'):
-            printer.write_json(f_path=Setts.OUT_DEST.value)
+    if Setts.MONGO_INDEXES.value:
+        manage_indexes()
+        return
+    if Setts.EXPORT_SEGMENTS.value:
+        export_segments()
+        return
+
+    try:
+        event_list = get_event_list()
+
+        printer = OutputHandler(ca_events_list=event_list)
+        if Setts.OUT_DEST.value:
+            if Setts.OUT_DEST.value.endswith('csv'):
+                printer.write_csv(f_path=Setts.OUT_DEST.value)
+            elif Setts.OUT_DEST.value.endswith('json'):
+                printer.write_json(f_path=Setts.OUT_DEST.value)
+            else:
+                printer.write_file(f_path=Setts.OUT_DEST.value)
         else:
-            printer.write_file(f_path=Setts.OUT_DEST.value)
-    else:
-        printer.write_terminal()
+            printer.write_terminal()
+    finally:
+        close_db()
+
+    log_parser_stats()
 
 
 def main(start_cmd=None):
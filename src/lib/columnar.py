@@ -0,0 +1,323 @@
+import logging
+from collections import OrderedDict
+
+from lib.database import MongoFields, SummaryFields
+from lib.extras import Setts, get_chunks
+from lib.timestamps import parse_timestamp, to_epoch_us
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+ACTION_JOIN = 1
+ACTION_LEAVE = 2
+_ACTION_CODES = {'join': ACTION_JOIN, 'leave': ACTION_LEAVE}
+# Max of int64, marks lack of join/leave of the participant
+NO_TIMESTAMP = 2 ** 63 - 1
+
+# Layout of log timestamps: 2016-05-26T16:37:46.106Z
+_TIMESTAMP_LENGTH = 24
+_TIMESTAMP_SEPARATORS = {4: b'-', 7: b'-', 10: b'T', 13: b':', 16: b':',
+                         19: b'.', 23: b'Z'}
+_TIMESTAMP_DIGITS = [position for position in range(_TIMESTAMP_LENGTH)
+                     if position not in _TIMESTAMP_SEPARATORS]
+# Of months in a common year, February of leap years is checked apart
+_MONTH_DAYS = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def check_numpy():
+    if np is None:
+        raise RuntimeError('Columnar engine requires numpy. '
+                           'Install it with: pip3 install numpy')
+
+
+class LogColumns:
+    """
+    Logs stored as typed columns instead of one object per log:
+      * event_id: int32
+      * user_index: int32, index of user id in `Setts.user_id_table`
+      * action: int8, ACTION_JOIN or ACTION_LEAVE
+      * timestamp: int64, microseconds since epoch
+    """
+    # Number of logs read at once by `from_logs`
+    _CHUNK_SIZE = 65536
+    event_id = None
+    user_index = None
+    action = None
+    timestamp = None
+
+    def __init__(self, event_id, user_index, action, timestamp):
+        self.event_id = event_id
+        self.user_index = user_index
+        self.action = action
+        self.timestamp = timestamp
+
+    def __len__(self):
+        return len(self.event_id)
+
+    @classmethod
+    def from_logs(cls, selected_logs):
+        """
+        Load logs (see `get_ca_event_list`) into columns. Logs are taken in
+          chunks of `_CHUNK_SIZE` and every field is read from a whole chunk
+          at once, so there is no per-log Python code besides the reading.
+        """
+        check_numpy()
+        event_ids, user_ids, actions, timestamps = [], [], [], []
+
+        for chunk in get_chunks(selected_logs, size=cls._CHUNK_SIZE):
+            chunk_timestamps = [log_entry.get(MongoFields.TIMESTAMP)
+                                for log_entry in chunk]
+            if None in chunk_timestamps:
+                for log_entry, raw_timestamp in zip(chunk, chunk_timestamps):
+                    if raw_timestamp is None:
+                        log.warning('Skipping log entry without timestamp '
+                                    '[%s]', log_entry)
+                chunk = [log_entry for log_entry, raw_timestamp
+                         in zip(chunk, chunk_timestamps)
+                         if raw_timestamp is not None]
+                chunk_timestamps = [raw_timestamp for raw_timestamp
+                                    in chunk_timestamps
+                                    if raw_timestamp is not None]
+
+            chunk_actions = [log_entry[MongoFields.ACTION]
+                             for log_entry in chunk]
+            if not _ACTION_CODES.keys() >= set(chunk_actions):
+                log_entry = next(log_entry for log_entry in chunk
+                                 if log_entry[MongoFields.ACTION]
+                                 not in _ACTION_CODES)
+                raise RuntimeError(
+                    'Unrecognized action [{}] for log_entry [{}]'.format(
+                        log_entry[MongoFields.ACTION], log_entry))
+
+            event_ids.extend([log_entry[MongoFields.EVENT_ID]
+                              for log_entry in chunk])
+            user_ids.extend([log_entry[MongoFields.USER_ID]
+                             for log_entry in chunk])
+            actions.extend(chunk_actions)
+            timestamps.extend(chunk_timestamps)
+
+        count = len(event_ids)
+        # Each distinct user id is interned once, in order of appearance
+        intern_user_id = Setts.user_id_table.intern
+        user_indexes = {user_id: intern_user_id(user_id=user_id)
+                        for user_id in OrderedDict.fromkeys(user_ids)}
+
+        return cls(
+            event_id=np.fromiter(event_ids, dtype=np.int32, count=count),
+            user_index=np.fromiter(map(user_indexes.__getitem__, user_ids),
+                                   dtype=np.int32, count=count),
+            action=np.fromiter(map(_ACTION_CODES.__getitem__, actions),
+                               dtype=np.int8, count=count),
+            timestamp=parse_timestamp_column(timestamps))
+
+    @classmethod
+    def from_records(cls, record_arrays):
+        """
+        Load records of log segments (see `lib.segments`) into columns. They
+          are in the same layout already, only user ids need interning.
+
+        :param record_arrays: structured arrays with `segments.RECORD_DTYPE`
+        """
+        check_numpy()
+        record_arrays = [records for records in record_arrays
+                         if len(records)]
+        if not record_arrays:
+            empty = np.array([], dtype=np.int64)
+            return cls(event_id=empty, user_index=empty, action=empty,
+                       timestamp=empty)
+
+        def concatenate(field):
+            return np.concatenate([records[field]
+                                   for records in record_arrays])
+
+        # Each distinct user id is decoded and interned once
+        user_ids, user_positions = np.unique(concatenate('user_id'),
+                                             return_inverse=True)
+        intern_user_id = Setts.user_id_table.intern
+        user_indexes = np.array(
+            [intern_user_id(user_id=user_id.decode()) for user_id in user_ids],
+            dtype=np.int32)
+
+        return cls(event_id=concatenate('event_id'),
+                   user_index=user_indexes[user_positions],
+                   action=concatenate('action'),
+                   timestamp=concatenate('timestamp'))
+
+
+class ParticipantColumns:
+    """
+    Logs reduced to one row per (event, user), sorted by event and user:
+      * event_id, user_index: as in `LogColumns`
+      * join, leave: earliest join, latest leave (`NO_TIMESTAMP` if none)
+      * join_count, leave_count
+      * first_seen, last_seen: earliest and latest timestamp of any action
+    """
+    def __init__(self, **columns):
+        self.event_id = columns['event_id']
+        self.user_index = columns['user_index']
+        self.join = columns['join']
+        self.leave = columns['leave']
+        self.join_count = columns['join_count']
+        self.leave_count = columns['leave_count']
+        self.first_seen = columns['first_seen']
+        self.last_seen = columns['last_seen']
+
+    def __len__(self):
+        return len(self.event_id)
+
+    @classmethod
+    def from_log_columns(cls, columns):
+        """ Vectorized group by (event, user) with sort + reduceat. """
+        check_numpy()
+        if not len(columns):
+            empty = np.array([], dtype=np.int64)
+            return cls(event_id=empty, user_index=empty, join=empty,
+                       leave=empty, join_count=empty, leave_count=empty,
+                       first_seen=empty, last_seen=empty)
+
+        # Last key is the primary one
+        order = np.lexsort((columns.timestamp, columns.user_index,
+                            columns.event_id))
+        event_id = columns.event_id[order]
+        user_index = columns.user_index[order]
+        action = columns.action[order]
+        timestamp = columns.timestamp[order]
+
+        group_change = ((event_id[1:] != event_id[:-1]) |
+                        (user_index[1:] != user_index[:-1]))
+        starts = np.concatenate(([0], np.flatnonzero(group_change) + 1))
+        ends = np.concatenate((starts[1:], [len(event_id)])) - 1
+
+        is_join = action == ACTION_JOIN
+        is_leave = action == ACTION_LEAVE
+        join = np.minimum.reduceat(
+            np.where(is_join, timestamp, NO_TIMESTAMP), starts)
+        leave = np.maximum.reduceat(
+            np.where(is_leave, timestamp, -NO_TIMESTAMP), starts)
+        leave[leave == -NO_TIMESTAMP] = NO_TIMESTAMP
+
+        return cls(event_id=event_id[starts],
+                   user_index=user_index[starts],
+                   join=join,
+                   leave=leave,
+                   join_count=np.add.reduceat(is_join.astype(np.int64),
+                                              starts),
+                   leave_count=np.add.reduceat(is_leave.astype(np.int64),
+                                               starts),
+                   # Sorted by timestamp within the group
+                   first_seen=timestamp[starts],
+                   last_seen=timestamp[ends])
+
+    def iter_summaries(self):
+        """
+        Yield participants as `SummaryFields` dicts, which can be added to
+          CaEvent(summarized=True). Timestamps are given as microseconds
+          since epoch (see `CaParticipantSummary`), not formatted back to
+          ISO strings.
+        """
+        get_user_id = Setts.user_id_table.get_user_id
+
+        def get_timestamps(column):
+            return [None if microseconds == NO_TIMESTAMP else microseconds
+                    for microseconds in column.tolist()]
+
+        # Columns are converted to lists at once, not value by value
+        for (event_id, user_index, join, leave, join_count, leave_count,
+             first_seen, last_seen) in zip(
+                self.event_id.tolist(), self.user_index.tolist(),
+                get_timestamps(self.join), get_timestamps(self.leave),
+                self.join_count.tolist(), self.leave_count.tolist(),
+                self.first_seen.tolist(), self.last_seen.tolist()):
+            yield {
+                SummaryFields.EVENT_ID: event_id,
+                SummaryFields.USER_ID: get_user_id(index=user_index),
+                SummaryFields.JOIN: join,
+                SummaryFields.LEAVE: leave,
+                SummaryFields.JOIN_COUNT: join_count,
+                SummaryFields.LEAVE_COUNT: leave_count,
+                SummaryFields.FIRST_SEEN: first_seen,
+                SummaryFields.LAST_SEEN: last_seen,
+            }
+
+
+def parse_timestamp_column(raw_timestamps):
+    """
+    Convert ISO timestamps to microseconds since epoch. Values in the log
+      layout are converted all at once, other ones by `parse_timestamp`.
+
+    :param raw_timestamps: ['2016-05-26T16:37:46.106Z', ...]
+    :return: int64 array
+    """
+    check_numpy()
+    count = len(raw_timestamps)
+    if not count:
+        return np.array([], dtype=np.int64)
+
+    chars = _get_fixed_length_chars(raw_timestamps=raw_timestamps)
+    if chars is not None:
+        in_layout = np.ones(count, dtype=bool)
+    else:
+        # One char longer than the layout, so longer values can be recognized
+        raw = np.array(raw_timestamps, dtype='S%s' % (_TIMESTAMP_LENGTH + 1))
+        chars = raw.view(np.uint8).reshape(count, _TIMESTAMP_LENGTH + 1)
+        in_layout = np.char.str_len(raw) == _TIMESTAMP_LENGTH
+    for position, separator in _TIMESTAMP_SEPARATORS.items():
+        in_layout &= chars[:, position] == ord(separator)
+    digits = chars[:, _TIMESTAMP_DIGITS]
+    in_layout &= ((digits >= ord('0')) & (digits <= ord('9'))).all(axis=1)
+
+    def number(start, stop):
+        ret = np.zeros(count, dtype=np.int64)
+        for position in range(start, stop):
+            ret = ret * 10 + (chars[:, position].astype(np.int64) - ord('0'))
+        return ret
+
+    year, month, day = number(0, 4), number(5, 7), number(8, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    # Dates which don't exist are left to `parse_timestamp`, which raises
+    in_layout &= (month >= 1) & (month <= 12)
+    leap_day = ((month == 2) & (year % 4 == 0) &
+                ((year % 100 != 0) | (year % 400 == 0)))
+    month_days = np.array(_MONTH_DAYS)[np.clip(month, 0, 12)] + leap_day
+    in_layout &= (day >= 1) & (day <= month_days)
+    in_layout &= (hour < 24) & (minute < 60) & (second < 60)
+
+    days = _days_from_civil(year=year, month=month, day=day)
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second
+    ret = seconds * 1000000 + number(20, 23) * 1000
+
+    for i in np.flatnonzero(~in_layout):
+        ret[i] = to_epoch_us(parse_timestamp(raw_timestamps[i]))
+    return ret
+
+
+def _get_fixed_length_chars(raw_timestamps):
+    """
+    Return (count, `_TIMESTAMP_LENGTH`) uint8 array of timestamps when all of
+      them have the length of the layout, else None. They are encoded in
+      one go instead of one by one.
+    """
+    if set(map(len, raw_timestamps)) != {_TIMESTAMP_LENGTH}:
+        return None
+    try:
+        raw = ''.join(raw_timestamps).encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    return np.frombuffer(raw, dtype=np.uint8).reshape(len(raw_timestamps),
+                                                      _TIMESTAMP_LENGTH)
+
+
+def _days_from_civil(year, month, day):
+    """ Days since 1970-01-01 for proleptic Gregorian dates (vectorized). """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + \
+        day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100 +
+                  day_of_year)
+    return era * 146097 + day_of_era - 719468
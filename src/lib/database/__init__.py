@@ -1,16 +1,49 @@
 from lib.extras import Setts
+from .aggregate_state import AggregateState
 from .couch_db import CouchData
-from .fields import EventFields, MongoFields, UserFields
+from .details_cache import CouchDetailsCache
+from .fields import EventFields, MongoFields, SummaryFields, UserFields
+from .log_file import LogFileData
 from .mongo_db import MongoData
 from .proxy import CaDetailsProvider
 
 
 def init_db():
-    Setts._DB_MONGO.value = MongoData(
-        connection_string=Setts.MONGO_STRING.value,
-        database_name=Setts.MONGO_DATABASE.value
-    )
+    if Setts.SEGMENTS.value and not (Setts.EXPORT_SEGMENTS.value or
+                                     Setts.MONGO_INDEXES.value):
+        # Logs are read from segments
+        Setts._DB_MONGO.value = None
+    elif Setts.LOGS_EXPORT.value:
+        Setts._DB_MONGO.value = LogFileData(
+            path=Setts.LOGS_EXPORT.value,
+            index_every=Setts.LOGS_EXPORT_INDEX.value
+        )
+    else:
+        Setts._DB_MONGO.value = MongoData(
+            connection_string=Setts.MONGO_STRING.value,
+            database_name=Setts.MONGO_DATABASE.value,
+            id_chunk_size=Setts.MONGO_ID_CHUNK_SIZE.value
+        )
+    details_cache = None
+    if Setts.COUCH_CACHE.value:
+        details_cache = CouchDetailsCache(
+            path=Setts.COUCH_CACHE.value,
+            ttl=Setts.COUCH_CACHE_TTL.value,
+            max_entries=Setts.COUCH_CACHE_SIZE.value
+        )
     Setts._DB_COUCH.value = CouchData(
         connection_string=Setts.COUCH_STRING.value,
-        database_name=Setts.COUCH_DATABASE.value
+        database_name=Setts.COUCH_DATABASE.value,
+        batch_size=Setts.COUCH_BATCH_SIZE.value,
+        cache=details_cache,
+        workers=Setts.COUCH_WORKERS.value
     )
+
+
+def close_db():
+    """ Release what was opened for the run, once its output is written. """
+    if Setts._details_provider.value is not None:
+        Setts._details_provider.value.close()
+    # After the provider, its fetches may still use the cache
+    if Setts._DB_COUCH.value is not None:
+        Setts._DB_COUCH.value.close()
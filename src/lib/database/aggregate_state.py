@@ -0,0 +1,171 @@
+import json
+import logging
+import sqlite3
+
+from lib.extras import norm_path
+from .fields import SummaryFields
+
+log = logging.getLogger(__name__)
+
+
+class AggregateState:
+    """
+    Participant summaries (see `SummaryFields`) of already processed logs,
+      kept in SQLite with a checkpoint - `_id` of the last processed log.
+      Next run needs to fetch only logs inserted after the checkpoint and
+      merge them into stored summaries. Only logs older than a safety lag
+      are processed, `_id`s don't grow in insertion order otherwise (see
+      `MongoData.get_settled_id`).
+
+    State is valid only for the selection it was made with (events, users,
+      dates), so the selection is stored as its signature.
+    """
+    _CREATE_TABLES = (
+        'CREATE TABLE IF NOT EXISTS meta ('
+        ' key TEXT PRIMARY KEY,'
+        ' value TEXT)',
+        'CREATE TABLE IF NOT EXISTS summaries ('
+        ' event_id INTEGER NOT NULL,'
+        ' user_id TEXT NOT NULL,'
+        ' join_ts TEXT,'
+        ' leave_ts TEXT,'
+        ' join_count INTEGER NOT NULL,'
+        ' leave_count INTEGER NOT NULL,'
+        ' first_seen TEXT,'
+        ' last_seen TEXT,'
+        ' PRIMARY KEY (event_id, user_id))',
+    )
+    _COLUMNS = ('event_id', 'user_id', 'join_ts', 'leave_ts', 'join_count',
+                'leave_count', 'first_seen', 'last_seen')
+    _FIELDS = (SummaryFields.EVENT_ID, SummaryFields.USER_ID,
+               SummaryFields.JOIN, SummaryFields.LEAVE,
+               SummaryFields.JOIN_COUNT, SummaryFields.LEAVE_COUNT,
+               SummaryFields.FIRST_SEEN, SummaryFields.LAST_SEEN)
+    _CREATE_NEW_SUMMARIES = (
+        'CREATE TEMP TABLE new_summaries AS '
+        'SELECT * FROM summaries WHERE 0')
+    # Earliest join, latest leave, sum of counts. NULL means no such action,
+    #   so it's taken only when both values are NULL
+    _MERGE_NEW_SUMMARIES = (
+        'INSERT OR REPLACE INTO summaries '
+        'SELECT n.event_id, n.user_id,'
+        ' MIN(COALESCE(s.join_ts, n.join_ts),'
+        '     COALESCE(n.join_ts, s.join_ts)),'
+        ' MAX(COALESCE(s.leave_ts, n.leave_ts),'
+        '     COALESCE(n.leave_ts, s.leave_ts)),'
+        ' COALESCE(s.join_count, 0) + n.join_count,'
+        ' COALESCE(s.leave_count, 0) + n.leave_count,'
+        ' MIN(COALESCE(s.first_seen, n.first_seen),'
+        '     COALESCE(n.first_seen, s.first_seen)),'
+        ' MAX(COALESCE(s.last_seen, n.last_seen),'
+        '     COALESCE(n.last_seen, s.last_seen)) '
+        'FROM new_summaries AS n LEFT JOIN summaries AS s'
+        ' ON s.event_id = n.event_id AND s.user_id = n.user_id')
+    _HIGH_WATER = 'high_water'
+    _SIGNATURE = 'signature'
+    _connection = None
+
+    def __init__(self, path, signature, rebuild=False):
+        """
+        :param path: file with the state, created when it doesn't exist
+        :param signature: selection of logs, see `get_signature`
+        :param rebuild: drop stored state and start from scratch
+        """
+        self.path = norm_path(path, mkdir=False, mkfile=False, logger=log)
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            for create_table in self._CREATE_TABLES:
+                self._connection.execute(create_table)
+
+        stored_signature = self._get_meta(key=self._SIGNATURE)
+        if rebuild:
+            log.info('Rebuilding state [%s] from scratch', self.path)
+            self._clear()
+        elif stored_signature is not None and stored_signature != signature:
+            self.close()
+            raise RuntimeError(
+                'State in "{}" was made for different selection of logs '
+                '[{}]. Run with --rebuild to start over.'.format(
+                    self.path, stored_signature))
+        with self._connection:
+            self._set_meta(key=self._SIGNATURE, value=signature)
+
+    @staticmethod
+    def get_signature(event_ids=None, user_ids=None, date_from=None,
+                      date_to=None):
+        """ Return selection of logs as a string, same for same selection. """
+        return json.dumps({
+            'event_ids': sorted(int(e) for e in event_ids)
+            if event_ids is not None else None,
+            'user_ids': sorted(str(u) for u in user_ids)
+            if user_ids is not None else None,
+            'date_from': date_from,
+            'date_to': date_to,
+        }, sort_keys=True)
+
+    @property
+    def high_water(self):
+        """ `_id` of the last processed log, as str, or None. """
+        return self._get_meta(key=self._HIGH_WATER)
+
+    def merge(self, summaries, high_water):
+        """
+        Merge summaries of new logs into stored ones and move the checkpoint,
+          all in one transaction. Merging is done by SQLite, like in
+          `CaParticipantSummary.add_summary`.
+
+        :param summaries: [{'eventId': .., 'userId': .., ...}, ...] of logs
+                          after the current checkpoint, one per participant
+        :param high_water: `_id` of the last of those logs
+        """
+        rows = ((summary[SummaryFields.EVENT_ID],
+                 str(summary[SummaryFields.USER_ID]),
+                 summary[SummaryFields.JOIN],
+                 summary[SummaryFields.LEAVE],
+                 summary[SummaryFields.JOIN_COUNT],
+                 summary[SummaryFields.LEAVE_COUNT],
+                 summary[SummaryFields.FIRST_SEEN],
+                 summary[SummaryFields.LAST_SEEN])
+                for summary in summaries)
+
+        # Schema changes may commit pending transaction, so they are kept
+        #   out of it
+        self._connection.execute(self._CREATE_NEW_SUMMARIES)
+        try:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT INTO new_summaries VALUES (%s)' %
+                    ', '.join('?' * len(self._COLUMNS)), rows)
+                merged = self._connection.execute(self._MERGE_NEW_SUMMARIES)
+                if high_water is not None:
+                    self._set_meta(key=self._HIGH_WATER,
+                                   value=str(high_water))
+        finally:
+            self._connection.execute('DROP TABLE new_summaries')
+        log.debug('Merged [%s] summaries into state [%s], checkpoint [%s]',
+                  merged.rowcount, self.path, self.high_water)
+
+    def get_summaries(self):
+        """ Yield all stored summaries as `SummaryFields` dicts. """
+        cursor = self._connection.execute(
+            'SELECT %s FROM summaries' % ', '.join(self._COLUMNS))
+        for row in cursor:
+            yield dict(zip(self._FIELDS, row))
+
+    def close(self):
+        self._connection.close()
+
+    def _get_meta(self, key):
+        row = self._connection.execute('SELECT value FROM meta WHERE key = ?',
+                                       (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def _clear(self):
+        with self._connection:
+            self._connection.execute('DELETE FROM summaries')
+            self._connection.execute('DELETE FROM meta')
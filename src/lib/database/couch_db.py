@@ -1,11 +1,16 @@
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import couchdb
 
-from lib.extras import is_string, is_iterable, get_couchdb_id
+from lib.extras import get_chunks, get_couchdb_id, is_iterable, is_string
+from .fields import COUCH_ID, COUCH_KEY, COUCH_VALUE, EventFields
 
 log = logging.getLogger(__name__)
 
+CouchRow = namedtuple('CouchRow', (COUCH_ID, COUCH_KEY, COUCH_VALUE))
+
 
 class CouchData:
     QUERY_EVENT = '''
@@ -16,23 +21,22 @@ class CouchData:
             }
         }
         '''
-    QUERY_LIST = '''
-        function(doc){
-            var L = function() {
-                    var obj = {};
-                    for(var i=0; i<arguments.length; i++)
-                        obj[arguments[i]] = null;
-
-                    return obj; };
-
-            if(doc._id in L('%s')){
-                emit(doc.id, doc);
-            }
-        }
-        '''
     db_couch = None
+    _batch_size = None
+    _workers = 1
+    _cache = None
 
-    def __init__(self, connection_string, database_name):
+    def __init__(self, connection_string, database_name, batch_size,
+                 cache=None, workers=None):
+        """
+        :param batch_size: number of documents asked for in one request
+        :param cache: CouchDetailsCache, when given documents are fetched
+                      only if they aren't cached or have changed
+        :param workers: number of requests made at once
+        """
+        self._batch_size = batch_size
+        self._workers = workers or 1
+        self._cache = cache
         self._client = couchdb.Server(connection_string)
         try:
             self.db_couch = self._client[database_name]
@@ -42,15 +46,22 @@ class CouchData:
                        'database_name': database_name})
             exit(1)
 
+    def close(self):
+        """ Close the details cache, CouchDB needs no closing. """
+        if self._cache is not None:
+            self._cache.close()
+
     def get_data(self, event_ids=None, user_ids=None):
         """
         Get data about specific events or users.
+        Documents are fetched by their `_id` in batches, so only requested
+          ones are read by CouchDB.
 
         :version: 2016.11.11
         :param user_ids:
         :param user_ids: list of userIds
         :type event_ids: list of eventIds
-        :return:
+        :return: [CouchRow(id='event/00430', key='430', value={..}), ...]
         """
 
         def make_iterable(evnt_ids=event_ids, usr_ids=user_ids):
@@ -114,7 +125,94 @@ class CouchData:
                                             usr_ids=user_ids)
 
         search_vals = get_search_values(evnt_ids=event_ids, usr_ids=user_ids)
-        search_query = self.QUERY_LIST % "', '".join(search_vals)
 
-        results = self.db_couch.query(search_query)
-        return results.rows
+        if self._cache is None:
+            documents = list(self._fetch_documents(keys=search_vals))
+        else:
+            documents = self._get_cached_documents(keys=search_vals)
+        return [self._get_row(document=document) for document in documents]
+
+    def _get_cached_documents(self, keys):
+        """
+        Take documents from the cache. Expired ones are revalidated with their
+          `_rev`, so only new or changed documents are downloaded.
+        """
+        fresh, stale = self._cache.get(couch_ids=keys)
+
+        current_revs = self._get_revisions(keys=list(stale))
+        unchanged, outdated = [], []
+        for couch_id, (rev, _) in stale.items():
+            if current_revs.get(couch_id) == rev:
+                unchanged.append(couch_id)
+            else:
+                outdated.append(couch_id)
+        self._cache.revalidated(couch_ids=unchanged)
+        self._cache.delete(couch_ids=outdated)
+
+        cached = set(fresh).union(unchanged)
+        fetched = list(self._fetch_documents(
+            keys=[key for key in keys if key not in cached]))
+        self._cache.put(documents=fetched)
+
+        log.debug('Details cache: [%s] fresh, [%s] revalidated, '
+                  '[%s] downloaded of [%s] asked',
+                  len(fresh), len(unchanged), len(fetched), len(keys))
+        documents = list(fresh.values())
+        documents.extend(stale[couch_id][1] for couch_id in unchanged)
+        documents.extend(fetched)
+        return documents
+
+    def _fetch_documents(self, keys):
+        for documents in self._map_chunks(
+                function=lambda chunk: list(self._get_documents(keys=chunk)),
+                keys=keys):
+            yield from documents
+
+    def _map_chunks(self, function, keys):
+        """
+        Call `function` with chunks of `batch_size` keys, `workers` of them
+          at once. Results are yielded in the order of chunks.
+        """
+        chunks = get_chunks(keys, size=self._batch_size)
+        if self._workers < 2:
+            yield from map(function, chunks)
+            return
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            yield from executor.map(function, chunks)
+
+    def _get_documents(self, keys):
+        """
+        Bulk lookup of documents with `_all_docs`.
+
+        :param keys: ['event/00430', 'user/116777777777777758951', ...]
+        :return:
+        """
+        results = self.db_couch.view('_all_docs', keys=keys,
+                                     include_docs=True)
+        for row in results:
+            document = row.doc
+            if document is None:
+                # Missing or deleted document, stub data will be used
+                log.debug('No document in CouchDB for [%s]', row.key)
+                continue
+            yield document
+
+    def _get_revisions(self, keys):
+        """ Return {couch_id: rev} of existing documents, without bodies. """
+        def get_chunk_revisions(chunk):
+            return list(self.db_couch.view('_all_docs', keys=chunk))
+
+        ret = {}
+        for rows in self._map_chunks(function=get_chunk_revisions, keys=keys):
+            for row in rows:
+                value = row.value
+                if value and not value.get('deleted'):
+                    ret[row.key] = value['rev']
+        return ret
+
+    @staticmethod
+    def _get_row(document):
+        """ Same shape as returned by views: key is our event/user id. """
+        return CouchRow(id=document[EventFields.ID_],
+                        key=document[EventFields.ID],
+                        value=document)
@@ -0,0 +1,136 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from lib.extras import get_chunks, norm_path
+from .fields import EventFields, UserFields
+
+log = logging.getLogger(__name__)
+
+
+class CouchDetailsCache:
+    """
+    Persistent cache of CouchDB event and user documents, kept in SQLite.
+    Only fields used by our models are stored, together with `_rev` of the
+      document, so it can be cheaply checked if the document has changed.
+
+    Entries younger than `ttl` are used as they are. Older ones have to be
+      revalidated with CouchDB (see `CouchData.get_data`).
+    When there are more than `max_entries`, least recently used are evicted.
+    """
+    _CREATE_TABLE = (
+        'CREATE TABLE IF NOT EXISTS details ('
+        ' couch_id TEXT PRIMARY KEY,'
+        ' rev TEXT,'
+        ' document TEXT NOT NULL,'
+        ' validated REAL NOT NULL,'
+        ' accessed REAL NOT NULL)'
+    )
+    _CREATE_INDEX = ('CREATE INDEX IF NOT EXISTS details_accessed '
+                     'ON details (accessed)')
+    # SQLite limits number of variables in one statement
+    _MAX_VARIABLES = 500
+    _USED_FIELDS = set(EventFields.USED_FIELDS + UserFields.USED_FIELDS)
+
+    _connection = None
+    _lock = None
+
+    def __init__(self, path, ttl, max_entries):
+        """
+        :param path: file with the cache, created when it doesn't exist
+        :param ttl: seconds after which entry must be revalidated
+        :param max_entries: number of documents kept in the cache
+        """
+        self.path = norm_path(path, mkdir=False, mkfile=False, logger=log)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # Cache can be used from CouchDB fetching worker thread
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute(self._CREATE_TABLE)
+            self._connection.execute(self._CREATE_INDEX)
+
+    def get(self, couch_ids):
+        """
+        Return cached entries and split them by freshness.
+
+        :param couch_ids: ['event/00430', 'user/116777777777777758951', ...]
+        :return: ({couch_id: document}, {couch_id: (rev, document)})
+                 fresh and needing revalidation entries
+        """
+        fresh, stale = {}, {}
+        expired = time.time() - self.ttl
+        with self._lock:
+            for chunk in get_chunks(couch_ids, size=self._MAX_VARIABLES):
+                question = ('SELECT couch_id, rev, document, validated '
+                            'FROM details WHERE couch_id IN (%s)' %
+                            ', '.join('?' * len(chunk)))
+                for couch_id, rev, document, validated in (
+                        self._connection.execute(question, chunk)):
+                    document = json.loads(document)
+                    if validated > expired:
+                        fresh[couch_id] = document
+                    else:
+                        stale[couch_id] = (rev, document)
+        self._touch(couch_ids=list(fresh), validated=False)
+        return fresh, stale
+
+    def put(self, documents):
+        """ Store (or replace) full CouchDB documents. """
+        now = time.time()
+        rows = []
+        for document in documents:
+            stored = {k: v for k, v in document.items()
+                      if k in self._USED_FIELDS}
+            rows.append((document[EventFields.ID_],
+                         document.get(EventFields.REV_),
+                         json.dumps(stored), now, now))
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO details '
+                '(couch_id, rev, document, validated, accessed) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+        self.evict()
+
+    def revalidated(self, couch_ids):
+        """ Mark entries as still up to date with CouchDB. """
+        self._touch(couch_ids=couch_ids, validated=True)
+
+    def delete(self, couch_ids):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'DELETE FROM details WHERE couch_id = ?',
+                ((couch_id,) for couch_id in couch_ids))
+
+    def evict(self):
+        """ Remove least recently used entries above `max_entries`. """
+        with self._lock, self._connection:
+            deleted = self._connection.execute(
+                'DELETE FROM details WHERE couch_id NOT IN ('
+                ' SELECT couch_id FROM details'
+                ' ORDER BY accessed DESC LIMIT ?)',
+                (self.max_entries,)).rowcount
+        if deleted:
+            log.debug('Evicted [%s] entries from details cache [%s]',
+                      deleted, self.path)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _touch(self, couch_ids, validated):
+        now = time.time()
+        if validated:
+            question = ('UPDATE details SET accessed = ?, validated = ? '
+                        'WHERE couch_id = ?')
+            rows = ((now, now, couch_id) for couch_id in couch_ids)
+        else:
+            question = 'UPDATE details SET accessed = ? WHERE couch_id = ?'
+            rows = ((now, couch_id) for couch_id in couch_ids)
+        with self._lock, self._connection:
+            self._connection.executemany(question, rows)
@@ -13,6 +13,23 @@ class MongoFields:
     TIMESTAMP = 'timestamp'
     USER_ID = 'userId'
 
+    # Fields read by our models, rest of the log entry is never used
+    USED_FIELDS = (ACTION, EVENT_ID, TIMESTAMP, USER_ID)
+
+
+class SummaryFields:
+    """ Participant in the event, reduced from all his logs. """
+    EVENT_ID = MongoFields.EVENT_ID
+    USER_ID = MongoFields.USER_ID
+    # Earliest join and latest leave timestamps
+    JOIN = 'join'
+    LEAVE = 'leave'
+    JOIN_COUNT = 'joinCount'
+    LEAVE_COUNT = 'leaveCount'
+    # Earliest and latest timestamps regardless of action
+    FIRST_SEEN = 'firstSeen'
+    LAST_SEEN = 'lastSeen'
+
 
 class EventFields:
     ID = 'id'
@@ -44,11 +61,15 @@ class EventFields:
     WHITEBOARD = 'whiteboard'
     YOUTUBE_EMBED = 'youtubeEmbed'
 
+    # Fields read by our models
+    USED_FIELDS = (ID, ID_, REV_, CALENDAR_ID, DATE_AND_TIME, DESCRIPTION,
+                   DURATION)
+
 
 class UserFields:
     ID = 'id'
     ID_ = '_id'
-    REV_ = '-rev'
+    REV_ = '_rev'
 
     ADMIN_PROPOSED_SESSIONS = 'adminProposedSessions'
     ADMIN = 'admin'
@@ -83,3 +104,6 @@ class UserFields:
     PREFERRED_CONTACT = 'preferredContact'
     PROVIDER = 'provider'
     SUPERUSER = 'superuser'
+
+    # Fields read by our models
+    USED_FIELDS = (ID, ID_, REV_, DISPLAY_NAME)
@@ -0,0 +1,212 @@
+import gzip
+import json
+import logging
+import mmap
+import os
+
+from bson import ObjectId
+
+from lib.extras import norm_path
+from .fields import MongoFields
+from .log_index import LogFileIndex
+from .mongo_db import MongoData
+
+log = logging.getLogger(__name__)
+
+
+class LogFileData(MongoData):
+    """
+    Logs read straight from the export MongoDB is seeded with
+      (`ca-analytics.log`, see DOCKER.md) - one JSON document per line,
+      optionally gzipped. No database is needed.
+
+    Selection is the same as in `MongoData` (see `get_question`), but it's
+      resolved while the file is read. With a date window, only parts of the
+      file found in `LogFileIndex` are read.
+    """
+    _GZIP_MAGIC = b'\x1f\x8b'
+    # Only lines with all of those may be join/leave logs, so the rest isn't
+    #   parsed at all
+    _REQUIRED_TEXT = ('"%s"' % MongoFields.EVENT_ID, '"events"')
+    _ACTION_TEXT = ('"join"', '"leave"')
+
+    def __init__(self, path, index_every=None):
+        """
+        :param path: file with logs, one JSON document per line
+        :param index_every: lines per block of `LogFileIndex`, no index
+                            when not given
+        """
+        self.path = norm_path(path, mkdir=False, mkfile=False, logger=log)
+        self._index_every = index_every
+        self._index = None
+        if index_every:
+            self._index = LogFileIndex(path=self.path, every=index_every)
+
+    def get_copy_arguments(self):
+        """ Same as `MongoData.get_copy_arguments`. """
+        return {'path': self.path, 'index_every': self._index_every}
+
+    def get_data(self, event_ids=None, user_ids=None, date_from=None,
+                 date_to=None, stream=False, batch_size=None,
+                 extra_fields=None, scan_workers=None, after_id=None,
+                 sort_by_event=False, partition=None, before_id=None):
+        """
+        Same as `MongoData.get_data`. Logs are returned in the file order.
+        `batch_size` and `scan_workers` don't apply to a file. With
+          `sort_by_event` selected logs are sorted in memory.
+
+        A `partition` of an uncompressed file is a range of its bytes, not of
+          eventIds, so every line is parsed by one partition only. Logs of
+          an event may be in several partitions then.
+        """
+        byte_partition = None
+        if partition is not None and not self.is_gzip():
+            byte_partition, partition = partition, None
+        question = self.get_question(event_ids=event_ids, user_ids=user_ids,
+                                     date_from=date_from, date_to=date_to,
+                                     after_id=after_id, partition=partition,
+                                     before_id=before_id)
+        projection = self.get_projection(extra_fields=extra_fields)
+        logs = self._read_logs(question=question, projection=projection,
+                               partition=byte_partition)
+        if sort_by_event:
+            logs = sorted(logs, key=self.get_event_order_key)
+        if stream:
+            return logs
+        return list(logs)
+
+    def get_participant_summaries(self, event_ids=None, user_ids=None,
+                                  date_from=None, date_to=None,
+                                  batch_size=None, scan_workers=None):
+        """ Same as `MongoData.get_participant_summaries`. """
+        # lib.summaries imports lib.database itself
+        from lib.summaries import fold_rows, get_log_rows, get_summaries
+        logs = self.get_data(event_ids=event_ids, user_ids=user_ids,
+                             date_from=date_from, date_to=date_to,
+                             stream=True)
+        folded = {}
+        fold_rows(folded=folded, rows=get_log_rows(selected_logs=logs))
+        return get_summaries(folded=folded)
+
+    def is_gzip(self):
+        with open(self.path, 'rb') as f:
+            return f.read(len(self._GZIP_MAGIC)) == self._GZIP_MAGIC
+
+    def open(self):
+        """ Open the file for reading text, gzipped or not. """
+        if self.is_gzip():
+            return gzip.open(self.path, 'rt', encoding='utf-8')
+        return open(self.path, encoding='utf-8')
+
+    def _read_logs(self, question, projection, partition=None):
+        fields = [field for field, used in projection.items() if used]
+        for line in self._read_lines(question=question, partition=partition):
+            if not self._may_match(line):
+                continue
+            try:
+                document = self._parse(line)
+            except ValueError as e:
+                log.warning('Skipping malformed line [%s] of [%s]: %s',
+                            line.strip()[:100], self.path, e)
+                continue
+            if self._matches(document=document, question=question):
+                yield {field: document[field] for field in fields
+                       if field in document}
+
+    def _read_lines(self, question, partition=None):
+        """
+        Yield lines of the file which may be selected by `question`.
+
+        :param partition: (index, partitions), only lines starting in this
+                          part of the file's bytes
+        """
+        date_question = question.get(MongoFields.TIMESTAMP)
+        use_index = (self._index is not None and date_question and
+                     not self.is_gzip())
+        if not use_index and partition is None:
+            with self.open() as f:
+                yield from f
+            return
+
+        if use_index:
+            self._index.refresh()
+            ranges = self._index.get_ranges(
+                date_from=date_question.get('$gte'),
+                date_to=date_question.get('$lt'))
+            # Lines after the indexed part, like the last one without a
+            #   newline or ones appended since
+            indexed, size = self._index.size, os.path.getsize(self.path)
+            if size > indexed:
+                if ranges and ranges[-1][1] == indexed:
+                    ranges[-1] = (ranges[-1][0], size)
+                else:
+                    ranges.append((indexed, size))
+        else:
+            ranges = [(0, os.path.getsize(self.path))]
+        if partition is not None:
+            ranges = self._get_partition_ranges(ranges=ranges,
+                                                partition=partition)
+        if not ranges:
+            return
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start, end in ranges:
+                if start:
+                    # Line started before the range belongs to the previous
+                    #   one, skip to the next line
+                    mm.seek(start - 1)
+                    mm.readline()
+                while mm.tell() < end:
+                    yield mm.readline().decode('utf-8')
+
+    def _get_partition_ranges(self, ranges, partition):
+        """ Cut byte ranges to the part of the file of `partition`. """
+        index, partitions = partition
+        size = os.path.getsize(self.path)
+        part_start = size * index // partitions
+        part_end = size * (index + 1) // partitions
+        return [(max(start, part_start), min(end, part_end))
+                for start, end in ranges
+                if start < part_end and end > part_start]
+
+    @classmethod
+    def _may_match(cls, line):
+        return (all(text in line for text in cls._REQUIRED_TEXT) and
+                any(text in line for text in cls._ACTION_TEXT))
+
+    @staticmethod
+    def _parse(line):
+        """ Parse log, with values in MongoDB extended JSON converted. """
+        document = json.loads(line)
+        _id = document.get(MongoFields.ID)
+        if isinstance(_id, dict) and '$oid' in _id:
+            document[MongoFields.ID] = ObjectId(_id['$oid'])
+        timestamp = document.get(MongoFields.TIMESTAMP)
+        if isinstance(timestamp, dict) and '$date' in timestamp:
+            document[MongoFields.TIMESTAMP] = timestamp['$date']
+        return document
+
+    @classmethod
+    def _matches(cls, document, question):
+        """ Check document against query made by `get_question`. """
+        for field, condition in question.items():
+            value = document.get(field)
+            if not isinstance(condition, dict):
+                if value != condition:
+                    return False
+                continue
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$mod' in condition and (
+                    not isinstance(value, int) or
+                    value % condition['$mod'][0] != condition['$mod'][1]):
+                return False
+            if value is None and condition.keys() & {'$gt', '$gte', '$lt'}:
+                return False
+            if '$gt' in condition and not value > condition['$gt']:
+                return False
+            if '$gte' in condition and not value >= condition['$gte']:
+                return False
+            if '$lt' in condition and not value < condition['$lt']:
+                return False
+        return True
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+from bisect import bisect_left
+
+from .fields import MongoFields
+
+log = logging.getLogger(__name__)
+
+
+class LogFileIndex:
+    """
+    Sparse index of a logs export (see `LogFileData`): byte offset of every
+      `every`-th line, with the earliest and the latest timestamp of lines
+      in the block starting there. Kept next to the export in a
+      `<export>.idx` file.
+
+    Blocks which can't have logs from the date window aren't read at all.
+      Exports are written in insertion order, so timestamps mostly grow and
+      blocks of a date window are adjacent. It doesn't rely on it though,
+      the index is correct for any order.
+
+    Exports only grow, so when the file is longer than when indexed, only
+      the new part is indexed. If it was modified, but the first block isn't
+      the same anymore (or it didn't grow), it was written anew and the
+      index is rebuilt.
+    """
+    _VERSION = 2
+    _SUFFIX = '.idx'
+    _TIMESTAMP_RE = re.compile(
+        br'"%s"\s*:\s*(?:\{\s*"\$date"\s*:\s*)?"([^"]+)"' %
+        MongoFields.TIMESTAMP.encode())
+    # Compare lower/higher than any ISO timestamp
+    _BEFORE_ALL = ''
+    _AFTER_ALL = '~'
+
+    def __init__(self, path, every):
+        """
+        :param path: uncompressed logs export
+        :param every: number of lines in one block of the index
+        """
+        self.path = path
+        self.index_path = path + self._SUFFIX
+        self.every = every
+        # Indexed bytes, up to the last complete line
+        self.size = 0
+        # Of the export, in nanoseconds, when it was indexed
+        self.mtime = None
+        # [[offset, earliest timestamp, latest timestamp], ...]
+        self.blocks = []
+        # Hash of the first `head_size` bytes, the first block when indexed
+        self.head_size = 0
+        self.head_hash = None
+
+    def refresh(self):
+        """ Load the index and bring it up to date with the export. """
+        self._load()
+        stat = os.stat(self.path)
+        if stat.st_size == self.size and stat.st_mtime_ns == self.mtime:
+            return
+        # Nothing to compare with when built the first time
+        if self.head_hash is not None and (
+                stat.st_size <= self.size or
+                self._get_head_hash(size=self.head_size) != self.head_hash):
+            log.info('Logs export [%s] was rewritten, rebuilding its index',
+                     self.path)
+            self.size, self.blocks = 0, []
+        self._extend(size=stat.st_size)
+        self.mtime = stat.st_mtime_ns
+        self._save()
+
+    def get_ranges(self, date_from=None, date_to=None):
+        """
+        Return byte ranges which may contain logs from the date window.
+
+        :param date_from: '2016-07-02T00:00:00.000Z', included
+        :param date_to: '2016-07-03T00:00:00.000Z', excluded
+        :return: [(start, end), ...] in file order
+        """
+        # Latest timestamp up to a block and earliest from a block on, so
+        #   the window's first and last block can be bisected
+        prefix_max, latest = [], self._BEFORE_ALL
+        for _, _, block_max in self.blocks:
+            latest = max(latest, block_max or self._BEFORE_ALL)
+            prefix_max.append(latest)
+        suffix_min, earliest = [], self._AFTER_ALL
+        for _, block_min, _ in reversed(self.blocks):
+            earliest = min(earliest, block_min or self._AFTER_ALL)
+            suffix_min.append(earliest)
+        suffix_min.reverse()
+
+        first = bisect_left(prefix_max, date_from) if date_from else 0
+        last = (bisect_left(suffix_min, date_to) if date_to
+                else len(self.blocks))
+
+        ranges = []
+        for i in range(first, last):
+            _, block_min, block_max = self.blocks[i]
+            if block_min is None or \
+                    (date_from and block_max < date_from) or \
+                    (date_to and block_min >= date_to):
+                continue
+            start = self.blocks[i][0]
+            end = (self.blocks[i + 1][0] if i + 1 < len(self.blocks)
+                   else self.size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        log.debug('Reading [%s] of [%s] bytes of [%s]',
+                  sum(end - start for start, end in ranges), self.size,
+                  self.path)
+        return ranges
+
+    def _extend(self, size):
+        """ Index lines from the last, possibly partial, block on. """
+        if not size:
+            # Empty file can't be mapped
+            return
+        if self.blocks:
+            offset = self.blocks.pop()[0]
+        else:
+            offset = 0
+
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.seek(offset)
+            block, lines = None, 0
+            while mm.tell() < size:
+                line_offset = mm.tell()
+                line = mm.readline()
+                if not line.endswith(b'\n'):
+                    # Still being written, index it next time
+                    size = line_offset
+                    break
+                if lines % self.every == 0:
+                    block = [line_offset, None, None]
+                    self.blocks.append(block)
+                lines += 1
+
+                match = self._TIMESTAMP_RE.search(line)
+                if match is None:
+                    continue
+                timestamp = match.group(1).decode()
+                if block[1] is None or timestamp < block[1]:
+                    block[1] = timestamp
+                if block[2] is None or timestamp > block[2]:
+                    block[2] = timestamp
+        self.size = size
+        self.head_size = (self.blocks[1][0] if len(self.blocks) > 1
+                          else self.size)
+        self.head_hash = self._get_head_hash(size=self.head_size)
+        log.info('Indexed logs export [%s] up to [%s] bytes, [%s] blocks',
+                 self.path, self.size, len(self.blocks))
+
+    def _get_head_hash(self, size):
+        with open(self.path, 'rb') as f:
+            return hashlib.sha1(f.read(size)).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            log.debug('No index of [%s]: %s', self.path, e)
+            return
+        if (index.get('version') != self._VERSION or
+                index.get('every') != self.every):
+            return
+        self.size = index['size']
+        self.mtime = index['mtime']
+        self.blocks = index['blocks']
+        self.head_size = index['head_size']
+        self.head_hash = index['head_hash']
+
+    def _save(self):
+        index = {'version': self._VERSION, 'every': self.every,
+                 'size': self.size, 'mtime': self.mtime,
+                 'blocks': self.blocks, 'head_size': self.head_size,
+                 'head_hash': self.head_hash}
+        try:
+            with open(self.index_path, 'w') as f:
+                json.dump(index, f)
+        except OSError as e:
+            log.warning('Could not save index of logs export [%s]: %s',
+                        self.index_path, e)
@@ -1,9 +1,18 @@
+import heapq
+import itertools
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-import dateutil.parser
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
 
+from lib.extras import get_chunks
+from lib.timestamps import format_log_timestamp, parse_timestamp
+from .fields import MongoFields, SummaryFields
+
 log = logging.getLogger(__name__)
 
 
@@ -11,10 +20,78 @@ class MongoData:
     _filter_join_events = {'message': 'events',
                            'action': {'$in': ['join', 'leave']}}
     _TIME_TEMPLATE = '%sT00:00:00.000Z'
+    _ACTION_JOIN = 'join'
+    _ACTION_LEAVE = 'leave'
+    # Date window is applied in `get_data` query
+    FILTERS_DATE = True
+    # Timestamp ranges read by each scan worker (see `get_data`)
+    _RANGES_PER_WORKER = 4
+    # Max number of ids in one `$in` (see `get_questions`)
+    _ID_CHUNK_SIZE = 1000
+    _id_chunk_size = None
+    _connection_string = None
+    _database_name = None
+    _BSON_STRING = 2
+    # Documents of every question read ahead by `_read_questions`, when no
+    #   batch size is given. Same as the first batch of a MongoDB cursor
+    _READ_AHEAD = 101
+    # Order of logs with `sort_by_event` (see `get_data`)
+    _EVENT_ORDER = [(MongoFields.EVENT_ID, ASCENDING),
+                    (MongoFields.TIMESTAMP, ASCENDING)]
+    # Compound indexes serving `get_question`: equality fields first, then
+    #   the timestamp range. Logs without events or users selection are
+    #   served by the timestamp one, logs after a checkpoint (`after_id`) by
+    #   the `_id` one
+    RECOMMENDED_INDEXES = (
+        ('message_action_eventId_timestamp',
+         [(MongoFields.MESSAGE, ASCENDING), (MongoFields.ACTION, ASCENDING),
+          (MongoFields.EVENT_ID, ASCENDING),
+          (MongoFields.TIMESTAMP, ASCENDING)]),
+        ('message_action_userId_timestamp',
+         [(MongoFields.MESSAGE, ASCENDING), (MongoFields.ACTION, ASCENDING),
+          (MongoFields.USER_ID, ASCENDING),
+          (MongoFields.TIMESTAMP, ASCENDING)]),
+        ('message_action_timestamp',
+         [(MongoFields.MESSAGE, ASCENDING), (MongoFields.ACTION, ASCENDING),
+          (MongoFields.TIMESTAMP, ASCENDING)]),
+        ('message_action__id',
+         [(MongoFields.MESSAGE, ASCENDING), (MongoFields.ACTION, ASCENDING),
+          (MongoFields.ID, ASCENDING)]),
+    )
+    # Selections made by `get_question`, explained by `explain_questions`.
+    #   Values don't matter, only the fields used. `timestamp` replaces the
+    #   timestamp question (like in `get_range_questions`), `sort` is the
+    #   order asked of the cursor
+    QUERY_SHAPES = (
+        ('events', {'event_ids': [0]}),
+        ('users', {'user_ids': ['0']}),
+        ('events and users', {'event_ids': [0], 'user_ids': ['0']}),
+        ('dates', {'date_from': '2016-07-02'}),
+        ('events and dates', {'event_ids': [0], 'date_from': '2016-07-02'}),
+        ('users and dates', {'user_ids': ['0'], 'date_from': '2016-07-02'}),
+        ('everything', {}),
+        ('logs after checkpoint',
+         {'after_id': '000000000000000000000000',
+          'before_id': 'ffffffffffffffffffffffff'}),
+        ('timestamp range',
+         {'timestamp': {'$gte': '2016-07-02T00:00:00.000Z',
+                        '$lt': '2016-07-03T00:00:00.000Z'},
+          'sort': [(MongoFields.TIMESTAMP, ASCENDING)]}),
+        ('timestamp bounds',
+         {'timestamp': {'$type': _BSON_STRING},
+          'sort': [(MongoFields.TIMESTAMP, ASCENDING)]}),
+        ('no string timestamp',
+         {'timestamp': {'$not': {'$type': _BSON_STRING}}}),
+        ('events sorted by event', {'event_ids': [0], 'sort': _EVENT_ORDER}),
+        ('sorted by event', {'sort': _EVENT_ORDER}),
+    )
     db_mongo = None
 
     def __init__(self, connection_string, database_name,
-                 check_db_connection_timeout=5):
+                 check_db_connection_timeout=5, id_chunk_size=None):
+        """
+        :param id_chunk_size: max number of event or user ids in one query
+        """
         def check_database_connection():
             try:
                 client = MongoClient(
@@ -28,12 +105,27 @@ class MongoData:
                 exit(1)
 
         check_database_connection()
+        self._connection_string = connection_string
+        self._database_name = database_name
+        self._id_chunk_size = id_chunk_size
         self._client = MongoClient(connection_string)
         self.db_mongo = self._client[database_name]
 
+    def get_copy_arguments(self):
+        """
+        Return arguments opening the same source in another process, with
+          its own connection. MongoClient can't be passed to other processes.
+        """
+        return {'connection_string': self._connection_string,
+                'database_name': self._database_name,
+                'id_chunk_size': self._id_chunk_size}
+
     @classmethod
     def filter_date(cls, data, date_from=None, date_to=None):
         """
+        Client side date filtering. Only used as a fallback for sources that
+          can't filter by date themselves (see `get_data`).
+
             114498861474704307604: 2016-03-22T02:05:03.806Z
             108960323403366113062: 2016-03-23T09:50:41.085Z
             104697518485852908489: 2016-03-28T22:10:57.527Z
@@ -51,89 +143,518 @@ class MongoData:
         :param date_to:
         :return:
         """
-        # TODO: Move date filtering to database
-        def handle_both(date_from, date_to):
-            ret_f = []
-            date_from_orig = date_from
-            date_to_orig = date_to
-            date_from = dateutil.parser.parse(cls._TIME_TEMPLATE % date_from)
-            date_to = dateutil.parser.parse(cls._TIME_TEMPLATE % date_to)
-
-            if date_from > date_to:
-                raise RuntimeError(
-                    'Date from "%s" is earlier than date to "%s".' % (
-                        date_from_orig, date_to_orig))
-            elif date_from_orig == date_to_orig:
-                raise RuntimeError(
-                    'Date_from "%s" is the same as date_to "%s". '
-                    'If results should include only one day, '
-                    'set date_to to date_from+1day. ' % (
-                        date_from_orig, date_to_orig))
-            for row in data:
-                try:
-                    log_date = dateutil.parser.parse(row['timestamp'])
-                    if date_from < log_date < date_to:
-                        ret_f.append(row)
-                except KeyError as e:
-                    log.error("Couldn't determine logs date [%s] Error [%s]",
-                              row, e)
-            return ret_f
-
-        def handle_from(date_from):
-            ret_f = []
-            date_from = dateutil.parser.parse(cls._TIME_TEMPLATE % date_from)
-            for row in data:
-                try:
-                    log_date = dateutil.parser.parse(row['timestamp'])
-                    if date_from < log_date:
-                        ret_f.append(row)
-                except KeyError as e:
-                    log.error("Couldn't determine logs date [%s] Error [%s]",
-                              row, e)
-            return ret_f
-
-        def handle_to(date_to):
-            ret_f = []
-            date_to = dateutil.parser.parse(cls._TIME_TEMPLATE % date_to)
-            for row in data:
-                try:
-                    log_date = dateutil.parser.parse(row['timestamp'])
-                    if log_date < date_to:
-                        ret_f.append(row)
-                except KeyError as e:
-                    log.error("Couldn't determine logs date [%s] Error [%s]",
-                              row, e)
-            return ret_f
-
-        ret = data
         if date_from is None and date_to is None:
-            pass
-        elif date_from and date_to:
-            ret = handle_both(date_from, date_to)
-        elif date_from:
-            ret = handle_from(date_from)
-        elif date_to:
-            ret = handle_to(date_to)
+            return data
+
+        cls._check_date_range(date_from=date_from, date_to=date_to)
+        if date_from:
+            date_from = cls._parse_date(date_from)
+        if date_to:
+            date_to = cls._parse_date(date_to)
+
+        def in_date_range(row):
+            try:
+                log_date = parse_timestamp(row[MongoFields.TIMESTAMP])
+            except KeyError as e:
+                log.error("Couldn't determine logs date [%s] Error [%s]",
+                          row, e)
+                return False
+            if date_from and log_date < date_from:
+                return False
+            if date_to and log_date >= date_to:
+                return False
+            return True
+
+        ret = (row for row in data if in_date_range(row))
+        if isinstance(data, list):
+            # Streamed data stays lazy, lists stay lists
+            ret = list(ret)
+        return ret
+
+    @classmethod
+    def get_date_question(cls, date_from=None, date_to=None):
+        """
+        Translate date window to range predicate on `timestamp`.
+        Timestamps are stored as ISO strings in UTC
+          ('2016-05-26T16:37:46.106Z'), so they sort lexicographically. Bounds
+          are formatted the same way, so dates like '2016-7-2' compare right.
+
+        :param date_from: '2016-07-02', included
+        :param date_to: '2016-07-03', excluded
+        :return: {'$gte': '2016-07-02T00:00:00.000Z', ...} or None
+        """
+        if date_from is None and date_to is None:
+            return None
+
+        cls._check_date_range(date_from=date_from, date_to=date_to)
+        ret = {}
+        if date_from:
+            ret['$gte'] = format_log_timestamp(cls._parse_date(date_from))
+        if date_to:
+            ret['$lt'] = format_log_timestamp(cls._parse_date(date_to))
         return ret
 
-    def get_data(self, event_ids=None, user_ids=None):
+    @classmethod
+    def _parse_date(cls, date):
+        """ '2016-07-02' -> aware datetime of its midnight in UTC. """
+        return parse_timestamp(cls._TIME_TEMPLATE % date)
+
+    @classmethod
+    def _check_date_range(cls, date_from, date_to):
+        if not (date_from and date_to):
+            return
+
+        parsed_from = cls._parse_date(date_from)
+        parsed_to = cls._parse_date(date_to)
+        if parsed_from == parsed_to:
+            raise RuntimeError(
+                'Date_from "%s" is the same as date_to "%s". '
+                'If results should include only one day, '
+                'set date_to to date_from+1day. ' % (date_from, date_to))
+
+        if parsed_from > parsed_to:
+            raise RuntimeError(
+                'Date from "%s" is earlier than date to "%s".' % (
+                    date_from, date_to))
+
+    def get_data(self, event_ids=None, user_ids=None, date_from=None,
+                 date_to=None, stream=False, batch_size=None,
+                 extra_fields=None, scan_workers=None, after_id=None,
+                 sort_by_event=False, partition=None, before_id=None):
         """
         Get data about specific events or users.
+        Date window is resolved by the database, so `filter_date` is not
+          needed afterwards (see `FILTERS_DATE`).
+
+        With `stream` documents are consumed straight from the cursor, so
+          only `batch_size` of them are held by the driver at once.
+
+        With `scan_workers` the selection is split into disjoint timestamp
+          ranges read concurrently. Logs are returned range after range,
+          each range sorted by timestamp by the database, so they come in
+          timestamp order. Logs with no timestamp or one which isn't
+          a string come first, in no particular order.
+
+        Long lists of ids are split into chunks (see `get_questions`), each
+          read by its own query, `scan_workers` of them at once. Logs come
+          chunk after chunk then, without timestamp ranges.
+
+        With `sort_by_event` logs come ordered by (eventId, timestamp), see
+          `get_event_order_key`. It's sorted by the database, so all logs of
+          an event come together without being held in memory. Cursors of
+          id chunks are merged, `scan_workers` don't apply.
 
         :param user_ids:
         :param user_ids: list of userIds
         :type event_ids: list of eventIds
+        :param date_from: '2016-07-02', logs from this date and later
+        :param date_to: '2016-07-03', logs earlier than this date
+        :param stream: return cursor instead of list
+        :param batch_size: number of documents fetched per round-trip
+        :param extra_fields: fields to fetch besides `MongoFields.USED_FIELDS`
+        :param scan_workers: number of ranges read at once
+        :param after_id: only logs inserted after the one with this `_id`
+        :param sort_by_event: order logs by eventId and timestamp
+        :param partition: (index, partitions), only logs of events with
+                          eventId % partitions == index
+        :param before_id: only logs with lower `_id`, see `get_settled_id`
         :return:
         """
+        questions = self.get_questions(event_ids=event_ids,
+                                       user_ids=user_ids,
+                                       date_from=date_from, date_to=date_to,
+                                       after_id=after_id, partition=partition,
+                                       before_id=before_id)
+        # Else whole db is downloaded for 'action': 'join'
+        projection = self.get_projection(extra_fields=extra_fields)
+        if sort_by_event:
+            logs = self._read_sorted_by_event(questions=questions,
+                                              projection=projection,
+                                              batch_size=batch_size)
+            return logs if stream else list(logs)
+
+        if len(questions) > 1:
+            logs = self._read_questions(questions=questions,
+                                        projection=projection,
+                                        batch_size=batch_size,
+                                        workers=scan_workers or 1)
+            return logs if stream else list(logs)
+
+        question = questions[0]
+        if scan_workers and scan_workers > 1:
+            range_questions = self.get_range_questions(
+                question=question,
+                ranges=scan_workers * self._RANGES_PER_WORKER)
+            logs = self._read_questions(questions=range_questions,
+                                        projection=projection,
+                                        batch_size=batch_size,
+                                        workers=scan_workers,
+                                        by_timestamp=True)
+            return logs if stream else list(logs)
+
+        cursor = self.db_mongo.analytics.find(question, projection)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+
+        if stream:
+            # Cursor is lazy by itself, documents are fetched batch by batch
+            return cursor
+        return list(cursor)
+
+    @staticmethod
+    def get_event_order_key(log_entry):
+        """ (eventId, timestamp), same order as sorted by the database. """
+        # Missing timestamps are sorted first, like nulls
+        return (log_entry[MongoFields.EVENT_ID],
+                log_entry.get(MongoFields.TIMESTAMP) or '')
+
+    def _read_sorted_by_event(self, questions, projection, batch_size):
+        """ Merge cursors of questions sorted by (eventId, timestamp). """
+        cursors = []
+        for question in questions:
+            cursor = self.db_mongo.analytics.find(question, projection).sort(
+                self._EVENT_ORDER)
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+            cursors.append(cursor)
+        if len(cursors) == 1:
+            return cursors[0]
+        return heapq.merge(*cursors, key=self.get_event_order_key)
+
+    def get_range_questions(self, question, ranges):
+        """
+        Split `question` into disjoint timestamp ranges of equal duration,
+          between the earliest and the latest selected log. Without a date
+          window, logs with no timestamp or one which isn't a string (eg.
+          BSON date) get their own, first range, as string bounds don't
+          match them.
+
+        :param question: see `get_question`
+        :param ranges: max number of ranges
+        :return: [question, question, ...] in timestamp order
+        """
+        timestamp_question = dict(question.get(MongoFields.TIMESTAMP) or {})
+        ret = []
+        if not timestamp_question:
+            # Outside of any date window
+            ret.append(dict(question, **{MongoFields.TIMESTAMP: {
+                '$not': {'$type': self._BSON_STRING}}}))
+
+        first, last = self._get_timestamp_bounds(question=question)
+        if first is None:
+            return ret
+
+        first_date = parse_timestamp(first)
+        step = (parse_timestamp(last) - first_date) / ranges
+        bounds = [first]
+        for i in range(1, ranges):
+            bound = format_log_timestamp(first_date + step * i)
+            if bound > bounds[-1]:
+                bounds.append(bound)
+
+        for i, lower in enumerate(bounds):
+            range_timestamp = dict(timestamp_question, **{'$gte': lower})
+            if i + 1 < len(bounds):
+                range_timestamp['$lt'] = bounds[i + 1]
+            ret.append(dict(question,
+                            **{MongoFields.TIMESTAMP: range_timestamp}))
+        return ret
+
+    def _get_timestamp_bounds(self, question):
+        """ Return the earliest and the latest timestamp of selected logs. """
+        timestamp_question = dict(question.get(MongoFields.TIMESTAMP) or {})
+        timestamp_question['$type'] = self._BSON_STRING
+        bounds_question = dict(question,
+                               **{MongoFields.TIMESTAMP: timestamp_question})
+        projection = {MongoFields.TIMESTAMP: True, MongoFields.ID: False}
+
+        def get_edge(direction):
+            cursor = self.db_mongo.analytics.find(bounds_question, projection)
+            for document in cursor.sort(MongoFields.TIMESTAMP,
+                                        direction).limit(1):
+                return document[MongoFields.TIMESTAMP]
+
+        return get_edge(ASCENDING), get_edge(DESCENDING)
+
+    def _read_questions(self, questions, projection, batch_size, workers,
+                        by_timestamp=False):
+        """
+        Read questions in `workers` threads, see `_read_cursors`.
+
+        :param by_timestamp: let the database sort logs of timestamp ranges
+                             (see `get_range_questions`) by timestamp
+        """
+        def open_cursor(question):
+            cursor = self.db_mongo.analytics.find(question, projection)
+            if by_timestamp and '$gte' in question[MongoFields.TIMESTAMP]:
+                cursor = cursor.sort([(MongoFields.TIMESTAMP, ASCENDING)])
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+            return cursor
+
+        return self._read_cursors(open_cursor=open_cursor,
+                                  questions=questions, batch_size=batch_size,
+                                  workers=workers)
+
+    def _read_cursors(self, open_cursor, questions, batch_size, workers):
+        """
+        Open cursors of questions in `workers` threads, yielding documents
+          question after question. Only the first batch of the next `workers`
+          questions is read ahead of the consumed one, the rest comes from
+          their cursors while they are consumed.
+
+        :param open_cursor: f(question) -> cursor
+        """
+        read_ahead = batch_size or self._READ_AHEAD
+
+        def read_question(question):
+            cursor = open_cursor(question)
+            return list(itertools.islice(cursor, read_ahead)), cursor
+
+        questions = iter(questions)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = deque(executor.submit(read_question, question)
+                            for _, question in zip(range(workers), questions))
+            while futures:
+                first_batch, cursor = futures.popleft().result()
+                for question in questions:
+                    futures.append(executor.submit(read_question, question))
+                    break
+                yield from first_batch
+                yield from cursor
+
+    def get_participant_summaries(self, event_ids=None, user_ids=None,
+                                  date_from=None, date_to=None,
+                                  batch_size=None, scan_workers=None):
+        """
+        Get participants already reduced by the database, one document per
+          (event, user) pair instead of every join/leave log.
+        Selection is the same as in `get_data`.
+
+        {'eventId': 430,
+         'userId': '116777777777777758951',
+         'join': '2016-05-26T16:37:46.106Z',
+         'leave': '2016-05-26T17:40:11.811Z',
+         'joinCount': 3,
+         'leaveCount': 2,
+         'firstSeen': '2016-05-26T16:37:46.106Z',
+         'lastSeen': '2016-05-26T17:40:11.811Z'}
+
+        :param batch_size: number of documents fetched per round-trip
+        :param scan_workers: number of threads running aggregations of id
+                             chunks (see `get_questions`) at once
+        :return: iterator of `SummaryFields` documents
+        """
+        questions = self.get_questions(event_ids=event_ids,
+                                       user_ids=user_ids,
+                                       date_from=date_from, date_to=date_to)
+        options = {'allowDiskUse': True}
+        if batch_size:
+            options['batchSize'] = batch_size
+        # Chunks have disjoint (eventId, userId) pairs, so their summaries
+        #   don't need merging
+        return self._read_cursors(
+            open_cursor=lambda question: self.db_mongo.analytics.aggregate(
+                self.get_summary_pipeline(question=question), **options),
+            questions=questions, batch_size=batch_size,
+            workers=scan_workers or 1)
+
+    @classmethod
+    def get_summary_pipeline(cls, question):
+        """
+        $match logs and $group them by (eventId, userId). Timestamps are ISO
+          strings, so $min/$max give the earliest/latest ones. Null values
+          are ignored by $min/$max, so only given action is taken into account.
+        """
+        def when_action(action, then, otherwise=None):
+            return {'$cond': [{'$eq': ['$' + MongoFields.ACTION, action]},
+                              then, otherwise]}
+
+        timestamp = '$' + MongoFields.TIMESTAMP
+        group = {
+            MongoFields.ID: {
+                SummaryFields.EVENT_ID: '$' + MongoFields.EVENT_ID,
+                SummaryFields.USER_ID: '$' + MongoFields.USER_ID},
+            SummaryFields.JOIN: {
+                '$min': when_action(cls._ACTION_JOIN, timestamp)},
+            SummaryFields.LEAVE: {
+                '$max': when_action(cls._ACTION_LEAVE, timestamp)},
+            SummaryFields.JOIN_COUNT: {
+                '$sum': when_action(cls._ACTION_JOIN, 1, 0)},
+            SummaryFields.LEAVE_COUNT: {
+                '$sum': when_action(cls._ACTION_LEAVE, 1, 0)},
+            SummaryFields.FIRST_SEEN: {'$min': timestamp},
+            SummaryFields.LAST_SEEN: {'$max': timestamp},
+        }
+
+        id_fields = (SummaryFields.EVENT_ID, SummaryFields.USER_ID)
+        project = {field: '$%s.%s' % (MongoFields.ID, field)
+                   for field in id_fields}
+        project.update({field: True for field in (
+            SummaryFields.JOIN, SummaryFields.LEAVE,
+            SummaryFields.JOIN_COUNT, SummaryFields.LEAVE_COUNT,
+            SummaryFields.FIRST_SEEN, SummaryFields.LAST_SEEN)})
+        project[MongoFields.ID] = False
+
+        return [{'$match': question},
+                {'$group': group},
+                {'$project': project}]
+
+    def get_indexes(self):
+        """ Return {name: [(field, direction), ...]} of `analytics`. """
+        return {name: [(field, direction) for field, direction in info['key']]
+                for name, info in
+                self.db_mongo.analytics.index_information().items()}
+
+    def get_missing_indexes(self):
+        """
+        Return `RECOMMENDED_INDEXES` not present in `analytics`. Indexes are
+          compared by their keys, so the name doesn't matter.
+        """
+        existing_keys = [keys for keys in self.get_indexes().values()]
+        return [(name, keys) for name, keys in self.RECOMMENDED_INDEXES
+                if keys not in existing_keys]
+
+    def create_indexes(self):
+        """
+        Create missing `RECOMMENDED_INDEXES`. They are built in the
+          background, so the collection stays available meanwhile.
+
+        :return: names of created indexes
+        """
+        created = []
+        for name, keys in self.get_missing_indexes():
+            log.info('Creating index [%s] on [%s]', name, keys)
+            self.db_mongo.analytics.create_index(keys, name=name,
+                                                 background=True)
+            created.append(name)
+        return created
+
+    def explain_questions(self):
+        """
+        Return which index the database would use for every
+          `QUERY_SHAPES` selection.
+
+        :return: [(shape, index name or 'COLLSCAN'), ...]
+        """
+        ret = []
+        for shape, selection in self.QUERY_SHAPES:
+            selection = dict(selection)
+            timestamp_question = selection.pop('timestamp', None)
+            sort = selection.pop('sort', None)
+            question = self.get_question(**selection)
+            if timestamp_question is not None:
+                question[MongoFields.TIMESTAMP] = timestamp_question
+            cursor = self.db_mongo.analytics.find(question,
+                                                  self.get_projection())
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            explained = cursor.explain()
+            ret.append((shape, self._get_plan_index(
+                plan=explained['queryPlanner']['winningPlan'])))
+        return ret
+
+    @classmethod
+    def _get_plan_index(cls, plan):
+        """ Find index scanned by the query plan, through its stages. """
+        if plan.get('stage') == 'COLLSCAN':
+            return 'COLLSCAN'
+        if 'indexName' in plan:
+            return plan['indexName']
+        stages = list(plan.get('inputStages', []))
+        if 'inputStage' in plan:
+            stages.append(plan['inputStage'])
+        indexes = [cls._get_plan_index(plan=stage) for stage in stages]
+        return ', '.join(index for index in indexes if index) or None
+
+    def get_questions(self, event_ids=None, user_ids=None, date_from=None,
+                      date_to=None, after_id=None, partition=None,
+                      before_id=None):
+        """
+        Same selection as `get_question`, split so no `$in` has more than
+          `id_chunk_size` ids. Every (event, user) pair is in one question.
+
+        :return: [question, ...]
+        """
+        chunk_size = self._id_chunk_size or self._ID_CHUNK_SIZE
+
+        def get_id_chunks(ids):
+            if ids is None:
+                return [None]
+            return list(get_chunks(ids, size=chunk_size)) or [ids]
+
+        questions = [
+            self.get_question(event_ids=event_chunk, user_ids=user_chunk,
+                              date_from=date_from, date_to=date_to,
+                              after_id=after_id, partition=partition,
+                              before_id=before_id)
+            for event_chunk, user_chunk in itertools.product(
+                get_id_chunks(event_ids), get_id_chunks(user_ids))]
+        if len(questions) > 1:
+            log.debug('Split selection into [%s] queries', len(questions))
+        return questions
+
+    def get_question(self, event_ids=None, user_ids=None, date_from=None,
+                     date_to=None, after_id=None, partition=None,
+                     before_id=None):
+        """ Return query document selecting join/leave logs. """
         question = self.filter_join_events
 
         if event_ids is not None:
-            question['eventId'] = self._search_in(event_ids)
+            question[MongoFields.EVENT_ID] = self._search_in(event_ids)
+        if partition is not None:
+            index, partitions = partition
+            question.setdefault(MongoFields.EVENT_ID, {})['$mod'] = [
+                partitions, index]
         if user_ids is not None:
-            question['userId'] = self._search_in(user_ids, cast=str)
-        # Else whole db is downloaded for 'action': 'join'
-        ret = list(self.db_mongo.analytics.find(question))
-        return ret
+            question[MongoFields.USER_ID] = self._search_in(user_ids, cast=str)
+        date_question = self.get_date_question(date_from=date_from,
+                                               date_to=date_to)
+        if date_question is not None:
+            question[MongoFields.TIMESTAMP] = date_question
+        if after_id is not None:
+            question[MongoFields.ID] = {'$gt': ObjectId(str(after_id))}
+        if before_id is not None:
+            question.setdefault(MongoFields.ID, {})['$lt'] = ObjectId(
+                str(before_id))
+        return question
+
+    @staticmethod
+    def get_settled_id(lag):
+        """
+        Return `_id` below which all logs are taken as inserted already.
+
+        `_id`s are made by writers: seconds of their clock, a random value
+          of the process and a counter. So they don't grow in insertion order
+          across writers, or even within a second, and a checkpoint at the
+          highest `_id` read would skip logs inserted later with lower ones.
+          Logs made within the last `lag` seconds are left for later runs,
+          so every log read afterwards has higher `_id` than the checkpoint.
+
+        :param lag: seconds, longer than clock skew of writers plus the time
+                    it takes them to insert a log
+        """
+        return ObjectId.from_datetime(
+            datetime.now(timezone.utc) - timedelta(seconds=lag))
+
+    @classmethod
+    def get_projection(cls, extra_fields=None):
+        """
+        Return projection with only the fields our models use, so the rest of
+          the document isn't sent over the wire and decoded.
+
+        :param extra_fields: ['connectedUsers', '_id', ...]
+        :return: {'action': True, ..., '_id': False}
+        """
+        fields = set(MongoFields.USED_FIELDS)
+        if extra_fields:
+            fields.update(extra_fields)
+
+        projection = {field: True for field in fields}
+        if MongoFields.ID not in fields:
+            # It's always returned, unless explicitly excluded
+            projection[MongoFields.ID] = False
+        return projection
 
     @property
     def filter_join_events(self):
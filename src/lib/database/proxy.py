@@ -1,12 +1,26 @@
 import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.database.stub_data import get_event_stub_data, get_user_stub_data
 from lib.extras import Setts
 
+log = logging.getLogger(__name__)
+
 
 class CaDetailsProvider(collections.MutableMapping):
     _MAX_EVENT_ID = 99999
+    # Details of events, by their id
     _proxy_items = None
+    # Details of users, by their index in `Setts.user_id_table`
+    _user_items = None
+
+    # Event ids/user indexes which details weren't asked for in CouchDB yet
+    _pending_ids = None
+    _pending_user_indexes = None
+    # Background fetching of details, while logs are still processed
+    _executor = None
+    _futures = None
 
     def __init__(self):
         """
@@ -25,19 +39,42 @@ class CaDetailsProvider(collections.MutableMapping):
             + ...                                 +----+
         """
         self._proxy_items = {}
+        self._user_items = []
+        self._pending_ids = []
+        self._pending_user_indexes = []
+        self._futures = []
 
     def __delitem__(self, key):
         # @TODO: Check it
-        del self._proxy_items[key]
+        key = int(key)
+        if self._is_user(ca_id=key):
+            index = Setts.user_id_table.find(user_id=key)
+            if index is None or index >= len(self._user_items) or \
+                    self._user_items[index] is None:
+                raise KeyError(key)
+            self._user_items[index] = None
+        else:
+            del self._proxy_items[key]
 
     def __setitem__(self, key, value):
-        self._proxy_items[key] = value
+        key = int(key)
+        if self._is_user(ca_id=key):
+            index = Setts.user_id_table.intern(user_id=key)
+            self._extend_user_items(size=index + 1)
+            self._user_items[index] = value
+        else:
+            self._proxy_items[key] = value
 
     def __len__(self):
-        return len(self._proxy_items)
+        return len(self._proxy_items) + sum(
+            1 for details in self._user_items if details is not None)
 
     def __iter__(self):
-        return iter(self._proxy_items)
+        yield from self._proxy_items
+        user_id_table = Setts.user_id_table
+        for index, details in enumerate(self._user_items):
+            if details is not None:
+                yield user_id_table.get_user_id(index=index)
 
     def __getitem__(self, key):
         """
@@ -49,38 +86,120 @@ class CaDetailsProvider(collections.MutableMapping):
         :type key: int
         :return:
         """
+        key = int(key)
+        if self._is_user(ca_id=key):
+            return self.get_user_details(
+                user_index=Setts.user_id_table.intern(user_id=key))
+
         try:
-            details_proxy = self._proxy_items[int(key)]
+            details_proxy = self._proxy_items[key]
             return details_proxy
         except KeyError:
-            details_proxy = self._get_proxy_stub(ca_id=key)
+            details_proxy = get_event_stub_data(event_id=key)
             self._proxy_items[key] = details_proxy
+            self._pending_ids.append(key)
+            self._check_pending()
             return details_proxy
 
-    @classmethod
-    def _get_proxy_stub(cls, ca_id):
-        if cls._is_user(ca_id=ca_id):
-            details_proxy = get_user_stub_data(user_id=ca_id)
-        else:
-            details_proxy = get_event_stub_data(event_id=ca_id)
+    def get_user_details(self, user_index):
+        """
+        Same as `__getitem__`, but for user already interned in
+          `Setts.user_id_table`. Details are kept in a list by user index.
+
+        :param user_index: int
+        :return:
+        """
+        try:
+            details_proxy = self._user_items[user_index]
+        except IndexError:
+            self._extend_user_items(size=user_index + 1)
+            details_proxy = None
+
+        if details_proxy is None:
+            user_id = Setts.user_id_table.get_user_id(index=user_index)
+            details_proxy = get_user_stub_data(user_id=user_id)
+            self._user_items[user_index] = details_proxy
+            self._pending_user_indexes.append(user_index)
+            self._check_pending()
         return details_proxy
 
+    def _extend_user_items(self, size):
+        missing = size - len(self._user_items)
+        if missing > 0:
+            self._user_items.extend([None] * missing)
+
     @classmethod
     def _is_user(cls, ca_id):
         return ca_id > cls._MAX_EVENT_ID
 
     def get_details_from_db(self):
-        def get_event_and_user_id_lists():
-            evnt_ids, usr_ids = [], []
-            for ca_id in self._proxy_items:
-                if self._is_user(ca_id=ca_id):
-                    usr_ids.append(ca_id)
-                else:
-                    evnt_ids.append(ca_id)
-            return evnt_ids, usr_ids
-
-        event_ids, user_ids = get_event_and_user_id_lists()
+        """
+        Make sure that details of all known events and users are fetched.
+        Some of them may have been already fetched in the background (see
+          `Setts.COUCH_PREFETCH`), here we only wait for them.
+        """
+        if self._pending_ids or self._pending_user_indexes:
+            self._fetch_details(event_ids=self._pending_ids,
+                                user_indexes=self._pending_user_indexes)
+            self._pending_ids = []
+            self._pending_user_indexes = []
+
+        futures, self._futures = self._futures, []
+        for future in futures:
+            # Re-raises errors from the worker
+            future.result()
+
+    def forget(self, event_ids, user_indexes):
+        """
+        Drop details of given events/users, eg. when they are already written
+          out. Objects which took details keep them; if they are asked for
+          again, they are fetched again.
+        """
+        for event_id in event_ids:
+            self._proxy_items.pop(event_id, None)
+        for user_index in user_indexes:
+            if user_index < len(self._user_items):
+                self._user_items[user_index] = None
+
+    def close(self):
+        """ Stop the background fetching, once submitted fetches are done. """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _check_pending(self):
+        pending_count = (len(self._pending_ids) +
+                         len(self._pending_user_indexes))
+        if (Setts.COUCH_PREFETCH.value and
+                pending_count >= Setts.COUCH_BATCH_SIZE.value):
+            self._submit_pending()
+
+    def _submit_pending(self):
+        """ Fetch pending details on the worker thread. """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+        event_ids, self._pending_ids = self._pending_ids, []
+        user_indexes, self._pending_user_indexes = \
+            self._pending_user_indexes, []
+        log.debug('Prefetching details of [%s] events and [%s] users',
+                  len(event_ids), len(user_indexes))
+        self._futures.append(
+            self._executor.submit(self._fetch_details, event_ids=event_ids,
+                                  user_indexes=user_indexes))
+
+    def _fetch_details(self, event_ids, user_indexes):
+        """ Fill stubs of given events/users with data from CouchDB. """
+        user_id_table = Setts.user_id_table
+        user_ids = [user_id_table.get_user_id(index=index)
+                    for index in user_indexes]
+
         couch_data = Setts._DB_COUCH.value.get_data(event_ids=event_ids,
                                                     user_ids=user_ids)
         for row in couch_data:
-            self._proxy_items[int(row.key)].update(row.value)
+            ca_id = int(row.key)
+            if self._is_user(ca_id=ca_id):
+                index = user_id_table.find(user_id=ca_id)
+                self._user_items[index].update(row.value)
+            else:
+                self._proxy_items[ca_id].update(row.value)
@@ -1,15 +1,23 @@
 import logging
 
-from lib.database import MongoFields
+from lib.columnar import LogColumns, ParticipantColumns
+from lib.database import MongoFields, SummaryFields
 from lib.event import CaEvent
-from lib.extras import Setts
+from lib.extras import Setts, get_chunks
+from lib.parallel import get_partitioned_summaries
+from lib.spill import ExternalSorter
+from lib.summaries import fold_rows, get_log_rows, get_summaries
 
 log = logging.getLogger(__name__)
 
 
-def get_ca_event_list(selected_logs):
+def get_ca_event_list(selected_logs, summarized=False):
     """
     Return [CaEvent(), CaEvent(), ...]
+    Logs are consumed one by one, so `selected_logs` can be a lazy stream
+      (eg. MongoDB cursor). Only CaEvents are kept, not raw log entries.
+    When `summarized`, participants keep only their first join/last leave
+      and counts, so logs are not available in the events.
 
     :param selected_logs: [ {'eventId': 430,
                              'userId': '116777777777777758951',
@@ -22,6 +30,7 @@ def get_ca_event_list(selected_logs):
                              {..},
                              {..},
                           ]
+    :param summarized:
     :return:
     """
     ca_events_holder = {}
@@ -30,7 +39,7 @@ def get_ca_event_list(selected_logs):
         try:
             ca_event = ca_events_holder[event_id]
         except KeyError:
-            ca_event = CaEvent(event_id=event_id)
+            ca_event = CaEvent(event_id=event_id, summarized=summarized)
             ca_events_holder[event_id] = ca_event
         ca_event.add_participant(log_entry=log_entry)
 
@@ -39,5 +48,183 @@ def get_ca_event_list(selected_logs):
     return sort_output_events(event_list=ca_events_holder.values())
 
 
+def iter_ca_events_sorted(selected_logs, summarized=False):
+    """
+    Yield CaEvent(), CaEvent(), ... like `get_ca_event_list`, but from logs
+      sorted by eventId (see `MongoData.get_data` with `sort_by_event`).
+      An event is finished when logs of the next one start. Besides events
+      already yielded (if the caller keeps them), only the current event and
+      finished ones waiting for details are held in memory.
+
+    Details of finished events are fetched in batches of about
+      `Setts.COUCH_BATCH_SIZE` participants, before those events are yielded.
+      Then they are dropped from `Setts.details_provider`, so it doesn't grow
+      with the whole report. Users taking part in later events are fetched
+      again for them. Events come in eventId order.
+
+    :param selected_logs: same as for `get_ca_event_list`, sorted by eventId
+    :param summarized: same as for `get_ca_event_list`
+    :return:
+    """
+    finished, finished_participants = [], 0
+    ca_event = None
+    for log_entry in selected_logs:
+        event_id = log_entry[MongoFields.EVENT_ID]
+        if ca_event is None or event_id != ca_event.event_id:
+            if ca_event is not None:
+                if event_id < ca_event.event_id:
+                    raise RuntimeError(
+                        'Logs are not sorted by eventId, got [{}] after '
+                        '[{}].'.format(event_id, ca_event.event_id))
+                finished.append(ca_event)
+                finished_participants += ca_event.participants_number
+            if finished_participants >= Setts.COUCH_BATCH_SIZE.value:
+                yield from _get_events_with_details(events=finished)
+                finished, finished_participants = [], 0
+            ca_event = CaEvent(event_id=event_id, summarized=summarized)
+        ca_event.add_participant(log_entry=log_entry)
+
+    if ca_event is not None:
+        finished.append(ca_event)
+    yield from _get_events_with_details(events=finished)
+
+
+def _get_events_with_details(events):
+    details_provider = Setts.details_provider
+    details_provider.get_details_from_db()
+    # Events and their participants keep details they took
+    details_provider.forget(
+        event_ids=[ca_event.event_id for ca_event in events],
+        user_indexes={user_index for ca_event in events
+                      for user_index in ca_event.user_indexes})
+    log.debug('Finished [%s] events', len(events))
+    return events
+
+
+def get_ca_event_list_from_summaries(participant_summaries):
+    """
+    Return [CaEvent(), CaEvent(), ...] built from participants reduced by the
+      database. Logs of participants are not available in those events.
+
+    :param participant_summaries: [ {'eventId': 430,
+                                     'userId': '116777777777777758951',
+                                     'join': '2016-05-26T16:37:46.106Z',
+                                     'leave': '2016-05-26T17:40:11.811Z',
+                                     'joinCount': 3,
+                                     'leaveCount': 2,
+                                     'firstSeen': '2016-05-26T16:37:46.106Z',
+                                     'lastSeen': '2016-05-26T17:40:11.811Z'},
+                                    {..},
+                                  ]
+    :return:
+    """
+    ca_events_holder = {}
+    for summary in participant_summaries:
+        event_id = summary[SummaryFields.EVENT_ID]
+        try:
+            ca_event = ca_events_holder[event_id]
+        except KeyError:
+            ca_event = CaEvent(event_id=event_id, summarized=True)
+            ca_events_holder[event_id] = ca_event
+        ca_event.add_participant_summary(summary=summary)
+
+    Setts.details_provider.get_details_from_db()
+
+    return sort_output_events(event_list=ca_events_holder.values())
+
+
+def get_ca_event_list_columnar(selected_logs):
+    """
+    Return [CaEvent(), CaEvent(), ...] like `get_ca_event_list`, but logs are
+      loaded into NumPy columns and reduced per (event, user) with vectorized
+      operations. CaEvents are built only from reduced participants, so logs
+      are not available in them.
+
+    :param selected_logs: same as for `get_ca_event_list`
+    :return:
+    """
+    columns = LogColumns.from_logs(selected_logs=selected_logs)
+    return get_ca_event_list_from_columns(columns=columns)
+
+
+def get_ca_event_list_from_segments(record_arrays):
+    """
+    Return [CaEvent(), CaEvent(), ...] of logs read from segments (see
+      `LogSegments.read`), with the columnar engine. No decoding of logs is
+      needed.
+
+    :param record_arrays: structured arrays with `segments.RECORD_DTYPE`
+    :return:
+    """
+    columns = LogColumns.from_records(record_arrays=record_arrays)
+    return get_ca_event_list_from_columns(columns=columns)
+
+
+def get_ca_event_list_from_columns(columns):
+    """ Reduce LogColumns per participant and build CaEvents of them. """
+    participants = ParticipantColumns.from_log_columns(columns=columns)
+    log.debug('Reduced [%s] logs to [%s] participants',
+              len(columns), len(participants))
+    return get_ca_event_list_from_summaries(
+        participant_summaries=participants.iter_summaries())
+
+
+def get_ca_event_list_parallel(db_logs, workers, **selection):
+    """
+    Return [CaEvent(), CaEvent(), ...] like `get_ca_event_list`, but logs are
+      read and folded in `workers` processes, each one getting its own
+      partition of them. CaEvents are built from participants reduced by
+      workers, so logs are not available in them.
+
+    :param db_logs: MongoData or LogFileData
+    :param workers: number of worker processes
+    :param selection: event_ids, user_ids, date_from, date_to, batch_size,
+                      same as for `MongoData.get_data`
+    :return:
+    """
+    summaries = get_partitioned_summaries(db_logs=db_logs, workers=workers,
+                                          **selection)
+    return get_ca_event_list_from_summaries(participant_summaries=summaries)
+
+
+def get_ca_event_list_incremental(selected_logs, state):
+    """
+    Return [CaEvent(), CaEvent(), ...] of all logs ever processed with this
+      `state`. Only new logs are given, they are reduced to summaries and
+      merged into the state, which is then used to build CaEvents.
+
+    :param selected_logs: same as for `get_ca_event_list`, but inserted after
+                          `state.high_water` and with `_id`
+    :param state: AggregateState
+    :return:
+    """
+    folded = {}
+    high_water = None
+    for chunk in get_chunks(selected_logs, size=Setts.MONGO_BATCH_SIZE.value):
+        fold_rows(folded=folded, rows=get_log_rows(selected_logs=chunk))
+        chunk_high_water = max(log_entry[MongoFields.ID]
+                               for log_entry in chunk)
+        if high_water is None or chunk_high_water > high_water:
+            high_water = chunk_high_water
+    log.info('Merging [%s] new participants into state, checkpoint [%s]',
+             len(folded), high_water)
+
+    state.merge(summaries=get_summaries(folded=folded), high_water=high_water)
+    return get_ca_event_list_from_summaries(
+        participant_summaries=state.get_summaries())
+
+
 def sort_output_events(event_list):
-    return sorted(event_list, key=Setts.ORDER_BY.event_sort_keys)
+    """
+    Sort events by `Setts.ORDER_BY`. Above `Setts.MEMORY_BUDGET` events,
+      with their participants, are spilled to disk and merged back while
+      they are output.
+
+    :return: list, or iterator when events were spilled
+    """
+    memory_budget = Setts.MEMORY_BUDGET.value
+    if memory_budget is not None:
+        memory_budget = int(memory_budget * 2 ** 20)
+    sorter = ExternalSorter(key=Setts.ORDER_BY.event_sort_keys,
+                            memory_budget=memory_budget)
+    return sorter.sort(items=event_list)
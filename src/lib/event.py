@@ -1,6 +1,5 @@
 import logging
 
-import dateutil.parser
 import dateutil.relativedelta
 
 from lib.database import (
@@ -12,26 +11,24 @@ from lib.extras import (
     STRFTIME_FORMAT,
 )
 from lib.participants import EventParticipantsHandler
+from lib.timestamps import parse_timestamp
 
 log = logging.getLogger(__name__)
 
 
 class CaEvent:
-    _event_id = None
-
-    # Details
-    _calendar_id = None
-    _description = None
-    _start_time = None
-    _end_time = None
-
-    # Handle participants
-    _participants_handler = None
-    add_participant = None  # It'll be _event_participants.add
-
-    # Details storage variables
-    _raw_details = None
-    _details = None  # Cache of converted values
+    # One instance per event, but they are kept for the whole report
+    __slots__ = (
+        '_event_id',
+        # Details
+        '_calendar_id', '_description', '_start_time', '_end_time',
+        # Handle participants
+        '_participants_handler',
+        'add_participant',  # It'll be _event_participants.add
+        'add_participant_summary',  # _event_participants.add_summary
+        # Details storage variable
+        '_raw_details',
+    )
 
     # TODO: Proper error handling
     _error_msg_change = (
@@ -59,19 +56,28 @@ class CaEvent:
 
     _silenced_exceptions = set()
 
-    def __init__(self, event_id):
+    def __init__(self, event_id, summarized=False):
         """
         _raw_details must contain stub of CouchDB info. Dict with None values.
 
         :param event_id:
+        :param summarized: keep only summaries of participants, not their logs
         """
+        self._event_id = None
+        self._calendar_id = None
+        self._description = None
+        self._start_time = None
+        self._end_time = None
+
         # Setup event
         self.event_id = event_id
         self._raw_details = Setts.details_provider[event_id]
 
         # Setup users
-        self._participants_handler = EventParticipantsHandler()
+        self._participants_handler = EventParticipantsHandler(
+            summarized=summarized)
         self.add_participant = self._participants_handler.add
+        self.add_participant_summary = self._participants_handler.add_summary
 
     @property
     def event_id(self):
@@ -113,9 +119,9 @@ class CaEvent:
 
         raw_value = self._raw_details[EventFields.DATE_AND_TIME]
         try:
-            self._start_time = dateutil.parser.parse(raw_value)
+            self._start_time = parse_timestamp(raw_value)
         except AttributeError as e:
-            first_timestamp = self._participants_handler.all_timestamps[0]
+            first_timestamp = self._participants_handler.first_timestamp
             self._start_time = first_timestamp
 
             log_handler = self._get_log_handler(
@@ -145,7 +151,7 @@ class CaEvent:
         except TypeError as e:
             # TODO: When leave time will be implemented for the users,
             #       change it to the last user leaving
-            last_timestamp = self._participants_handler.all_timestamps[-1]
+            last_timestamp = self._participants_handler.last_timestamp
             self._end_time = last_timestamp
             duration = self._end_time - self.start_time
 
@@ -170,7 +176,12 @@ class CaEvent:
 
     @property
     def participants_number(self):
-        return len(self.event_participants())
+        return len(self._participants_handler)
+
+    @property
+    def user_indexes(self):
+        """ Indexes of participants in `Setts.user_id_table`. """
+        return self._participants_handler.user_indexes
 
     @classmethod
     def _get_log_handler(cls, exception_key):
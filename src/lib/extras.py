@@ -3,6 +3,7 @@ import collections
 import csv
 import errno
 import functools
+import itertools
 import json
 import logging
 import operator
@@ -13,6 +14,8 @@ from os.path import join as j
 
 import ruamel.yaml as yaml
 
+from lib.interning import UserIdTable
+
 log = logging.getLogger(__name__)
 
 is_string = lambda val: isinstance(val, str)
@@ -40,10 +43,22 @@ def get_couchdb_id(event_id):
     return str(event_id).rjust(5, '0')
 
 
+def get_chunks(iterable, size):
+    """ Yield lists of at most `size` elements. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class OutputHandler:
     _ca_events_list = None
     _lines = None
     _user_print_templ = '  %s'
+    # Bytes of CSV rows buffered before they are written to the file
+    _CSV_BUFFER_SIZE = 2 ** 20
 
     def __init__(self, ca_events_list):
         """
@@ -64,50 +79,80 @@ class OutputHandler:
         return self._lines
 
     def convert_to_string_output(self):
-        out = []
-        for each_ca_event in self._ca_events_list:
-            out.append(str(each_ca_event))
-            user_list = [self._user_print_templ % str(usr) for usr
-                         in each_ca_event.event_participants()]
-            out.extend(user_list)
-            out.append('')
+        return list(self.iter_lines())
 
-        return out
+    def iter_lines(self):
+        """
+        Yield lines to be written to output, event after event. Events may
+          be a lazy stream (see `engine.iter_ca_events_sorted`), each one is
+          written as soon as it's produced.
+        """
+        if self._lines is not None:
+            yield from self._lines
+            return
+
+        empty = True
+        for each_ca_event in self._ca_events_list:
+            empty = False
+            yield str(each_ca_event)
+            for usr in each_ca_event.event_participants():
+                yield self._user_print_templ % str(usr)
+            yield ''
+        if empty:
+            # Stream turned out empty
+            print('Output created with settings: "%s"' % Setts.cfg)
+            yield 'No data to print.'
 
     def write_terminal(self):
-        for line in self.lines:
+        for line in self.iter_lines():
             print(line)
 
     def write_file(self, f_path):
         f_path = norm_path(f_path, mkfile=False, mkdir=False)
         with open(f_path, 'w') as f:
             print('* Writing to file: "%s"' % f_path)
-            f.write('\n'.join(self.lines))
+            for i, line in enumerate(self.iter_lines()):
+                if i:
+                    f.write('\n')
+                f.write(line)
             print('* Done')
 
     def write_csv(self, f_path):
+        """
+        Write a row per participant, event after event. Events may be a lazy
+          stream, each one is written as soon as it's produced, without
+          building dicts of it. Rows of an event are written together, once
+          all of them are made, so a broken event leaves no rows behind.
+        """
         f_path = norm_path(f_path, mkfile=False, mkdir=False)
 
-        with open(f_path, 'w') as f:
+        with open(f_path, 'w', buffering=self._CSV_BUFFER_SIZE) as f:
             print('* Exporting as: "%s"' % f_path)
-            writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES,
-                                    extrasaction='ignore',
-                                    quoting=csv.QUOTE_NONNUMERIC)
-            writer.writeheader()
+            writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerow(CSV_FIELDNAMES)
             for each_ca_event in self._ca_events_list:
                 try:
-                    event_dict = self.convert_to_dictionary(each_ca_event)
-                    for user in event_dict['Users']:
-                        event_dict['User_ID'] = user['User_ID']
-                        event_dict['User_name'] = user['User_name']
-                        event_dict['Join_time'] = user['Join_time']
-                        event_dict['Leave_time'] = user['Leave_time']
-                        writer.writerow(event_dict)
+                    # Event_ID, Description, Calendar_ID, Start_time,
+                    #   End_time
+                    event_row = (each_ca_event.event_id,
+                                 each_ca_event.description,
+                                 each_ca_event.calendar_id,
+                                 each_ca_event.start_time_str,
+                                 each_ca_event.end_time_str)
+                    rows = []
+                    for user in each_ca_event.event_participants():
+                        timestamp_str = user.timestamp_str
+                        # User_ID, User_name, Join_time, Leave_time
+                        rows.append(event_row + (
+                            user.user_id, user.display_name,
+                            timestamp_str.join, timestamp_str.leave))
                 except Exception as e:
                     log.error(
                         'Error while exporting event [%s] to csv. '
-                        'Skipping that row(s). Caused by: "%s"',
+                        'Skipping that event. Caused by: "%s"',
                         each_ca_event.event_id, e)
+                    continue
+                writer.writerows(rows)
             print('* Done')
 
     def write_json(self, f_path):
@@ -284,22 +329,86 @@ def conf_logs(log_name, log_dir=None, console_level=logging.ERROR,
     log.debug(msg)
 
 
+class IdsAction(argparse.Action):
+    """
+    Store ids given on the command line, converted with `cast`. Argument
+      '@ids.txt' stands for all ids in that file, separated by whitespace,
+      with '#' starting a comment.
+    """
+
+    def __init__(self, *args, cast=int, **kwargs):
+        self.cast = cast
+        super().__init__(*args, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        ids = []
+        for value in values:
+            if value.startswith('@'):
+                ids.extend(self._read_ids(path=value[1:]))
+            else:
+                ids.append(self._cast(value=value))
+        setattr(namespace, self.dest, ids)
+
+    def _read_ids(self, path):
+        try:
+            with open(path) as f:
+                for line in f:
+                    for value in line.split('#', 1)[0].split():
+                        yield self._cast(value=value)
+        except OSError as e:
+            raise argparse.ArgumentError(
+                self, "can't read ids from '%s': %s" % (path, e))
+
+    def _cast(self, value):
+        try:
+            return self.cast(value)
+        except ValueError:
+            raise argparse.ArgumentError(
+                self, 'invalid id: %r' % value) from None
+
+
 def configure_argparse(rwd, start_cmd=None):
     """
     :return
     Namespace(
         cfg=None,
+        couchdb_batch_size=None,
+        couchdb_cache=None,
+        couchdb_cache_size=None,
+        couchdb_cache_ttl=None,
         couchdb_connection_string=None,
+        couchdb_prefetch=None,
+        couchdb_workers=None,
         couchdb_database=None,
         date_from=None,
         date_to=None,
+        engine=None,
         order_by: eventId,
         event=None,
+        export_segments=None,
+        incremental=None,
+        incremental_lag=None,
         log=None,
+        logs_export=None,
+        logs_export_index=None,
+        memory_budget=None,
         mongo_database=None,
         mongodb_connection_string=None,
+        mongo_aggregate=None,
+        mongo_batch_size=None,
+        mongo_extra_fields=None,
+        mongo_id_chunk_size=None,
+        mongo_indexes=None,
+        mongo_scan_workers=None,
         output_destination=None,
-        user=None
+        pipeline=None,
+        pipeline_queue_size=None,
+        rebuild=None,
+        segments=None,
+        stream=None,
+        summarize_participants=None,
+        user=None,
+        workers=None
     )
     """
     # TODO: Move it to inside/get from setts class
@@ -320,14 +429,16 @@ def configure_argparse(rwd, start_cmd=None):
     stats_opt.add_argument('-e', '--' + Setts.EVENT.key,
                            help=Setts.EVENT.desc,
                            metavar='EVENT_ID',
-                           type=int,
+                           action=IdsAction,
+                           cast=int,
                            nargs='*',
                            )
 
     stats_opt.add_argument('-u', '--' + Setts.USER.key,
                            help=Setts.USER.desc,
                            metavar='USER_ID',
-                           type=int,
+                           action=IdsAction,
+                           cast=int,
                            nargs='*',
                            )
 
@@ -352,6 +463,137 @@ def configure_argparse(rwd, start_cmd=None):
                            nargs='*',
                            )
 
+    proc_opt = parser.add_argument_group('Processing Options')
+
+    proc_opt.add_argument('--' + Setts.ENGINE.key,
+                          help=Setts.ENGINE.desc,
+                          choices=Setts.ENGINE.choices,
+                          type=str,
+                          )
+
+    proc_opt.add_argument('--' + Setts.PIPELINE.key,
+                          help=Setts.PIPELINE.desc,
+                          action='store_const',
+                          const=True,
+                          )
+
+    proc_opt.add_argument('--' + Setts.PIPELINE_QUEUE_SIZE.key,
+                          help=Setts.PIPELINE_QUEUE_SIZE.desc,
+                          metavar='SIZE',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.MEMORY_BUDGET.key,
+                          help=Setts.MEMORY_BUDGET.desc,
+                          metavar='MB',
+                          type=float,
+                          )
+
+    proc_opt.add_argument('--' + Setts.WORKERS.key,
+                          help=Setts.WORKERS.desc,
+                          metavar='NUMBER',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.STREAM.key,
+                          help=Setts.STREAM.desc,
+                          action='store_const',
+                          const=True,
+                          )
+
+    proc_opt.add_argument('--' + Setts.SUMMARIZE.key,
+                          help=Setts.SUMMARIZE.desc,
+                          action='store_const',
+                          const=True,
+                          )
+
+    proc_opt.add_argument('--' + Setts.INCREMENTAL.key,
+                          help=Setts.INCREMENTAL.desc,
+                          metavar='FILE',
+                          type=str,
+                          )
+
+    proc_opt.add_argument('--' + Setts.INCREMENTAL_LAG.key,
+                          help=Setts.INCREMENTAL_LAG.desc,
+                          metavar='SECONDS',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.REBUILD.key,
+                          help=Setts.REBUILD.desc,
+                          action='store_const',
+                          const=True,
+                          )
+
+    proc_opt.add_argument('--' + Setts.MONGO_BATCH_SIZE.key,
+                          help=Setts.MONGO_BATCH_SIZE.desc,
+                          metavar='SIZE',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.MONGO_SCAN_WORKERS.key,
+                          help=Setts.MONGO_SCAN_WORKERS.desc,
+                          metavar='NUMBER',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.MONGO_ID_CHUNK_SIZE.key,
+                          help=Setts.MONGO_ID_CHUNK_SIZE.desc,
+                          metavar='SIZE',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.MONGO_AGGREGATE.key,
+                          help=Setts.MONGO_AGGREGATE.desc,
+                          action='store_const',
+                          const=True,
+                          )
+
+    proc_opt.add_argument('--' + Setts.MONGO_EXTRA_FIELDS.key,
+                          help=Setts.MONGO_EXTRA_FIELDS.desc,
+                          metavar='FIELD',
+                          type=str,
+                          nargs='*',
+                          )
+
+    proc_opt.add_argument('--' + Setts.COUCH_BATCH_SIZE.key,
+                          help=Setts.COUCH_BATCH_SIZE.desc,
+                          metavar='SIZE',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.COUCH_WORKERS.key,
+                          help=Setts.COUCH_WORKERS.desc,
+                          metavar='NUMBER',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--no_' + Setts.COUCH_PREFETCH.key,
+                          help='Fetch details from CouchDB only after all '
+                               'logs are processed',
+                          dest=Setts.COUCH_PREFETCH.key,
+                          action='store_const',
+                          const=False,
+                          )
+
+    proc_opt.add_argument('--' + Setts.COUCH_CACHE.key,
+                          help=Setts.COUCH_CACHE.desc,
+                          metavar='FILE',
+                          type=str,
+                          )
+
+    proc_opt.add_argument('--' + Setts.COUCH_CACHE_TTL.key,
+                          help=Setts.COUCH_CACHE_TTL.desc,
+                          metavar='SECONDS',
+                          type=int,
+                          )
+
+    proc_opt.add_argument('--' + Setts.COUCH_CACHE_SIZE.key,
+                          help=Setts.COUCH_CACHE_SIZE.desc,
+                          metavar='SIZE',
+                          type=int,
+                          )
+
     conn_opt = parser.add_argument_group('Connection Options')
 
     conn_opt.add_argument('--' + Setts.COUCH_STRING.key,
@@ -378,6 +620,36 @@ def configure_argparse(rwd, start_cmd=None):
                           metavar='NAME',
                           )
 
+    conn_opt.add_argument('--' + Setts.MONGO_INDEXES.key,
+                          help=Setts.MONGO_INDEXES.desc,
+                          choices=Setts.MONGO_INDEXES.choices,
+                          type=str,
+                          )
+
+    conn_opt.add_argument('--' + Setts.LOGS_EXPORT.key,
+                          type=str,
+                          help=Setts.LOGS_EXPORT.desc,
+                          metavar='FILE',
+                          )
+
+    conn_opt.add_argument('--' + Setts.SEGMENTS.key,
+                          type=str,
+                          help=Setts.SEGMENTS.desc,
+                          metavar='DIR',
+                          )
+
+    conn_opt.add_argument('--' + Setts.EXPORT_SEGMENTS.key,
+                          help=Setts.EXPORT_SEGMENTS.desc,
+                          action='store_const',
+                          const=True,
+                          )
+
+    conn_opt.add_argument('--' + Setts.LOGS_EXPORT_INDEX.key,
+                          type=int,
+                          help=Setts.LOGS_EXPORT_INDEX.desc,
+                          metavar='LINES',
+                          )
+
     conf_opt = parser.add_argument_group('Configuration')
 
     conf_opt.add_argument('-o', '--' + Setts.OUT_DEST.key,
@@ -511,6 +783,13 @@ class Setts:
             type(self)._user_original_args = values
             type(self)._our_user_args = self._map_fields(values)
 
+        @property
+        def events_by_id(self):
+            """ Tell if events are ordered by their id first. """
+            return next(k for k in self.value
+                        if k in (self.OUR_EVENT_ID, self.OUR_START_TIME)
+                        ) == self.OUR_EVENT_ID
+
         @property
         def event_sort_keys(self):
             """ Returns attrgetter to sort events by those attr. """
@@ -555,15 +834,31 @@ class Setts:
         def choices(cls):
             return tuple(cls._ORDER_BY_KEY_MAPPING.keys())
 
+    class _EngineOpt(_Option):
+        # Available engines processing logs
+        OBJECTS = 'objects'
+        COLUMNAR = 'columnar'
+        PARALLEL = 'parallel'
+        SORTED = 'sorted'
+
+        choices = (OBJECTS, COLUMNAR, PARALLEL, SORTED)
+
+    class _MongoIndexesOpt(_Option):
+        # What is done with indexes of the logs collection
+        CHECK = 'check'
+        CREATE = 'create'
+
+        choices = (CHECK, CREATE)
+
     # Strings values, can be stored in user.cfg
 
     EVENT = _Option(
         'event',
-        desc='Events ids to report')
+        desc='Events ids to report, @FILE reads them from the file')
 
     USER = _Option(
         'user',
-        desc='Users ids to report')
+        desc='Users ids to report, @FILE reads them from the file')
 
     DATE_FROM = _Option(
         'date_from',
@@ -579,6 +874,135 @@ class Setts:
         # TODO: Give 3 column names. Maybe all column names?
         desc='Order results by one of the column names: [3 column names]')
 
+    # Processing settings
+    ENGINE = _EngineOpt(
+        'engine',
+        default=_EngineOpt.OBJECTS,
+        desc='How logs are processed: "objects" - model per log, '
+             '"columnar" - NumPy columns, needs numpy, '
+             '"parallel" - logs read and folded by worker processes, '
+             '"sorted" - logs sorted by event in the database, each event '
+             'is output as soon as it\'s complete [Default: objects]')
+
+    WORKERS = _Option(
+        'workers',
+        default=os.cpu_count() or 1,
+        desc='Number of worker processes of the parallel engine '
+             '[Default: number of CPUs]')
+
+    PIPELINE = _Option(
+        'pipeline',
+        default=False,
+        desc='Read, filter and process logs in separate threads connected '
+             'by bounded queues, overlapping with writing the output')
+
+    PIPELINE_QUEUE_SIZE = _Option(
+        'pipeline_queue_size',
+        default=4,
+        desc='Max number of chunks of logs (or events) waiting between two '
+             'pipeline stages [Default: 4]')
+
+    MEMORY_BUDGET = _Option(
+        'memory_budget',
+        desc='Megabytes of events kept in memory while sorting them for '
+             'output, the rest is spilled to temporary files '
+             '[Default: no limit]')
+
+    STREAM = _Option(
+        'stream',
+        default=False,
+        desc='Process logs straight from the database cursor instead of '
+             'loading all of them into memory first')
+
+    SUMMARIZE = _Option(
+        'summarize_participants',
+        default=False,
+        desc='Keep only the first join and the last leave of participants '
+             'instead of all their logs')
+
+    INCREMENTAL = _Option(
+        'incremental',
+        desc='Keep summaries of processed logs in this file and fetch only '
+             'logs inserted since the previous run')
+
+    INCREMENTAL_LAG = _Option(
+        'incremental_lag',
+        default=60,
+        desc='Leave logs made within this many seconds to the next run of '
+             'the incremental mode or --export_segments, as they may still '
+             'come with lower _id than ones already read. Must be longer '
+             'than clock skew of writers of logs [Default: 60]')
+
+    REBUILD = _Option(
+        'rebuild',
+        default=False,
+        desc='Drop state of the incremental mode and process all logs again')
+
+    MONGO_BATCH_SIZE = _Option(
+        'mongo_batch_size',
+        default=1000,
+        desc='Number of logs fetched from MongoDB per round-trip '
+             '[Default: 1000]')
+
+    MONGO_SCAN_WORKERS = _Option(
+        'mongo_scan_workers',
+        default=1,
+        desc='Split reading of logs into timestamp ranges (or chunks of '
+             'ids, see --mongo_id_chunk_size) read by this many threads at '
+             'once. Chunks of ids are aggregated this way with '
+             '--mongo_aggregate too [Default: 1]')
+
+    MONGO_ID_CHUNK_SIZE = _Option(
+        'mongo_id_chunk_size',
+        default=1000,
+        desc='Max number of event or user ids in one MongoDB query, longer '
+             'lists are split into several queries [Default: 1000]')
+
+    MONGO_AGGREGATE = _Option(
+        'mongo_aggregate',
+        default=False,
+        desc='Let MongoDB reduce logs to the first join and the last leave '
+             'of every participant. Participant logs are not available then')
+
+    MONGO_EXTRA_FIELDS = _Option(
+        'mongo_extra_fields',
+        desc='Additional log fields to fetch from MongoDB, besides those '
+             'needed for the report')
+
+    COUCH_BATCH_SIZE = _Option(
+        'couchdb_batch_size',
+        default=500,
+        desc='Number of documents asked from CouchDB in one request '
+             '[Default: 500]')
+
+    COUCH_WORKERS = _Option(
+        'couchdb_workers',
+        default=1,
+        desc='Number of requests for details made to CouchDB at once '
+             '[Default: 1]')
+
+    COUCH_PREFETCH = _Option(
+        'couchdb_prefetch',
+        default=True,
+        desc='Fetch details from CouchDB in the background, while logs '
+             'are still processed [Default: yes]')
+
+    COUCH_CACHE = _Option(
+        'couchdb_cache',
+        desc='File in which events and users details from CouchDB are cached '
+             'between runs [Default: no cache]')
+
+    COUCH_CACHE_TTL = _Option(
+        'couchdb_cache_ttl',
+        default=24 * 60 * 60,
+        desc='Seconds after which cached details are checked for changes in '
+             'CouchDB [Default: 86400]')
+
+    COUCH_CACHE_SIZE = _Option(
+        'couchdb_cache_size',
+        default=100000,
+        desc='Maximum number of cached details [Default: 100000]')
+
     # Connection settings
     COUCH_STRING = _Option(
         'couchdb_connection_string',
@@ -600,6 +1024,36 @@ class Setts:
         default='circleanywhere',
         desc='Database to be used by MongoDB [Default: %(default)s]')
 
+    LOGS_EXPORT = _Option(
+        'logs_export',
+        desc='Read logs from this export (ca-analytics.log, one JSON per '
+             'line, optionally gzipped) instead of MongoDB')
+
+    SEGMENTS = _Option(
+        'segments',
+        desc='Read logs from binary segments in this directory instead of '
+             'MongoDB, needs numpy (see --export_segments)')
+
+    EXPORT_SEGMENTS = _Option(
+        'export_segments',
+        default=False,
+        desc='Append logs inserted since the previous export from MongoDB '
+             '(or --logs_export) to --segments directory and exit')
+
+    MONGO_INDEXES = _MongoIndexesOpt(
+        'mongo_indexes',
+        desc='Manage indexes of MongoDB logs collection and exit: "check" - '
+             'report missing recommended indexes and which index every '
+             'query shape uses, "create" - also create the missing ones '
+             'in the background')
+
+    LOGS_EXPORT_INDEX = _Option(
+        'logs_export_index',
+        default=10000,
+        desc='Lines between entries of the index used to read only the date '
+             'window from uncompressed logs export, 0 disables the index '
+             '[Default: 10000]')
+
     # Script options
     OUT_DEST = _Option(
         'output_destination',
@@ -629,6 +1083,19 @@ class Setts:
         desc='Proxy to CouchDB from which we get detailed info about events '
              'and users.')
 
+    _user_id_table = _Option(
+        'user_id_table',
+        desc='Dense indexes of user ids seen in the logs.')
+
+    @ClassProperty
+    @classmethod
+    def user_id_table(cls):
+        if cls._user_id_table.value is None:
+            log.debug('Creating new UserIdTable')
+            cls._user_id_table.value = UserIdTable()
+
+        return cls._user_id_table.value
+
     @ClassProperty
     @classmethod
     def details_provider(cls):
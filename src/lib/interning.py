@@ -0,0 +1,57 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class UserIdTable:
+    """
+    Interning table of user ids. Each external id (eg. '116777777777777758951')
+      gets a dense index (0, 1, 2, ...) when it is first seen. Internal
+      structures are keyed by that index; the external id is needed only
+      for the output and queries to the databases.
+    """
+    __slots__ = ('_index_of', '_user_ids')
+
+    # Indexes are stored in int32 columns (see `lib.columnar`)
+    MAX_SIZE = 2 ** 31 - 1
+
+    def __init__(self):
+        # Normalized (int) user id -> its index, one key per user
+        self._index_of = {}
+        self._user_ids = []
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def __contains__(self, user_id):
+        return self.find(user_id=user_id) is not None
+
+    def intern(self, user_id):
+        """
+        Return index of given user id, assigning the next one when it is seen
+          for the first time.
+
+        :param user_id: '116777777777777758951' or 116777777777777758951
+        :return: int
+        """
+        user_id = int(user_id)
+        try:
+            return self._index_of[user_id]
+        except KeyError:
+            pass
+
+        index = len(self._user_ids)
+        if index >= self.MAX_SIZE:
+            raise RuntimeError(
+                'Too many distinct user ids [{}].'.format(index))
+        self._user_ids.append(user_id)
+        self._index_of[user_id] = index
+        return index
+
+    def find(self, user_id):
+        """ Return index of given user id or None if it wasn't seen yet. """
+        return self._index_of.get(int(user_id))
+
+    def get_user_id(self, index):
+        """ Return external id of the user, as int. """
+        return self._user_ids[index]
@@ -0,0 +1,119 @@
+import logging
+import multiprocessing
+import pickle
+import queue
+
+from lib.summaries import fold_rows, get_log_rows, get_summaries
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks if workers are still alive
+_POLL = 1.0
+
+
+def get_partitioned_summaries(db_logs, workers, event_ids=None,
+                              user_ids=None, date_from=None, date_to=None,
+                              batch_size=None):
+    """
+    Reduce logs to participant summaries in `workers` processes. Every worker
+      reads its own partition of selected logs (see `partition` of
+      `MongoData.get_data`) and folds it, so reading and parsing of logs
+      is split between processes as well. Only summaries are sent back.
+
+    Workers open their own copy of the source from its
+      `get_copy_arguments`, connections are not passed between processes.
+      A worker which dies without reporting (eg. killed for lack of memory)
+      fails the whole run instead of being waited for.
+
+    :param db_logs: MongoData or LogFileData
+    :param workers: number of worker processes
+    :param batch_size: number of documents fetched per round-trip
+    :return: [ {'eventId': .., 'userId': .., 'join': .., ...}, ...] - same
+             as `MongoData.get_participant_summaries`. A participant may have
+             summaries from several partitions, CaEvent merges them
+    """
+    if workers < 1:
+        raise RuntimeError(
+            'Number of workers must be positive, not [{}].'.format(workers))
+
+    source = (type(db_logs), db_logs.get_copy_arguments())
+    selection = {'event_ids': event_ids, 'user_ids': user_ids,
+                 'date_from': date_from, 'date_to': date_to,
+                 'batch_size': batch_size}
+    result_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=_fold_partition,
+        args=(source, selection, (index, workers), result_queue),
+        daemon=True) for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        summaries = []
+        for partial_summaries in _get_results(processes=processes,
+                                              result_queue=result_queue):
+            summaries.extend(partial_summaries)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    log.debug('[%s] workers reduced logs to [%s] participants',
+              workers, len(summaries))
+    return summaries
+
+
+def _get_results(processes, result_queue):
+    """ Yield summaries of every worker, raise errors of workers. """
+    pending = set(range(len(processes)))
+    # Exited without a result at the previous check. Results are sent before
+    #   a worker exits, so one more check is given to get it
+    exited = set()
+    while pending:
+        try:
+            index, error, partial_summaries = result_queue.get(
+                timeout=_POLL)
+        except queue.Empty:
+            for index in sorted(pending):
+                exitcode = processes[index].exitcode
+                if exitcode is None:
+                    continue
+                if exitcode != 0 or index in exited:
+                    raise RuntimeError(
+                        'Worker of partition [{}] exited with code [{}] '
+                        'without a result.'.format(index, exitcode))
+                exited.add(index)
+            continue
+        if error is not None:
+            raise error
+        pending.discard(index)
+        yield partial_summaries
+
+
+def _fold_partition(source, selection, partition, result_queue):
+    """ Worker: read logs of the partition and fold them into summaries. """
+    source_type, arguments = source
+    index, _ = partition
+    folded = {}
+    try:
+        db_logs = source_type(**arguments)
+        logs = db_logs.get_data(stream=True, partition=partition,
+                                **selection)
+        fold_rows(folded=folded, rows=get_log_rows(selected_logs=logs))
+    except BaseException as e:
+        # Eg. SystemExit when the database can't be reached
+        result_queue.put((index, _get_picklable_error(error=e), None))
+        return
+    result_queue.put((index, None, get_summaries(folded=folded)))
+
+
+def _get_picklable_error(error):
+    """ Error as it can be sent to the parent, which raises it. """
+    if isinstance(error, Exception):
+        try:
+            pickle.dumps(error)
+            return error
+        except Exception:
+            pass
+    return RuntimeError('Worker failed with [{!r}].'.format(error))
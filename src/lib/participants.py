@@ -2,10 +2,9 @@ import inspect
 import logging
 from collections import defaultdict, namedtuple
 
-import dateutil.parser
-
-from lib.database import MongoFields, UserFields
+from lib.database import MongoFields, SummaryFields, UserFields
 from lib.extras import STRFTIME_FORMAT, Setts
+from lib.timestamps import from_epoch_us, parse_timestamp
 
 log = logging.getLogger(__name__)
 
@@ -20,14 +19,40 @@ class EventParticipantsHandler:
     If you want to get all users from particular event, you must change hash
       algorithm of the CaUser class, so that set() won't throw it out.
     """
-    _participant_dict = None
+    __slots__ = ('_participant_dict', '_summarized', '_user_id_table')
 
-    def __init__(self):
-        self._participant_dict = defaultdict(CaParticipant)
+    def __init__(self, summarized=False):
+        """
+        Participants are kept by their index in `Setts.user_id_table`.
+
+        :param summarized: keep only summaries of participants (see
+                           `CaParticipantSummary`), not all their logs
+        """
+        self._summarized = summarized
+        self._user_id_table = Setts.user_id_table
+        if summarized:
+            self._participant_dict = defaultdict(CaParticipantSummary)
+        else:
+            self._participant_dict = defaultdict(CaParticipant)
 
     def add(self, log_entry):
-        participant_id = log_entry['userId']
-        self._participant_dict[participant_id].add(log_entry)
+        user_index = self._user_id_table.intern(
+            user_id=log_entry[MongoFields.USER_ID])
+        self._participant_dict[user_index].add(log_entry,
+                                               user_index=user_index)
+
+    def add_summary(self, summary):
+        user_index = self._user_id_table.intern(
+            user_id=summary[SummaryFields.USER_ID])
+        self._participant_dict[user_index].add_summary(summary,
+                                                       user_index=user_index)
+
+    def __len__(self):
+        return len(self._participant_dict)
+
+    @property
+    def user_indexes(self):
+        return self._participant_dict.keys()
 
     def get_participants(self):
         # TODO: return sorted by id default?
@@ -38,6 +63,9 @@ class EventParticipantsHandler:
 
     def get_participant_log_list(self):
         """ Reconstruct log entries from MongoDB. """
+        if self._summarized:
+            raise RuntimeError('Participant logs are not kept when '
+                               'participants are summarized.')
         all_logs = []
         for ca_participant in self._participant_dict.values():
             all_logs.extend(ca_participant.action_join_list)
@@ -64,6 +92,22 @@ class EventParticipantsHandler:
                                     if ts]
         return sorted(cleaned_leave_timestamps)
 
+    @property
+    def first_timestamp(self):
+        """ Earliest timestamp seen for this event. """
+        timestamps = [participant.first_seen for participant
+                      in self._participant_dict.values()
+                      if participant.first_seen]
+        return min(timestamps)
+
+    @property
+    def last_timestamp(self):
+        """ Latest timestamp seen for this event. """
+        timestamps = [participant.last_seen for participant
+                      in self._participant_dict.values()
+                      if participant.last_seen]
+        return max(timestamps)
+
     @property
     def all_timestamps(self):
         """ All possible timestamps seen for this event. """
@@ -84,10 +128,13 @@ class EventParticipantsHandler:
 
 
 class CaParticipant:
-    _user_id = None
-
-    action_join_list = None
-    action_leave_list = None
+    __slots__ = (
+        '_user_index',
+        'action_join_list', 'action_leave_list',
+        # This reference is just for easy details retrieval
+        # TODO: Move data from CaPartLog model to here?
+        '__user_data_reference',
+    )
 
     _ACTION_JOIN = 'join'
     _ACTION_LEAVE = 'leave'
@@ -99,15 +146,13 @@ class CaParticipant:
         'This should never happen. Statistics may be corrupted.'
     )
 
-    # This reference is just for easy details retrieval
-    # TODO: Move data from CaPartLog model to here?
-    __user_data_reference = None
-
     def __init__(self):
         """
         This is class for Participant. It should sore all constant info
         about user, as well as supported user actions: join/leave.
         """
+        self._user_index = None
+        self.__user_data_reference = None
         # Be careful if you want to change it to dict - hashing of
         #   `CaParticipantLogEntry` may remove entries from dict.
         self.action_join_list = []
@@ -115,18 +160,20 @@ class CaParticipant:
 
     @property
     def user_id(self):
+        return Setts.user_id_table.get_user_id(index=self._user_index)
+
+    @property
+    def user_index(self):
         """ It'e here cos we want to check if log is for correct user. """
-        return self._user_id
+        return self._user_index
 
-    @user_id.setter
-    def user_id(self, value):
-        """ Sets EventId for this class. """
-        value = int(value)
-        if self._user_id is None:
-            self._user_id = value
-        elif self._user_id != value:
-            log.error(self._error_msg_change,
-                      MongoFields.USER_ID, self.user_id, self._user_id, value)
+    @user_index.setter
+    def user_index(self, value):
+        if self._user_index is None:
+            self._user_index = value
+        elif self._user_index != value:
+            log.error(self._error_msg_change, 'user_index', self.user_id,
+                      self._user_index, value)
 
     @property
     def event_id(self):
@@ -158,23 +205,28 @@ class CaParticipant:
 
     @property
     def timestamp_str(self):
-        def get_str(date_timestamp):
-            try:
-                return date_timestamp.strftime(STRFTIME_FORMAT)
-            except Exception as e:
-                log.debug(e)
-                return str(date_timestamp)
-
-        join, leave = self.timestamp
-        join = get_str(date_timestamp=join)
-        leave = get_str(date_timestamp=leave)
-        timestamp = ParticipantTimestamp(join=join, leave=leave)
-        return timestamp
+        return get_timestamp_str(timestamp=self.timestamp)
 
-    def add(self, log_entry):
-        self.user_id = log_entry[MongoFields.USER_ID]
+    @property
+    def first_seen(self):
+        all_logs = self.action_join_list + self.action_leave_list
+        return min(each.timestamp for each in all_logs)
+
+    @property
+    def last_seen(self):
+        all_logs = self.action_join_list + self.action_leave_list
+        return max(each.timestamp for each in all_logs)
+
+    def add(self, log_entry, user_index=None):
+        """
+        :param log_entry:
+        :param user_index: index of log's user in `Setts.user_id_table`,
+                           if already known
+        """
+        ca_participant = CaParticipantLogEntry(log_entry=log_entry,
+                                               user_index=user_index)
+        self.user_index = ca_participant.user_index
 
-        ca_participant = CaParticipantLogEntry(log_entry=log_entry)
         if ca_participant.action == self._ACTION_JOIN:
             self.action_join_list.append(ca_participant)
         elif ca_participant.action == self._ACTION_LEAVE:
@@ -197,21 +249,188 @@ class CaParticipant:
         return self._repr_templ % data_for_templ
 
 
-class CaParticipantLogEntry:
-    # Log entries
-    _user_id = None
-    _event_id = None
-    action = None
-    _timestamp = None
-    _timestamp_str = None
+class CaParticipantSummary:
+    """
+    Participant reduced to the earliest join, the latest leave and counts of
+      his actions. It's built from summaries made by the database (see
+      `SummaryFields`) or by folding his logs one by one. Logs are not kept,
+      so memory doesn't grow with the number of his reconnections.
+    """
+    __slots__ = (
+        '_user_index', '_event_id',
+        # Raw ISO timestamps, compared as strings, or microseconds since
+        #   epoch from the columnar engine
+        '_join', '_leave', '_first_seen', '_last_seen',
+        'join_count', 'leave_count',
+        '_raw_details',
+    )
 
-    # Details
-    _display_name = None
+    _ACTION_JOIN = CaParticipant._ACTION_JOIN
+    _ACTION_LEAVE = CaParticipant._ACTION_LEAVE
 
-    # Storage variables
-    _raw_log_entry = None
-    _raw_details = None
-    _details = None
+    _str_templ = CaParticipant._str_templ
+    _repr_templ = CaParticipant._repr_templ
+    _error_msg_change = CaParticipant._error_msg_change
+
+    def __init__(self):
+        self._user_index = None
+        self._event_id = None
+        self._join = None
+        self._leave = None
+        self._first_seen = None
+        self._last_seen = None
+        self.join_count = 0
+        self.leave_count = 0
+        self._raw_details = None
+
+    @property
+    def user_id(self):
+        return Setts.user_id_table.get_user_id(index=self._user_index)
+
+    @property
+    def user_index(self):
+        return self._user_index
+
+    @user_index.setter
+    def user_index(self, value):
+        if self._user_index is None:
+            self._user_index = value
+            self._raw_details = Setts.details_provider.get_user_details(
+                user_index=value)
+        elif self._user_index != value:
+            log.error(self._error_msg_change, 'user_index', self.user_id,
+                      self._user_index, value)
+
+    @property
+    def event_id(self):
+        return self._event_id
+
+    @event_id.setter
+    def event_id(self, value):
+        value = int(value)
+        if self._event_id is None:
+            self._event_id = value
+        elif self._event_id != value:
+            log.error(self._error_msg_change,
+                      'event_id', self.user_id, self._event_id, value)
+
+    @property
+    def display_name(self):
+        return self._raw_details[UserFields.DISPLAY_NAME]
+
+    @property
+    def timestamp(self):
+        return ParticipantTimestamp(join=self._parse(self._join),
+                                    leave=self._parse(self._leave))
+
+    @property
+    def timestamp_str(self):
+        return get_timestamp_str(timestamp=self.timestamp)
+
+    @property
+    def first_seen(self):
+        return self._parse(self._first_seen)
+
+    @property
+    def last_seen(self):
+        return self._parse(self._last_seen)
+
+    def add(self, log_entry, user_index=None):
+        """ Fold log entry into this summary. """
+        if user_index is None:
+            user_index = Setts.user_id_table.intern(
+                user_id=log_entry[MongoFields.USER_ID])
+        self.user_index = user_index
+        self.event_id = log_entry[MongoFields.EVENT_ID]
+
+        action = log_entry[MongoFields.ACTION]
+        timestamp = log_entry.get(MongoFields.TIMESTAMP)
+        if action == self._ACTION_JOIN:
+            self._join = self._earlier(self._join, timestamp)
+            self.join_count += 1
+        elif action == self._ACTION_LEAVE:
+            self._leave = self._later(self._leave, timestamp)
+            self.leave_count += 1
+        else:
+            raise RuntimeError(
+                'Unrecognized action [{}] for log_entry [{}]'.format(
+                    action, log_entry))
+        self._first_seen = self._earlier(self._first_seen, timestamp)
+        self._last_seen = self._later(self._last_seen, timestamp)
+
+    def add_summary(self, summary, user_index=None):
+        """ Merge another summary of this participant into this one. """
+        if user_index is None:
+            user_index = Setts.user_id_table.intern(
+                user_id=summary[SummaryFields.USER_ID])
+        self.user_index = user_index
+        self.event_id = summary[SummaryFields.EVENT_ID]
+
+        self._join = self._earlier(self._join, summary[SummaryFields.JOIN])
+        self._leave = self._later(self._leave, summary[SummaryFields.LEAVE])
+        self._first_seen = self._earlier(self._first_seen,
+                                         summary[SummaryFields.FIRST_SEEN])
+        self._last_seen = self._later(self._last_seen,
+                                      summary[SummaryFields.LAST_SEEN])
+        self.join_count += summary[SummaryFields.JOIN_COUNT]
+        self.leave_count += summary[SummaryFields.LEAVE_COUNT]
+
+    @staticmethod
+    def _earlier(current, new):
+        if current is None or (new is not None and new < current):
+            return new
+        return current
+
+    @staticmethod
+    def _later(current, new):
+        if current is None or (new is not None and new > current):
+            return new
+        return current
+
+    def _parse(self, raw_value):
+        if raw_value is None:
+            log.debug('No timestamp for user [%s] in event [%s].',
+                      self.user_id, self.event_id)
+            return None
+        if isinstance(raw_value, int):
+            return from_epoch_us(raw_value)
+        return parse_timestamp(raw_value)
+
+    def __str__(self):
+        data_for_templ = (self.user_id, self.display_name, *self.timestamp_str)
+        return self._str_templ % data_for_templ
+
+    def __repr__(self):
+        data_for_templ = (self.user_id, self.event_id,
+                          self.join_count, self.leave_count)
+        return self._repr_templ % data_for_templ
+
+
+def get_timestamp_str(timestamp):
+    """ Convert ParticipantTimestamp of dates to the one of strings. """
+    def get_str(date_timestamp):
+        try:
+            return date_timestamp.strftime(STRFTIME_FORMAT)
+        except Exception as e:
+            log.debug(e)
+            return str(date_timestamp)
+
+    join = get_str(date_timestamp=timestamp.join)
+    leave = get_str(date_timestamp=timestamp.leave)
+    return ParticipantTimestamp(join=join, leave=leave)
+
+
+class CaParticipantLogEntry:
+    # There is one instance per log, so keep it small. Raw log entry is not
+    #   referenced, only values parsed from it.
+    __slots__ = (
+        # Log entries
+        '_user_index', '_event_id', 'action', '_timestamp', '_timestamp_str',
+        # Details
+        '_display_name',
+        # Storage variables
+        '_raw_details',
+    )
 
     # TODO: Proper error handling
     _error_msg_change = (
@@ -221,7 +440,7 @@ class CaParticipantLogEntry:
     # TODO: remove
     _str_representation_templ = 'User: [%s] - [%s], Joined: [%s]'
 
-    def __init__(self, log_entry):
+    def __init__(self, log_entry, user_index=None):
         """
         {'_id': ObjectId('57a3a39a00c88030ca45cddb'),
           'action': 'join',
@@ -232,29 +451,32 @@ class CaParticipantLogEntry:
           'timestamp': '2016-07-02T20:35:40.896Z',
           'userId': '108333970581946079744'}
         :param log_entry:
+        :param user_index: index of log's user in `Setts.user_id_table`,
+                           if already known
         """
-        self.user_id = log_entry[MongoFields.USER_ID]
+        self._event_id = None
+        self._timestamp = None
+        self._display_name = None
+
+        if user_index is None:
+            user_index = Setts.user_id_table.intern(
+                user_id=log_entry[MongoFields.USER_ID])
+        self._user_index = user_index
         self.event_id = log_entry[MongoFields.EVENT_ID]
         self.action = log_entry[MongoFields.ACTION]
+        # Raw value is dropped when parsed
+        self._timestamp_str = log_entry.get(MongoFields.TIMESTAMP)
 
-        self._raw_log_entry = log_entry
-        self._raw_details = Setts.details_provider[self.user_id]
+        self._raw_details = Setts.details_provider.get_user_details(
+            user_index=user_index)
 
     @property
     def user_id(self):
-        return self._user_id
+        return Setts.user_id_table.get_user_id(index=self._user_index)
 
-    @user_id.setter
-    def user_id(self, value):
-        """ Sets EventId for this class. """
-        # TODO: Here validation is probably not needed as one instance of
-        #       the class corresponds to one log_entry
-        value = int(value)
-        if self._user_id is None:
-            self._user_id = value
-        elif self._user_id != value:
-            log.error(self._error_msg_change,
-                      MongoFields.USER_ID, self.user_id, self._user_id, value)
+    @property
+    def user_index(self):
+        return self._user_index
 
     @property
     def event_id(self):
@@ -276,9 +498,10 @@ class CaParticipantLogEntry:
         if self._timestamp is not None:
             return self._timestamp
 
-        raw_value = self._raw_log_entry[MongoFields.TIMESTAMP]
+        raw_value = self._timestamp_str
         try:
-            self._timestamp = dateutil.parser.parse(raw_value)
+            self._timestamp = parse_timestamp(raw_value)
+            self._timestamp_str = None
         except AttributeError as e:
             log.warning(
                 'Error converting [%s] to date object for participant [%s]. '
@@ -301,13 +524,13 @@ class CaParticipantLogEntry:
         return self._display_name
 
     def __hash__(self):
-        return hash(self.user_id)
+        return hash(self.user_index)
         ## Show all users
         # return (hash(self.user_id) ^
         #         hash(self._timestamp_str))
 
     def __eq__(self, other):
-        return other.user_id == self.user_id
+        return other.user_index == self.user_index
         ## Show all users
         # if other.user_id != self.user_id:
         #     return other.user_id < self.user_id
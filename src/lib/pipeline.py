@@ -0,0 +1,192 @@
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Markers passed through queues after the last item of a stage
+_END = object()
+
+
+class _Failure:
+    """ Error raised in a stage, re-raised by the following ones. """
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats:
+    """ What a stage did and how long it waited for its neighbours. """
+    __slots__ = ('name', 'items', 'seconds', 'input_wait', 'output_wait',
+                 'max_queue_depth')
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+        # Waiting for the previous stage
+        self.input_wait = 0.0
+        # Waiting for the next stage, when the queue was full (backpressure)
+        self.output_wait = 0.0
+        # Of the queue to the next stage
+        self.max_queue_depth = 0
+
+    @property
+    def busy(self):
+        return max(self.seconds - self.input_wait - self.output_wait, 0.0)
+
+    @property
+    def throughput(self):
+        """ Items per second of own work. """
+        return self.items / self.busy if self.busy else None
+
+
+class Pipeline:
+    """
+    Stages running in their own threads, connected by bounded queues. A stage
+      is a function taking an iterable of items and yielding items for the
+      next stage. The first stage gets the source, output of the last one is
+      yielded by `run` in the calling thread.
+
+    Queues hold at most `queue_size` items, so a slow stage holds back the
+      ones before it instead of items piling up in memory.
+    """
+    # Seconds between checks if the pipeline was stopped
+    _POLL = 0.1
+
+    def __init__(self, queue_size):
+        """
+        :param queue_size: max number of items waiting between two stages
+        """
+        if queue_size < 1:
+            raise RuntimeError('Pipeline queue size must be at least 1, got '
+                               '[{}].'.format(queue_size))
+        self.queue_size = queue_size
+        # StageStats of stages and of the consumer of `run`, after the run
+        self.stats = []
+        self._stages = []
+        self._stop = threading.Event()
+
+    def add_stage(self, name, function):
+        """
+        :param name: shown in stats
+        :param function: f(items) -> iterable of items for the next stage
+        :return: self
+        """
+        self._stages.append((name, function))
+        return self
+
+    def run(self, source, consumer_name='output'):
+        """
+        Start stages and yield output of the last one. Stats of the run are
+          logged when it's over.
+
+        :param source: items for the first stage, iterated in its thread
+        :param consumer_name: name of the calling thread in stats
+        """
+        self._stop.clear()
+        self.stats = [StageStats(name=name) for name, _ in self._stages]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self._stages]
+        threads = []
+        for i, (name, function) in enumerate(self._stages):
+            items = source if i == 0 else self._iter_queue(
+                input_queue=queues[i - 1], stats=self.stats[i])
+            threads.append(threading.Thread(
+                target=self._run_stage, name='pipeline-%s' % name,
+                kwargs={'function': function, 'items': items,
+                        'output_queue': queues[i], 'stats': self.stats[i]},
+                daemon=True))
+
+        consumer_stats = StageStats(name=consumer_name)
+        self.stats.append(consumer_stats)
+        start = time.perf_counter()
+        try:
+            for thread in threads:
+                thread.start()
+            for item in self._iter_queue(input_queue=queues[-1],
+                                         stats=consumer_stats):
+                yield item
+                consumer_stats.items += 1
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            consumer_stats.seconds = time.perf_counter() - start
+            self.log_stats()
+
+    def log_stats(self):
+        for stats in self.stats:
+            throughput = stats.throughput
+            log.info('Stage [%s]: [%s] items in [%.2f]s, busy [%.2f]s '
+                     '([%s] items/s), waited [%.2f]s for input and [%.2f]s '
+                     'for output, max queue [%s] of [%s]',
+                     stats.name, stats.items, stats.seconds, stats.busy,
+                     '%.1f' % throughput if throughput is not None else '-',
+                     stats.input_wait, stats.output_wait,
+                     stats.max_queue_depth, self.queue_size)
+
+    def _run_stage(self, function, items, output_queue, stats):
+        start = time.perf_counter()
+        output = None
+        try:
+            output = function(items)
+            for item in output:
+                if not self._put(output_queue=output_queue, item=item,
+                                 stats=stats):
+                    # Nobody is waiting for the rest
+                    break
+                stats.items += 1
+            else:
+                self._put(output_queue=output_queue, item=_END, stats=stats)
+        except BaseException as e:
+            self._put(output_queue=output_queue, item=_Failure(error=e),
+                      stats=stats)
+        finally:
+            # Generators and cursors release what they hold, e.g. the source
+            #   stops reading logs when the consumer is gone
+            for iterable in (output, items):
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+            stats.seconds = time.perf_counter() - start
+
+    def _put(self, output_queue, item, stats):
+        """
+        Put unless the pipeline was stopped, waiting if it's full.
+
+        :return: False if the pipeline was stopped and item was not put
+        """
+        start = time.perf_counter()
+        put = False
+        while not self._stop.is_set():
+            try:
+                output_queue.put(item, timeout=self._POLL)
+                put = True
+                break
+            except queue.Full:
+                continue
+        stats.output_wait += time.perf_counter() - start
+        stats.max_queue_depth = max(stats.max_queue_depth,
+                                    output_queue.qsize())
+        return put
+
+    def _iter_queue(self, input_queue, stats):
+        """ Yield items of the previous stage, until it's done. """
+        while True:
+            start = time.perf_counter()
+            # Stopped pipeline ends like a finished one
+            item = _END
+            while not self._stop.is_set():
+                try:
+                    item = input_queue.get(timeout=self._POLL)
+                    break
+                except queue.Empty:
+                    continue
+            stats.input_wait += time.perf_counter() - start
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
@@ -0,0 +1,325 @@
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+
+from lib.columnar import ACTION_JOIN, ACTION_LEAVE, check_numpy, \
+    parse_timestamp_column
+from lib.database import MongoData, MongoFields
+from lib.extras import get_chunks, norm_path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# Fixed width records, 37 bytes each. Timestamp is in microseconds since
+#   epoch, see `lib.timestamps.to_epoch_us`
+RECORD_DTYPE = [('event_id', '<i4'),
+                ('user_id', 'S24'),
+                ('action', 'i1'),
+                ('timestamp', '<i8')]
+_ACTION_CODES = {'join': ACTION_JOIN, 'leave': ACTION_LEAVE}
+_US_PER_DAY = 86400 * 1000000
+
+
+class BloomFilter:
+    """
+    Set of byte strings which may give false positives, but never false
+      negatives. Bits are kept in a NumPy array, so filters can be stored
+      as raw bytes.
+    """
+    BITS = 2 ** 16
+    HASHES = 4
+
+    def __init__(self, bits=None):
+        """
+        :param bits: uint8 array of `BITS // 8` items, empty filter if None
+        """
+        if bits is None:
+            bits = np.zeros(self.BITS // 8, dtype=np.uint8)
+        self.bits = bits
+
+    def add(self, keys):
+        """ :param keys: [b'111', ...] """
+        positions = self._get_positions(keys=keys).ravel()
+        np.bitwise_or.at(self.bits, positions >> 3,
+                         np.left_shift(1, positions & 7).astype(np.uint8))
+
+    def may_contain_any(self, keys):
+        """ :param keys: [b'111', ...] """
+        positions = self._get_positions(keys=keys)
+        found = (self.bits[positions >> 3] >> (positions & 7)) & 1
+        return bool(found.all(axis=1).any())
+
+    @classmethod
+    def _get_positions(cls, keys):
+        """ Bits of keys, by double hashing of their MD5, (keys, HASHES). """
+        digests = b''.join(hashlib.md5(key).digest() for key in keys)
+        hashes = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+        steps = np.arange(cls.HASHES, dtype=np.uint64)
+        positions = (hashes[:, :1] + steps * hashes[:, 1:]) % \
+            np.uint64(cls.BITS)
+        return positions.astype(np.int64)
+
+
+class LogSegments:
+    """
+    Logs stored as fixed width binary records (see `RECORD_DTYPE`), in one
+      append-only segment file per day (UTC) of their timestamp. Segments are
+      memory-mapped as NumPy structured arrays, so no decoding is needed.
+
+    `manifest.json` in the directory keeps number of committed records of
+      every segment and `_id` of the last exported log. Records appended
+      after the last commit (eg. interrupted export) are ignored and
+      overwritten by the next export.
+
+    Every segment has metadata for skipping it without reading: ranges of
+      timestamps and event ids in the manifest and Bloom filters of event
+      and user ids in a `.bloom` file next to it. Filters are saved before
+      the manifest, so they can only have more ids than committed records.
+    """
+    _VERSION = 2
+    _MANIFEST = 'manifest.json'
+    _SUFFIX = '.seg'
+    _BLOOM_SUFFIX = '.bloom'
+
+    def __init__(self, directory):
+        """
+        :param directory: directory with segments, created when exporting
+        """
+        check_numpy()
+        self.directory = norm_path(directory, mkdir=False, mkfile=False,
+                                   logger=log)
+        self.dtype = np.dtype(RECORD_DTYPE)
+        # Segments read and skipped by the last `read`, by reason
+        self.stats = Counter()
+        self._manifest = self._load_manifest()
+
+    @property
+    def high_water(self):
+        """ `_id` of the last exported log, as str, or None. """
+        return self._manifest['high_water']
+
+    def export(self, db_logs, batch_size, before_id=None):
+        """
+        Append logs inserted since the previous export.
+
+        :param db_logs: MongoData (or other source with its `get_data`)
+        :param batch_size: logs converted and committed at once
+        :param before_id: export only logs with lower `_id`, the rest is left
+                          to the next export (see `MongoData.get_settled_id`)
+        :return: number of exported logs
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        logs = db_logs.get_data(stream=True, batch_size=batch_size,
+                                extra_fields=[MongoFields.ID],
+                                after_id=self.high_water,
+                                before_id=before_id)
+        exported = 0
+        for chunk in get_chunks(logs, size=batch_size):
+            records = self._to_records(logs=chunk)
+            days = records['timestamp'] // _US_PER_DAY
+            for day in np.unique(days):
+                self._append(day=self._get_day_name(day=day),
+                             records=records[days == day])
+            self._manifest['high_water'] = str(
+                max(log_entry[MongoFields.ID] for log_entry in chunk))
+            self._save_manifest()
+            exported += len(records)
+        log.info('Exported [%s] logs to segments [%s]', exported,
+                 self.directory)
+        return exported
+
+    def read(self, event_ids=None, user_ids=None, date_from=None,
+             date_to=None):
+        """
+        Yield records of segments in the date window, in day order. Records
+          of whole segments are memory-mapped, not copied. Segments which
+          can't have selected logs according to their metadata aren't read.
+
+        :param event_ids: [eventId, ...]
+        :param user_ids: [userId, ...]
+        :param date_from: '2016-07-02', included
+        :param date_to: '2016-07-03', excluded
+        :return: structured arrays with `RECORD_DTYPE`
+        """
+        date_question = MongoData.get_date_question(date_from=date_from,
+                                                    date_to=date_to) or {}
+        time_from, time_to = (
+            int(parse_timestamp_column([date_question[key]])[0])
+            if key in date_question else None
+            for key in ('$gte', '$lt'))
+        if event_ids is not None:
+            event_ids = np.array([int(e) for e in event_ids], dtype='<i4')
+        if user_ids is not None:
+            user_ids = np.array([str(u).encode() for u in user_ids],
+                                dtype='S24')
+
+        self.stats = Counter()
+        for day, segment in sorted(self._manifest['segments'].items()):
+            self.stats['segments'] += 1
+            if not segment['count']:
+                continue
+            min_time, max_time = segment['timestamp']
+            if (time_from is not None and max_time < time_from) or \
+                    (time_to is not None and min_time >= time_to):
+                self.stats['pruned_by_date'] += 1
+                continue
+            min_event, max_event = segment['event_id']
+            if event_ids is not None and not (
+                    (event_ids >= min_event) & (event_ids <= max_event)).any():
+                self.stats['pruned_by_event_range'] += 1
+                continue
+            if event_ids is not None or user_ids is not None:
+                event_bloom, user_bloom = self._load_blooms(day=day)
+                if (event_ids is not None and not event_bloom.may_contain_any(
+                        keys=self._get_event_keys(event_ids=event_ids))) or \
+                        (user_ids is not None and
+                         not user_bloom.may_contain_any(keys=user_ids)):
+                    self.stats['pruned_by_bloom'] += 1
+                    continue
+
+            self.stats['read'] += 1
+            records = np.memmap(self._get_path(day=day), dtype=self.dtype,
+                                mode='r', shape=(segment['count'],))
+            if event_ids is not None:
+                records = records[np.isin(records['event_id'], event_ids)]
+            if user_ids is not None:
+                records = records[np.isin(records['user_id'], user_ids)]
+            yield records
+        log.info('Read [%s] of [%s] segments, skipped [%s] by dates, '
+                 '[%s] by event id ranges, [%s] by Bloom filters',
+                 self.stats['read'], self.stats['segments'],
+                 self.stats['pruned_by_date'],
+                 self.stats['pruned_by_event_range'],
+                 self.stats['pruned_by_bloom'])
+
+    def _to_records(self, logs):
+        event_ids, user_ids, actions, timestamps = [], [], [], []
+        for log_entry in logs:
+            timestamp = log_entry.get(MongoFields.TIMESTAMP)
+            if timestamp is None:
+                log.warning('Skipping log entry without timestamp [%s]',
+                            log_entry)
+                continue
+            try:
+                action = _ACTION_CODES[log_entry[MongoFields.ACTION]]
+            except KeyError:
+                raise RuntimeError(
+                    'Unrecognized action [{}] for log_entry [{}]'.format(
+                        log_entry[MongoFields.ACTION], log_entry)) from None
+            user_id = str(log_entry[MongoFields.USER_ID]).encode()
+            if len(user_id) > self.dtype['user_id'].itemsize:
+                raise RuntimeError(
+                    'User id [{}] is too long for segments.'.format(
+                        log_entry[MongoFields.USER_ID]))
+
+            event_ids.append(log_entry[MongoFields.EVENT_ID])
+            user_ids.append(user_id)
+            actions.append(action)
+            timestamps.append(timestamp)
+
+        records = np.empty(len(event_ids), dtype=self.dtype)
+        records['event_id'] = event_ids
+        records['user_id'] = user_ids
+        records['action'] = actions
+        records['timestamp'] = parse_timestamp_column(timestamps)
+        return records
+
+    def _append(self, day, records):
+        segment = self._manifest['segments'].setdefault(
+            day, {'count': 0, 'timestamp': None, 'event_id': None})
+        with open(self._get_path(day=day), 'ab') as f:
+            # Drop records not committed in the manifest
+            f.truncate(segment['count'] * self.dtype.itemsize)
+            f.write(records.tobytes())
+        segment['count'] += len(records)
+        self._add_metadata(day=day, segment=segment, records=records)
+
+    def _add_metadata(self, day, segment, records):
+        """ Extend metadata of the segment with appended records. """
+        for field in ('timestamp', 'event_id'):
+            low, high = int(records[field].min()), int(records[field].max())
+            if segment[field] is not None:
+                low = min(low, segment[field][0])
+                high = max(high, segment[field][1])
+            segment[field] = [low, high]
+
+        event_bloom, user_bloom = self._load_blooms(day=day)
+        event_bloom.add(keys=self._get_event_keys(
+            event_ids=np.unique(records['event_id'])))
+        user_bloom.add(keys=np.unique(records['user_id']))
+        self._save_blooms(day=day, blooms=(event_bloom, user_bloom))
+
+    @staticmethod
+    def _get_event_keys(event_ids):
+        return [str(int(event_id)).encode() for event_id in event_ids]
+
+    def _load_blooms(self, day):
+        """ Return Bloom filters of event and user ids of the segment. """
+        size = BloomFilter.BITS // 8
+        path = self._get_path(day=day, suffix=self._BLOOM_SUFFIX)
+        try:
+            bits = np.fromfile(path, dtype=np.uint8)
+        except FileNotFoundError:
+            bits = np.zeros(2 * size, dtype=np.uint8)
+        return BloomFilter(bits=bits[:size]), BloomFilter(bits=bits[size:])
+
+    def _save_blooms(self, day, blooms):
+        path = self._get_path(day=day, suffix=self._BLOOM_SUFFIX)
+        with open(path + '.tmp', 'wb') as f:
+            for bloom in blooms:
+                f.write(bloom.bits.tobytes())
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _get_day_name(day):
+        """ Days since epoch -> '2016-07-02'. """
+        return str(np.datetime64(int(day), 'D'))
+
+    def _get_path(self, day, suffix=_SUFFIX):
+        return os.path.join(self.directory, day + suffix)
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.directory, self._MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {'version': self._VERSION, 'dtype': str(self.dtype),
+                    'high_water': None, 'segments': {}}
+        if manifest.get('version') == 1 and \
+                manifest.get('dtype') == str(self.dtype):
+            return self._upgrade_manifest(manifest=manifest)
+        if (manifest.get('version') != self._VERSION or
+                manifest.get('dtype') != str(self.dtype)):
+            raise RuntimeError(
+                'Segments in "{}" are in unsupported format.'.format(
+                    self.directory))
+        return manifest
+
+    def _upgrade_manifest(self, manifest):
+        """ Add metadata to segments exported without it. """
+        log.info('Adding metadata to segments [%s]', self.directory)
+        counts = manifest['segments']
+        self._manifest = dict(manifest, version=self._VERSION, segments={})
+        for day, count in counts.items():
+            if not count:
+                continue
+            records = np.memmap(self._get_path(day=day), dtype=self.dtype,
+                                mode='r', shape=(count,))
+            segment = {'count': count, 'timestamp': None, 'event_id': None}
+            self._add_metadata(day=day, segment=segment, records=records)
+            self._manifest['segments'][day] = segment
+        self._save_manifest()
+        return self._manifest
+
+    def _save_manifest(self):
+        """ Commit appended records, atomically. """
+        path = os.path.join(self.directory, self._MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._manifest, f, sort_keys=True)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,92 @@
+import heapq
+import logging
+import pickle
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+class ExternalSorter:
+    """
+    Sort items which may not fit in memory. Items are collected until their
+      estimated size exceeds the memory budget, then sorted and spilled to
+      a temporary file as a run. Runs are merged back lazily, so only one
+      item per run is held in memory while the output is consumed.
+
+    Size of items is estimated by their pickled size, measured on every
+      `_SAMPLE_EVERY`-th item.
+    """
+    _SAMPLE_EVERY = 64
+
+    def __init__(self, key, memory_budget=None):
+        """
+        :param key: same as for `sorted`
+        :param memory_budget: bytes of items kept in memory, no limit if None
+        """
+        self.key = key
+        self.memory_budget = memory_budget
+        # What was spilled by the last `sort`
+        self.spilled_items = 0
+        self.spilled_bytes = 0
+        self.runs = 0
+
+    def sort(self, items):
+        """
+        :param items: iterable of picklable items
+        :return: list, when nothing was spilled, else iterator
+        """
+        self.spilled_items = self.spilled_bytes = self.runs = 0
+        if self.memory_budget is None:
+            return sorted(items, key=self.key)
+
+        runs = []
+        buffer, item_size = [], None
+        for item in items:
+            if len(buffer) % self._SAMPLE_EVERY == 0:
+                size = len(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+                item_size = size if item_size is None else (
+                    (item_size + size) / 2)
+            buffer.append(item)
+            if len(buffer) * item_size > self.memory_budget:
+                runs.append(self._spill(items=buffer))
+                buffer = []
+
+        buffer.sort(key=self.key)
+        if not runs:
+            return buffer
+        log.info('Spilled [%s] items in [%s] runs, [%s] bytes to disk',
+                 self.spilled_items, self.runs, self.spilled_bytes)
+        return self._merge(runs=runs, last_run=buffer)
+
+    def _spill(self, items):
+        """ Write sorted items to a temporary file, return the file. """
+        items.sort(key=self.key)
+        run = tempfile.TemporaryFile(prefix='ca-analytics-run-')
+        pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+        for item in items:
+            pickler.dump(item)
+            # Items are independent, no need to remember them
+            pickler.clear_memo()
+        self.spilled_items += len(items)
+        self.spilled_bytes += run.tell()
+        self.runs += 1
+        log.debug('Spilled run of [%s] items', len(items))
+        run.seek(0)
+        return run
+
+    def _merge(self, runs, last_run):
+        try:
+            yield from heapq.merge(*[self._read_run(run=run) for run in runs],
+                                   last_run, key=self.key)
+        finally:
+            for run in runs:
+                run.close()
+
+    @staticmethod
+    def _read_run(run):
+        unpickler = pickle.Unpickler(run)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
@@ -0,0 +1,74 @@
+import logging
+
+from lib.database.fields import MongoFields, SummaryFields
+
+log = logging.getLogger(__name__)
+
+_ACTION_JOIN = 'join'
+_ACTION_LEAVE = 'leave'
+
+# Positions in folded state of a participant
+_JOIN, _LEAVE, _JOIN_COUNT, _LEAVE_COUNT, _FIRST_SEEN, _LAST_SEEN = range(6)
+
+
+def get_log_rows(selected_logs):
+    """ Yield (eventId, userId, action, timestamp) of log entries. """
+    for log_entry in selected_logs:
+        yield (log_entry[MongoFields.EVENT_ID],
+               log_entry[MongoFields.USER_ID],
+               log_entry[MongoFields.ACTION],
+               log_entry.get(MongoFields.TIMESTAMP))
+
+
+def fold_rows(folded, rows):
+    """
+    Fold log rows into participant states, like `CaParticipantSummary` does,
+      but without models. Timestamps are compared as raw ISO strings.
+
+    :param folded: {(eventId, userId): [join, leave, joinCount, leaveCount,
+                                        firstSeen, lastSeen]}, updated
+    :param rows: [(eventId, userId, action, timestamp), ...]
+    """
+    for event_id, user_id, action, timestamp in rows:
+        key = (event_id, user_id)
+        try:
+            state = folded[key]
+        except KeyError:
+            state = [None, None, 0, 0, None, None]
+            folded[key] = state
+
+        if action == _ACTION_JOIN:
+            if state[_JOIN] is None or (timestamp is not None and
+                                        timestamp < state[_JOIN]):
+                state[_JOIN] = timestamp
+            state[_JOIN_COUNT] += 1
+        elif action == _ACTION_LEAVE:
+            if state[_LEAVE] is None or (timestamp is not None and
+                                         timestamp > state[_LEAVE]):
+                state[_LEAVE] = timestamp
+            state[_LEAVE_COUNT] += 1
+        else:
+            raise RuntimeError(
+                'Unrecognized action [{}] for log_entry [{}]'.format(
+                    action, (event_id, user_id, action, timestamp)))
+
+        if state[_FIRST_SEEN] is None or (timestamp is not None and
+                                          timestamp < state[_FIRST_SEEN]):
+            state[_FIRST_SEEN] = timestamp
+        if state[_LAST_SEEN] is None or (timestamp is not None and
+                                         timestamp > state[_LAST_SEEN]):
+            state[_LAST_SEEN] = timestamp
+
+
+def get_summaries(folded):
+    """ Return folded participants as `SummaryFields` dicts. """
+    return [{SummaryFields.EVENT_ID: event_id,
+             SummaryFields.USER_ID: user_id,
+             SummaryFields.JOIN: state[_JOIN],
+             SummaryFields.LEAVE: state[_LEAVE],
+             SummaryFields.JOIN_COUNT: state[_JOIN_COUNT],
+             SummaryFields.LEAVE_COUNT: state[_LEAVE_COUNT],
+             SummaryFields.FIRST_SEEN: state[_FIRST_SEEN],
+             SummaryFields.LAST_SEEN: state[_LAST_SEEN]}
+            for (event_id, user_id), state in folded.items()]
+
@@ -0,0 +1,100 @@
+import collections
+import logging
+from datetime import datetime, timedelta
+
+import dateutil.parser
+import dateutil.tz
+
+log = logging.getLogger(__name__)
+
+# One shared instance, dateutil creates new one for every parsed value
+UTC = dateutil.tz.tzutc()
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+_MICROSECOND = timedelta(microseconds=1)
+# Format of timestamps in logs
+LOG_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.{ms:03d}Z'
+
+# How many values were parsed by the fast path and how many needed dateutil
+parser_stats = collections.Counter()
+FAST = 'fast'
+FALLBACK = 'fallback'
+
+
+def parse_timestamp(value):
+    """
+    Parse timestamps stored by Circle Anywhere:
+      * logs in MongoDB: '2016-05-26T16:37:46.106Z'
+      * events in CouchDB: '2016-05-12T19:00:00+00:00'
+    Any other value is passed to `dateutil.parser.parse`, so it behaves
+      (and raises) the same way for them.
+
+    :param value: '2016-05-26T16:37:46.106Z'
+    :return: timezone aware datetime
+    """
+    try:
+        ret = _parse_fixed_format(value)
+    except (TypeError, ValueError):
+        ret = None
+
+    if ret is None:
+        parser_stats[FALLBACK] += 1
+        return dateutil.parser.parse(value)
+    parser_stats[FAST] += 1
+    return ret
+
+
+def _parse_fixed_format(value):
+    """ Return None when value isn't in one of the known formats. """
+    length = len(value)
+    if (length not in (24, 25) or value[4] != '-' or value[7] != '-' or
+            value[10] != 'T' or value[13] != ':' or value[16] != ':'):
+        return None
+
+    if length == 24:
+        # 2016-05-26T16:37:46.106Z
+        if value[19] != '.' or value[23] != 'Z':
+            return None
+        microsecond = int(value[20:23]) * 1000
+        tz = UTC
+    else:
+        # 2016-05-12T19:00:00+00:00
+        if value[19] not in '+-' or value[22] != ':':
+            return None
+        microsecond = 0
+        offset = int(value[20:22]) * 3600 + int(value[23:25]) * 60
+        if value[19] == '-':
+            offset = -offset
+        tz = UTC if offset == 0 else dateutil.tz.tzoffset(None, offset)
+
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    microsecond, tz)
+
+
+def to_epoch_us(timestamp):
+    """ Datetime -> microseconds since epoch. Naive one is taken as UTC. """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=UTC)
+    return (timestamp - EPOCH) // _MICROSECOND
+
+
+def from_epoch_us(microseconds):
+    """ Microseconds since epoch -> aware datetime in UTC. """
+    return EPOCH + timedelta(microseconds=int(microseconds))
+
+
+def format_log_timestamp(timestamp):
+    """ Aware datetime -> '2016-05-26T16:37:46.106Z', as stored in logs. """
+    timestamp = timestamp.astimezone(UTC)
+    ms = timestamp.microsecond // 1000
+    return timestamp.strftime(LOG_TIMESTAMP_FORMAT.format(ms=ms))
+
+
+def log_parser_stats():
+    """ Let know if there are timestamps in unexpected formats. """
+    log.debug('Parsed timestamps: %s', dict(parser_stats))
+    if parser_stats[FALLBACK]:
+        log.info('[%s] of [%s] timestamps were in unexpected format and '
+                 'needed slow parsing', parser_stats[FALLBACK],
+                 parser_stats[FALLBACK] + parser_stats[FAST])
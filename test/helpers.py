@@ -83,7 +83,12 @@ class ResponseFactory:
         return ret
 
     @classmethod
-    def mongo_get_data_side_effect(cls, event_ids=None, user_ids=None):
+    def mongo_get_data_side_effect(cls, event_ids=None, user_ids=None,
+                                   date_from=None, date_to=None,
+                                   stream=False, batch_size=None,
+                                   extra_fields=None, scan_workers=None,
+                                   after_id=None, sort_by_event=False,
+                                   partition=None):
         # print('called mongo_side_effect with:', {'event_ids': event_ids,
         #                                          'user_ids': user_ids})
 
@@ -110,8 +115,51 @@ class ResponseFactory:
 
         all_logs = cls.get_all_mongo_logs()
         ret = handler(logs=all_logs, u_ids=user_ids, e_ids=event_ids)
+        # Database resolves date window on its side
+        ret = MongoData.filter_date(data=ret, date_from=date_from,
+                                    date_to=date_to)
+        if partition is not None:
+            index, partitions = partition
+            ret = [entry for entry in ret
+                   if entry['eventId'] % partitions == index]
+        if sort_by_event:
+            ret.sort(key=MongoData.get_event_order_key)
+        if stream:
+            # Behave like a cursor, which can be consumed only once
+            return iter(ret)
         return ret
 
+    @classmethod
+    def mongo_get_participant_summaries_side_effect(
+            cls, event_ids=None, user_ids=None, date_from=None, date_to=None,
+            batch_size=None, scan_workers=None):
+        logs = cls.mongo_get_data_side_effect(
+            event_ids=event_ids, user_ids=user_ids, date_from=date_from,
+            date_to=date_to)
+
+        # Same as $group made by the database
+        summaries = {}
+        for entry in logs:
+            key = (entry['eventId'], entry['userId'])
+            summary = summaries.setdefault(key, {
+                'eventId': entry['eventId'], 'userId': entry['userId'],
+                'join': None, 'leave': None, 'joinCount': 0, 'leaveCount': 0,
+                'firstSeen': None, 'lastSeen': None})
+            timestamp = entry['timestamp']
+            if entry['action'] == 'join':
+                summary['joinCount'] += 1
+                summary['join'] = min(filter(None, (summary['join'],
+                                                    timestamp)))
+            else:
+                summary['leaveCount'] += 1
+                summary['leave'] = max(filter(None, (summary['leave'],
+                                                     timestamp)))
+            summary['firstSeen'] = min(filter(None, (summary['firstSeen'],
+                                                     timestamp)))
+            summary['lastSeen'] = max(filter(None, (summary['lastSeen'],
+                                                    timestamp)))
+        return list(summaries.values())
+
     @classmethod
     def couch_get_data_side_effect(cls, event_ids=NOT_CALLED,
                                    user_ids=NOT_CALLED):
@@ -141,12 +189,16 @@ class DbPatcherMixin:
     # Suppress IDE warnings
     patcher_coach_get_data = patcher_coach_init = \
         patcher_mongo_get_data = patcher_mongo_init = \
+        patcher_mongo_get_participant_summaries = \
         mock_coach_get_data = mock_coach_init = \
-        mock_mongo_get_data = mock_mongo_init = None
+        mock_mongo_get_data = mock_mongo_init = \
+        mock_mongo_get_participant_summaries = None
 
     def setUp(self):
         couch_side_effects = ResponseFactory.couch_get_data_side_effect
         mongo_side_effects = ResponseFactory.mongo_get_data_side_effect
+        mongo_summaries_side_effects = (
+            ResponseFactory.mongo_get_participant_summaries_side_effect)
 
         self.patcher_coach_get_data = patch.object(
             CouchData, 'get_data', side_effect=couch_side_effects)
@@ -157,6 +209,9 @@ class DbPatcherMixin:
             MongoData, 'get_data', side_effect=mongo_side_effects)
         self.patcher_mongo_init = patch.object(
             MongoData, '__init__', return_value=None)
+        self.patcher_mongo_get_participant_summaries = patch.object(
+            MongoData, 'get_participant_summaries',
+            side_effect=mongo_summaries_side_effects)
 
         # Start patch
         self.mock_coach_get_data = self.patcher_coach_get_data.start()
@@ -164,6 +219,8 @@ class DbPatcherMixin:
 
         self.mock_mongo_get_data = self.patcher_mongo_get_data.start()
         self.mock_mongo_init = self.patcher_mongo_init.start()
+        self.mock_mongo_get_participant_summaries = (
+            self.patcher_mongo_get_participant_summaries.start())
 
         # Stop patch
         self.addCleanup(patch.stopall)
@@ -1,8 +1,9 @@
 import logging
 import os
 import sys
+from datetime import datetime
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import dateutil.parser
 
@@ -107,3 +108,196 @@ class TestDateFilter(DbPatcherMixin, TestCase):
         str_date = MongoData._TIME_TEMPLATE % cmd_date
         parsed_date = dateutil.parser.parse(str_date)
         return parsed_date
+
+
+class TestMongoQuery(TestCase):
+    def setUp(self):
+        self.patcher_mongo_init = patch.object(MongoData, '__init__',
+                                               return_value=None)
+        self.patcher_mongo_init.start()
+        self.addCleanup(patch.stopall)
+
+        self.mongo = MongoData()
+        self.mongo.db_mongo = MagicMock()
+
+    def test_should_send_date_window_to_database(self):
+        # GIVEN
+        expected_timestamp_question = {'$gte': '2016-07-02T00:00:00.000Z',
+                                       '$lt': '2016-07-05T00:00:00.000Z'}
+
+        # WHEN
+        self.mongo.get_data(user_ids=[UserDateFilter.userId],
+                            date_from='2016-07-02', date_to='2016-07-05')
+
+        # THEN
+        question = self.mongo.db_mongo.analytics.find.call_args[0][0]
+        self.assertEqual(expected_timestamp_question, question['timestamp'])
+
+    def test_should_format_dates_without_leading_zeros_as_logs(self):
+        # GIVEN
+        expected_timestamp_question = {'$gte': '2016-07-02T00:00:00.000Z',
+                                       '$lt': '2016-07-10T00:00:00.000Z'}
+
+        # WHEN
+        self.mongo.get_data(date_from='2016-7-2', date_to='2016-7-10')
+
+        # THEN
+        question = self.mongo.db_mongo.analytics.find.call_args[0][0]
+        self.assertEqual(expected_timestamp_question, question['timestamp'])
+
+    def test_should_select_partition_of_events(self):
+        # WHEN
+        self.mongo.get_data(event_ids=[111, 222], partition=(1, 2))
+
+        # THEN
+        question = self.mongo.db_mongo.analytics.find.call_args[0][0]
+        self.assertEqual({'$in': [111, 222], '$mod': [2, 1]},
+                         question['eventId'])
+
+    def test_should_not_restrict_timestamp_when_no_dates_given(self):
+        # WHEN
+        self.mongo.get_data(user_ids=[UserDateFilter.userId])
+
+        # THEN
+        question = self.mongo.db_mongo.analytics.find.call_args[0][0]
+        self.assertNotIn('timestamp', question)
+
+    def test_should_raise_when_dates_are_the_same(self):
+        with self.assertRaises(RuntimeError):
+            self.mongo.get_data(date_from='2016-07-02', date_to='2016-07-02')
+
+    def test_should_fetch_only_used_fields(self):
+        # GIVEN
+        expected_projection = {'action': True, 'eventId': True,
+                               'timestamp': True, 'userId': True,
+                               '_id': False}
+
+        # WHEN
+        self.mongo.get_data(user_ids=[UserDateFilter.userId])
+
+        # THEN
+        projection = self.mongo.db_mongo.analytics.find.call_args[0][1]
+        self.assertEqual(expected_projection, projection)
+
+    def test_should_fetch_extra_fields_when_asked(self):
+        # WHEN
+        self.mongo.get_data(user_ids=[UserDateFilter.userId],
+                            extra_fields=['_id', 'connectedUsers'])
+
+        # THEN
+        projection = self.mongo.db_mongo.analytics.find.call_args[0][1]
+        self.assertTrue(projection['_id'])
+        self.assertTrue(projection['connectedUsers'])
+
+
+class TestMongoRangeScan(TestCase):
+    logs = [{'eventId': 1, 'userId': '1', 'action': 'join',
+             'timestamp': '2016-05-2%sT1%s:00:00.000Z' % (day, hour)}
+            for day in (8, 6, 9, 7) for hour in (3, 1, 2)]
+    logs.append({'eventId': 1, 'userId': '1', 'action': 'leave'})
+    logs.append({'eventId': 1, 'userId': '1', 'action': 'leave',
+                 'timestamp': datetime(2016, 5, 27, 12)})
+
+    class FakeCursor:
+        def __init__(self, logs):
+            self.logs = list(logs)
+            self.read = 0
+
+        def batch_size(self, size):
+            return self
+
+        def sort(self, keys):
+            (field, _), = keys
+            self.logs.sort(key=lambda log: log[field])
+            return self
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            if self.read >= len(self.logs):
+                raise StopIteration
+            self.read += 1
+            return self.logs[self.read - 1]
+
+    def setUp(self):
+        self.patcher_mongo_init = patch.object(MongoData, '__init__',
+                                               return_value=None)
+        self.patcher_mongo_init.start()
+        self.patcher_bounds = patch.object(
+            MongoData, '_get_timestamp_bounds',
+            return_value=('2016-05-26T11:00:00.000Z',
+                          '2016-05-29T13:00:00.000Z'))
+        self.patcher_bounds.start()
+        self.addCleanup(patch.stopall)
+
+        self.mongo = MongoData()
+        self.mongo.db_mongo = MagicMock()
+        self.mongo.db_mongo.analytics.find.side_effect = self.find
+        self.cursors = []
+
+    def find(self, question, projection):
+        timestamp = question['timestamp']
+        if '$not' in timestamp:
+            cursor = self.FakeCursor(
+                log for log in self.logs
+                if not isinstance(log.get('timestamp'), str))
+        else:
+            cursor = self.FakeCursor(
+                log for log in self.logs
+                if isinstance(log.get('timestamp'), str) and
+                timestamp['$gte'] <= log['timestamp'] and
+                ('$lt' not in timestamp or
+                 log['timestamp'] < timestamp['$lt']))
+        self.cursors.append(cursor)
+        return cursor
+
+    def test_should_split_scan_into_disjoint_timestamp_ranges(self):
+        # WHEN
+        questions = self.mongo.get_range_questions(
+            question=self.mongo.get_question(), ranges=4)
+
+        # THEN
+        self.assertEqual({'$not': {'$type': 2}}, questions[0]['timestamp'])
+        ranges = [question['timestamp'] for question in questions[1:]]
+        self.assertEqual(4, len(ranges))
+        self.assertEqual('2016-05-26T11:00:00.000Z', ranges[0]['$gte'])
+        for previous, following in zip(ranges, ranges[1:]):
+            self.assertEqual(previous['$lt'], following['$gte'])
+        self.assertNotIn('$lt', ranges[-1])
+
+    def test_should_keep_date_window_in_ranges(self):
+        # WHEN
+        questions = self.mongo.get_range_questions(
+            question=self.mongo.get_question(date_to='2016-05-30'),
+            ranges=4)
+
+        # THEN
+        self.assertEqual(4, len(questions))
+        self.assertEqual('2016-05-30T00:00:00.000Z',
+                         questions[-1]['timestamp']['$lt'])
+
+    def test_should_read_all_logs_in_timestamp_order(self):
+        # WHEN
+        logs = list(self.mongo.get_data(stream=True, scan_workers=2))
+
+        # THEN
+        self.assertEqual(len(self.logs), len(logs))
+        timestamps = [log['timestamp'] for log in logs
+                      if isinstance(log.get('timestamp'), str)]
+        self.assertEqual(sorted(timestamps), timestamps)
+        self.assertGreater(self.mongo.db_mongo.analytics.find.call_count, 2)
+
+    def test_should_read_ahead_only_first_batch_of_ranges(self):
+        # GIVEN
+        logs = self.mongo.get_data(stream=True, scan_workers=2, batch_size=1)
+
+        # WHEN
+        next(logs)
+
+        # THEN
+        self.assertTrue(self.cursors)
+        for cursor in self.cursors:
+            self.assertLessEqual(cursor.read, 1)
+        self.assertGreater(sum(len(cursor.logs) for cursor in self.cursors),
+                           len(self.cursors))
@@ -0,0 +1,248 @@
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from os.path import join as j
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import ca_analytics
+from example_data import Event111, Event222, User111, User222
+from helpers import DbPatcherMixin
+from lib.database import CouchData, CouchDetailsCache, details_cache
+from lib.extras import Setts
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+def get_all_docs_row_mock(sample):
+    """ Row of `_all_docs` view called with include_docs=True. """
+    row = MagicMock(spec=['id', 'key', 'doc'], name='AllDocsRow')
+    row.id = sample.couch_id_name
+    row.key = sample.couch_id_name
+    row.doc = sample.couch_value_response
+    return row
+
+
+def get_missing_row_mock(couch_id):
+    row = MagicMock(spec=['id', 'key', 'doc'], name='AllDocsRow')
+    row.id = None
+    row.key = couch_id
+    row.doc = None
+    return row
+
+
+class TestCouchBulkLookup(TestCase):
+    def setUp(self):
+        self.patcher_couch_init = patch.object(CouchData, '__init__',
+                                               return_value=None)
+        self.patcher_couch_init.start()
+        self.addCleanup(patch.stopall)
+
+        self.couch = CouchData()
+        self.couch._batch_size = 2
+        self.couch.db_couch = MagicMock()
+
+    def test_should_ask_only_for_requested_documents_in_batches(self):
+        # GIVEN
+        self.couch.db_couch.view.return_value = []
+
+        # WHEN
+        self.couch.get_data(event_ids=[Event111.eventId],
+                            user_ids=[User111.userId, User222.userId])
+
+        # THEN
+        asked_keys = [call[1]['keys'] for call
+                      in self.couch.db_couch.view.call_args_list]
+        self.assertEqual([['event/00111', 'user/%s' % User111.userId],
+                          ['user/%s' % User222.userId]], asked_keys)
+        for call in self.couch.db_couch.view.call_args_list:
+            self.assertEqual('_all_docs', call[0][0])
+            self.assertTrue(call[1]['include_docs'])
+
+    def test_should_return_rows_keyed_by_our_ids(self):
+        # GIVEN
+        self.couch.db_couch.view.return_value = [
+            get_all_docs_row_mock(sample=User111),
+            get_missing_row_mock(couch_id='user/1'),
+        ]
+
+        # WHEN
+        rows = self.couch.get_data(user_ids=[User111.userId])
+
+        # THEN
+        self.assertEqual(1, len(rows))
+        self.assertEqual(User111.userId, int(rows[0].key))
+        self.assertEqual(User111.display_name, rows[0].value['displayName'])
+
+    def test_should_ask_for_batches_concurrently_keeping_order(self):
+        # GIVEN
+        user_ids = list(range(100, 111))
+        self.couch._workers = 3
+        self.couch.db_couch.view.side_effect = (
+            lambda view, keys, include_docs: [
+                MagicMock(doc={'_id': key, 'id': key.split('/')[1]})
+                for key in keys])
+
+        # WHEN
+        rows = self.couch.get_data(user_ids=user_ids)
+
+        # THEN
+        self.assertEqual(6, self.couch.db_couch.view.call_count)
+        self.assertEqual([str(user_id) for user_id in user_ids],
+                         [row.key for row in rows])
+
+
+class TestCouchDetailsCache(TestCase):
+    def setUp(self):
+        self.patcher_couch_init = patch.object(CouchData, '__init__',
+                                               return_value=None)
+        self.patcher_couch_init.start()
+        self.addCleanup(patch.stopall)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache = CouchDetailsCache(path=j(tmp_dir.name, 'details.db'),
+                                       ttl=60, max_entries=10)
+        self.addCleanup(self.cache.close)
+
+        self.couch = CouchData()
+        self.couch._batch_size = 10
+        self.couch._cache = self.cache
+        self.couch.db_couch = MagicMock()
+        self.couch.db_couch.view.return_value = [
+            get_all_docs_row_mock(sample=User111)]
+
+    def test_should_not_ask_couch_for_fresh_details(self):
+        # GIVEN
+        self.couch.get_data(user_ids=[User111.userId])
+        self.couch.db_couch.view.reset_mock()
+
+        # WHEN
+        rows = self.couch.get_data(user_ids=[User111.userId])
+
+        # THEN
+        self.assertFalse(self.couch.db_couch.view.called)
+        self.assertEqual(User111.display_name, rows[0].value['displayName'])
+
+    def test_should_download_only_changed_documents_after_ttl(self):
+        # GIVEN
+        self.couch.get_data(user_ids=[User111.userId])
+        self.cache.ttl = 0
+        rev = User111.couch_value_response['_rev']
+        revision_row = MagicMock(spec=['id', 'key', 'value'])
+        revision_row.key = User111.couch_id_name
+        revision_row.value = {'rev': rev}
+        self.couch.db_couch.view.reset_mock()
+        self.couch.db_couch.view.return_value = [revision_row]
+
+        # WHEN
+        rows = self.couch.get_data(user_ids=[User111.userId])
+
+        # THEN
+        self.assertEqual(1, self.couch.db_couch.view.call_count)
+        self.assertNotIn('include_docs',
+                         self.couch.db_couch.view.call_args[1])
+        self.assertEqual(User111.display_name, rows[0].value['displayName'])
+
+    def test_should_evict_least_recently_used_details(self):
+        # GIVEN
+        self.cache.max_entries = 2
+        self.cache.ttl = 1000
+        mock_time = patch.object(details_cache, 'time').start()
+        mock_time.time.return_value = 100
+        self.cache.put(documents=[User111.couch_value_response])
+        mock_time.time.return_value = 200
+        self.cache.put(documents=[User222.couch_value_response])
+        mock_time.time.return_value = 300
+        self.cache.get(couch_ids=[User111.couch_id_name])
+
+        # WHEN
+        mock_time.time.return_value = 400
+        self.cache.put(documents=[Event111.couch_value_response])
+
+        # THEN
+        fresh, stale = self.cache.get(couch_ids=[User111.couch_id_name,
+                                                 User222.couch_id_name,
+                                                 Event111.couch_id_name])
+        self.assertEqual({User111.couch_id_name, Event111.couch_id_name},
+                         set(fresh))
+        self.assertFalse(stale)
+
+    def test_should_close_cache_with_couch(self):
+        # WHEN
+        self.couch.close()
+
+        # THEN
+        with self.assertRaises(sqlite3.ProgrammingError):
+            self.cache.get(couch_ids=[User111.couch_id_name])
+
+
+class TestDetailsPrefetch(DbPatcherMixin, TestCase):
+    def setUp(self):
+        self.patcher_output_handler = patch.object(ca_analytics,
+                                                   'OutputHandler')
+        self.mock_output_handler = self.patcher_output_handler.start()
+
+        super().setUp()
+        # Start with no details known
+        Setts._details_provider.value = None
+
+    def test_should_fetch_details_in_batches_while_processing_logs(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--couchdb_batch_size 2 -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.assertGreater(self.mock_coach_get_data.call_count, 1)
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_stop_prefetching_once_output_is_written(self):
+        # GIVEN
+        cli_cmd = '--couchdb_batch_size 2 -e %s' % Event111.eventId
+        cli_cmd = cli_cmd.split()
+        shutdown = MagicMock()
+        self.mock_output_handler.return_value.write_terminal.side_effect = (
+            lambda: self.assertFalse(shutdown.called))
+
+        # WHEN
+        with patch('lib.database.proxy.ThreadPoolExecutor.shutdown',
+                   shutdown):
+            ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        shutdown.assert_called_once_with(wait=True)
+        self.assertIsNone(Setts._details_provider.value._executor)
+
+    def test_should_close_couch_after_the_run(self):
+        # GIVEN
+        cli_cmd = '-e %s' % Event111.eventId
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        with patch.object(CouchData, 'close') as mock_close:
+            ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        mock_close.assert_called_once_with()
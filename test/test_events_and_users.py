@@ -16,6 +16,9 @@ from example_data import (
     UserFirstLastSeenDatesAreJoin,
 )
 from helpers import ResponseFactory, DbPatcherMixin
+from lib.engine import iter_ca_events_sorted
+from lib.extras import Setts
+from lib.parallel import get_partitioned_summaries
 
 rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
 if rwd not in sys.path:
@@ -24,6 +27,25 @@ if rwd not in sys.path:
 log = logging.getLogger(__name__)
 
 
+class FailingLogs:
+    """ Source of logs failing in parallel workers in the given way. """
+    def __init__(self, failure):
+        self.failure = failure
+
+    def get_copy_arguments(self):
+        return {'failure': self.failure}
+
+    def get_data(self, **selection):
+        if self.failure == 'exit':
+            # Like MongoData which can't connect
+            sys.exit(1)
+        if self.failure == 'kill':
+            # Like a worker killed for lack of memory, nothing is reported
+            os._exit(1)
+        return [{'eventId': 111, 'userId': '111', 'action': 'jump',
+                 'timestamp': '2016-05-26T16:37:46.106Z'}]
+
+
 class TestUser(DbPatcherMixin, TestCase):
     get_expected_users = ResponseFactory.get_users_for_given_event_class
 
@@ -143,6 +165,181 @@ class TestEvent(DbPatcherMixin, TestCase):
                 event_id=expected_event.eventId
             )
 
+    def test_should_get_same_events_when_streaming_logs(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--stream --mongo_batch_size 2 -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_get_same_events_when_mongo_aggregates_logs(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--mongo_aggregate -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.assertFalse(self.mock_mongo_get_data.called)
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_get_same_events_when_participants_summarized(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--summarize_participants -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_get_same_events_with_columnar_engine(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--engine columnar -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_get_same_events_with_parallel_engine(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--engine parallel --workers 2 -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_get_same_events_with_sorted_engine(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--engine sorted --couchdb_batch_size 1 -e %s' % ' '.join(
+            [str(e.eventId) for e in expected_events])
+        cli_cmd = cli_cmd.split()
+        Setts._details_provider.value = None
+
+        # WHEN
+        main(start_cmd=cli_cmd)
+
+        # THEN
+        self.assertTrue(
+            self.mock_mongo_get_data.call_args[1]['sort_by_event'])
+        ca_events = list(self.get_script_processed_data())
+        # Details of written events are not kept
+        self.assertEqual(0, len(Setts.details_provider))
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_raise_when_logs_not_sorted_by_event(self):
+        # GIVEN
+        logs = [{'eventId': event_id, 'userId': '111', 'action': 'join',
+                 'timestamp': '2016-05-26T16:37:46.106Z'}
+                for event_id in (222, 111)]
+
+        # WHEN/THEN
+        with self.assertRaises(RuntimeError):
+            list(iter_ca_events_sorted(selected_logs=logs))
+
+    def test_should_raise_worker_error_in_parallel_engine(self):
+        for failure in ('action', 'exit', 'kill'):
+            # GIVEN
+            db_logs = FailingLogs(failure=failure)
+
+            # WHEN/THEN
+            with self.assertRaises(RuntimeError):
+                get_partitioned_summaries(db_logs=db_logs, workers=2)
+
 
 class TestTimestamps(DbPatcherMixin, TestCase):
     _test_users = [UserFirstLastSeenDatesAreJoin,
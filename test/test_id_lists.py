@@ -0,0 +1,138 @@
+import logging
+import os
+import sys
+import tempfile
+import threading
+from os.path import join as j
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from lib.database import MongoData
+from lib.extras import configure_argparse
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+class TestMongoIdChunks(TestCase):
+    logs = [{'eventId': event_id, 'userId': str(user_id), 'action': 'join',
+             'timestamp': '2016-05-26T10:00:00.000Z'}
+            for event_id in range(25) for user_id in (1, 2)]
+
+    class FakeCursor:
+        """ Consumed once, like a cursor. """
+        def __init__(self, logs):
+            self.logs = iter(list(logs))
+
+        def batch_size(self, size):
+            return self
+
+        def __iter__(self):
+            return self.logs
+
+    def setUp(self):
+        self.patcher_mongo_init = patch.object(MongoData, '__init__',
+                                               return_value=None)
+        self.patcher_mongo_init.start()
+        self.addCleanup(patch.stopall)
+
+        self.mongo = MongoData()
+        self.mongo._id_chunk_size = 10
+        self.mongo.db_mongo = MagicMock()
+        self.mongo.db_mongo.analytics.find.side_effect = self.find
+
+    def find(self, question, projection):
+        def matches(log_entry, field):
+            return (field not in question or
+                    log_entry[field] in question[field]['$in'])
+
+        return self.FakeCursor(
+            log_entry for log_entry in self.logs
+            if matches(log_entry, 'eventId') and matches(log_entry, 'userId'))
+
+    def test_should_split_long_id_lists_into_chunks(self):
+        # WHEN
+        questions = self.mongo.get_questions(event_ids=list(range(25)),
+                                             user_ids=[1, 2])
+
+        # THEN
+        self.assertEqual([list(range(0, 10)), list(range(10, 20)),
+                          list(range(20, 25))],
+                         [question['eventId']['$in']
+                          for question in questions])
+        for question in questions:
+            self.assertEqual(['1', '2'], question['userId']['$in'])
+
+    def test_should_read_chunks_concurrently(self):
+        # WHEN
+        logs = self.mongo.get_data(event_ids=list(range(25)), user_ids=[2],
+                                   scan_workers=2)
+
+        # THEN
+        self.assertEqual(3, self.mongo.db_mongo.analytics.find.call_count)
+        self.assertEqual([log_entry for log_entry in self.logs
+                          if log_entry['userId'] == '2'], logs)
+
+    def test_should_aggregate_chunks_concurrently(self):
+        # GIVEN
+        both_running = threading.Barrier(2, timeout=5)
+        pipelines = []
+
+        def aggregate(pipeline, **options):
+            pipelines.append(pipeline)
+            if len(pipelines) <= 2:
+                # Fails unless the first two chunks are aggregated at once
+                both_running.wait()
+            question = pipeline[0]['$match']
+            return self.find(question=question, projection=None)
+
+        self.mongo.db_mongo.analytics.aggregate.side_effect = aggregate
+
+        # WHEN
+        summaries = list(self.mongo.get_participant_summaries(
+            event_ids=list(range(25)), user_ids=[2], scan_workers=2))
+
+        # THEN
+        self.assertEqual(3, len(pipelines))
+        self.assertEqual([log_entry for log_entry in self.logs
+                          if log_entry['userId'] == '2'], summaries)
+
+    def test_should_not_split_short_id_lists(self):
+        # WHEN
+        questions = self.mongo.get_questions(event_ids=[1, 2], user_ids=[])
+
+        # THEN
+        self.assertEqual(1, len(questions))
+        self.assertEqual([], questions[0]['userId']['$in'])
+
+
+class TestIdsFromFile(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = j(tmp_dir.name, 'ids.txt')
+
+    def test_should_read_ids_from_file(self):
+        # GIVEN
+        with open(self.path, 'w') as f:
+            f.write('# Cohort\n111\n222 333  # same line\n\n')
+
+        # WHEN
+        args, _ = configure_argparse(
+            rwd=rwd, start_cmd=['-e', '444', '@' + self.path, '-u', '1'])
+
+        # THEN
+        self.assertEqual([444, 111, 222, 333], args.event)
+        self.assertEqual([1], args.user)
+
+    def test_should_reject_invalid_ids(self):
+        # GIVEN
+        with open(self.path, 'w') as f:
+            f.write('111\nabc\n')
+
+        # WHEN
+        with self.assertRaises(SystemExit):
+            configure_argparse(rwd=rwd, start_cmd=['-u', '@' + self.path])
@@ -0,0 +1,187 @@
+import logging
+import os
+import sys
+import tempfile
+import time
+from os.path import join as j
+from unittest import TestCase
+from unittest.mock import patch
+
+from bson import ObjectId
+
+import ca_analytics
+from example_data import Event111, Event222
+from helpers import DbPatcherMixin, ResponseFactory
+from lib.database import AggregateState
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+def get_summary(join=None, leave=None, join_count=0, leave_count=0):
+    seen = [ts for ts in (join, leave) if ts]
+    return {'eventId': 111, 'userId': '111', 'join': join, 'leave': leave,
+            'joinCount': join_count, 'leaveCount': leave_count,
+            'firstSeen': min(seen) if seen else None,
+            'lastSeen': max(seen) if seen else None}
+
+
+class TestAggregateState(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = j(tmp_dir.name, 'state.db')
+        self.signature = AggregateState.get_signature(event_ids=[111])
+
+    def get_state(self, signature=None, rebuild=False):
+        state = AggregateState(path=self.path,
+                               signature=signature or self.signature,
+                               rebuild=rebuild)
+        self.addCleanup(state.close)
+        return state
+
+    def test_should_merge_summaries_of_new_logs(self):
+        # GIVEN
+        state = self.get_state()
+        state.merge(summaries=[get_summary(join='2016-05-26T16:00:00.000Z',
+                                           join_count=1)],
+                    high_water='57a3a39800c88030ca43b777')
+
+        # WHEN
+        state.merge(summaries=[get_summary(join='2016-05-26T15:00:00.000Z',
+                                           leave='2016-05-26T17:00:00.000Z',
+                                           join_count=2, leave_count=1)],
+                    high_water='57a3a39800c88030ca43b778')
+
+        # THEN
+        summaries = list(self.get_state().get_summaries())
+        self.assertEqual([{'eventId': 111, 'userId': '111',
+                           'join': '2016-05-26T15:00:00.000Z',
+                           'leave': '2016-05-26T17:00:00.000Z',
+                           'joinCount': 3, 'leaveCount': 1,
+                           'firstSeen': '2016-05-26T15:00:00.000Z',
+                           'lastSeen': '2016-05-26T17:00:00.000Z'}],
+                         summaries)
+        self.assertEqual('57a3a39800c88030ca43b778',
+                         self.get_state().high_water)
+
+    def test_should_raise_when_selection_changed(self):
+        # GIVEN
+        self.get_state().merge(summaries=[get_summary(join_count=1)],
+                               high_water='57a3a39800c88030ca43b777')
+        signature = AggregateState.get_signature(event_ids=[222])
+
+        # WHEN/THEN
+        with self.assertRaises(RuntimeError):
+            self.get_state(signature=signature)
+
+    def test_should_start_over_when_rebuilding(self):
+        # GIVEN
+        self.get_state().merge(summaries=[get_summary(join_count=1)],
+                               high_water='57a3a39800c88030ca43b777')
+        signature = AggregateState.get_signature(event_ids=[222])
+
+        # WHEN
+        state = self.get_state(signature=signature, rebuild=True)
+
+        # THEN
+        self.assertIsNone(state.high_water)
+        self.assertEqual([], list(state.get_summaries()))
+
+
+class TestIncrementalRun(DbPatcherMixin, TestCase):
+    def setUp(self):
+        self.patcher_output_handler = patch.object(ca_analytics,
+                                                   'OutputHandler')
+        self.mock_output_handler = self.patcher_output_handler.start()
+        super().setUp()
+        self.mock_mongo_get_data.side_effect = self.get_inserted_logs
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.state_path = j(tmp_dir.name, 'state.db')
+        # Number of logs inserted into database so far
+        self.inserted = 0
+        # Logs from this one on were made just now
+        self.recent = None
+        # Seconds since epoch when they were made
+        self.recent_time = int(time.time()) - 30
+
+    def get_log_id(self, i):
+        if self.recent is not None and i >= self.recent:
+            # Made in the same second by other writers, later ones with
+            #   lower random part
+            return ObjectId('%08x%016x' % (self.recent_time,
+                                              2 ** 32 - i))
+        return ObjectId('%024x' % (i + 1))
+
+    def get_inserted_logs(self, after_id=None, before_id=None, **kwargs):
+        kwargs.pop('scan_workers', None)
+        logs = list(ResponseFactory.mongo_get_data_side_effect(**kwargs))
+        for i, log_entry in enumerate(logs[:self.inserted]):
+            log_entry = dict(log_entry, _id=self.get_log_id(i))
+            if (after_id is None or log_entry['_id'] > ObjectId(after_id)) \
+                    and (before_id is None or log_entry['_id'] < before_id):
+                yield log_entry
+
+    def test_should_get_same_events_when_logs_come_in_parts(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+        cli_cmd = '--incremental %s -e %s' % (self.state_path, ' '.join(
+            [str(e.eventId) for e in expected_events]))
+        cli_cmd = cli_cmd.split()
+        all_logs = ResponseFactory.mongo_get_data_side_effect(
+            event_ids=[e.eventId for e in expected_events])
+
+        # WHEN
+        self.inserted = len(all_logs) // 2
+        ca_analytics.main(start_cmd=cli_cmd)
+        self.inserted = len(all_logs)
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        self.assertEqual(str(ObjectId('%024x' % (len(all_logs) // 2))),
+                         self.mock_mongo_get_data.call_args[1]['after_id'])
+
+        ca_events = self.get_script_processed_data()
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_leave_logs_within_lag_to_next_run(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        cli_cmd = '--incremental %s -e %s' % (self.state_path, ' '.join(
+            [str(e.eventId) for e in expected_events]))
+        all_logs = ResponseFactory.mongo_get_data_side_effect(
+            event_ids=[e.eventId for e in expected_events])
+        self.recent = len(all_logs) // 2
+
+        # WHEN
+        self.inserted = len(all_logs) * 3 // 4
+        ca_analytics.main(start_cmd=cli_cmd.split())
+        self.inserted = len(all_logs)
+        ca_analytics.main(
+            start_cmd=(cli_cmd + ' --incremental_lag 10').split())
+
+        # THEN
+        calls = self.mock_mongo_get_data.call_args_list
+        self.assertEqual(str(self.get_log_id(self.recent - 1)),
+                         calls[-1][1]['after_id'])
+        self.assertEqual(len(all_logs), self.count_logs(
+            ca_events=self.get_script_processed_data()))
+
+    @staticmethod
+    def count_logs(ca_events):
+        return sum(participant.join_count + participant.leave_count
+                   for ca_event in ca_events
+                   for participant in ca_event.event_participants())
@@ -0,0 +1,79 @@
+import logging
+import os
+import sys
+from unittest import TestCase
+
+from lib.database import CaDetailsProvider, UserFields
+from lib.extras import Setts
+from lib.interning import UserIdTable
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+class TestUserIdTable(TestCase):
+    def setUp(self):
+        self.table = UserIdTable()
+
+    def test_should_give_dense_indexes_in_order_of_appearance(self):
+        # GIVEN
+        user_ids = ['116777777777777758951', '108333970581946079744',
+                    '116777777777777758951']
+
+        # WHEN
+        indexes = [self.table.intern(user_id=u_id) for u_id in user_ids]
+
+        # THEN
+        self.assertEqual([0, 1, 0], indexes)
+        self.assertEqual(2, len(self.table))
+
+    def test_should_give_same_index_for_str_and_int_id(self):
+        # GIVEN
+        index = self.table.intern(user_id='116777777777777758951')
+
+        # WHEN
+        int_index = self.table.intern(user_id=116777777777777758951)
+
+        # THEN
+        self.assertEqual(index, int_index)
+        self.assertEqual(index, self.table.find(
+            user_id=116777777777777758951))
+        self.assertEqual(1, len(self.table))
+        self.assertEqual(1, len(self.table._index_of))
+
+    def test_should_return_external_id_for_output(self):
+        # GIVEN
+        index = self.table.intern(user_id='116777777777777758951')
+
+        # WHEN
+        user_id = self.table.get_user_id(index=index)
+
+        # THEN
+        self.assertEqual(116777777777777758951, user_id)
+
+    def test_should_not_intern_when_searching(self):
+        # WHEN
+        index = self.table.find(user_id='116777777777777758951')
+
+        # THEN
+        self.assertIsNone(index)
+        self.assertEqual(0, len(self.table))
+
+
+class TestDetailsByUserIndex(TestCase):
+    def test_should_share_details_of_user_id_and_index(self):
+        # GIVEN
+        provider = CaDetailsProvider()
+        user_id = '116777777777777758951'
+
+        # WHEN
+        details = provider[user_id]
+
+        # THEN
+        index = Setts.user_id_table.find(user_id=user_id)
+        self.assertIs(details, provider.get_user_details(user_index=index))
+        self.assertEqual(int(user_id), details[UserFields.ID])
+        self.assertIn(int(user_id), list(provider))
@@ -0,0 +1,330 @@
+import gzip
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from os.path import join as j
+from unittest import TestCase
+from unittest.mock import patch
+
+import ca_analytics
+from example_data import Event111, Event222, UserDateFilter
+from helpers import DbPatcherMixin, ResponseFactory
+from lib.database import LogFileData
+from lib.database.log_index import LogFileIndex
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+NOT_JOIN_LEAVE_LOGS = [
+    {'eventId': Event111.eventId, 'userId': '111', 'level': 'info',
+     'message': 'events', 'action': 'start',
+     'timestamp': '2016-05-26T16:37:46.106Z'},
+    {'eventId': Event111.eventId, 'userId': '111', 'level': 'info',
+     'message': 'sessions', 'action': 'join',
+     'timestamp': '2016-05-26T16:37:46.106Z'},
+]
+
+
+def write_logs_export(path, logs, open_file=open):
+    """ Write logs the way mongoexport does, with some noise. """
+    with open_file(path, 'wt') as f:
+        for log_entry in logs:
+            # User ids are stored as strings
+            log_entry = dict(log_entry, userId=str(log_entry['userId']),
+                             _id={'$oid': '57a3a39800c88030ca43b777'})
+            f.write(json.dumps(log_entry) + '\n')
+        for log_entry in NOT_JOIN_LEAVE_LOGS:
+            f.write(json.dumps(log_entry) + '\n')
+        f.write('{"eventId": 111, "message": "events", "action": "join"\n')
+
+
+class TestLogFileData(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = j(tmp_dir.name, 'ca-analytics.log')
+        self.logs = ResponseFactory.get_all_mongo_logs()
+
+    def test_should_select_same_logs_as_database(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        expected_logs = ResponseFactory.mongo_get_data_side_effect(
+            user_ids=[UserDateFilter.userId], date_from='2016-07-02',
+            date_to='2016-07-05')
+
+        # WHEN
+        logs = LogFileData(path=self.path).get_data(
+            user_ids=[UserDateFilter.userId], date_from='2016-07-02',
+            date_to='2016-07-05')
+
+        # THEN
+        def get_key(log_entry):
+            return (log_entry['eventId'], str(log_entry['userId']),
+                    log_entry['action'], log_entry['timestamp'])
+
+        self.assertTrue(expected_logs)
+        self.assertEqual([get_key(log_entry) for log_entry in expected_logs],
+                         [get_key(log_entry) for log_entry in logs])
+
+    def test_should_read_gzipped_export(self):
+        # GIVEN
+        self.path += '.gz'
+        write_logs_export(path=self.path, logs=self.logs, open_file=gzip.open)
+
+        # WHEN
+        logs = LogFileData(path=self.path).get_data(
+            event_ids=[Event111.eventId])
+
+        # THEN
+        expected_logs = ResponseFactory.mongo_get_data_side_effect(
+            event_ids=[Event111.eventId])
+        self.assertEqual(len(expected_logs), len(logs))
+
+    def test_should_fetch_only_used_fields(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+
+        # WHEN
+        logs = LogFileData(path=self.path).get_data(
+            event_ids=[Event111.eventId], stream=True)
+
+        # THEN
+        for log_entry in logs:
+            self.assertEqual({'action', 'eventId', 'timestamp', 'userId'},
+                             set(log_entry))
+
+    def test_should_import_modules_folding_logs_first(self):
+        # WHEN
+        for module in ('lib.summaries', 'lib.parallel'):
+            # Fresh interpreter, where lib.database isn't imported yet
+            result = subprocess.run(
+                [sys.executable, '-c', 'import %s' % module],
+                cwd=j(rwd, '..', 'src'), stderr=subprocess.PIPE)
+
+            # THEN
+            self.assertEqual(0, result.returncode, result.stderr.decode())
+
+    def test_should_read_every_log_in_one_partition(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        source = LogFileData(path=self.path)
+        expected_logs = source.get_data()
+
+        # WHEN
+        partitioned_logs = [source.get_data(partition=(index, 3))
+                            for index in range(3)]
+
+        # THEN
+        self.assertTrue(all(partitioned_logs))
+        self.assertEqual(expected_logs, [log_entry for logs in partitioned_logs
+                                         for log_entry in logs])
+
+
+class TestLogFileIndex(TestCase):
+    date_window = {'date_from': '2016-07-02', 'date_to': '2016-07-05'}
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = j(tmp_dir.name, 'ca-analytics.log')
+        # Exports are in insertion order
+        self.logs = sorted(ResponseFactory.get_all_mongo_logs(),
+                           key=lambda log_entry: log_entry['timestamp'])
+
+    def test_should_select_same_logs_with_index(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        expected_logs = LogFileData(path=self.path).get_data(
+            **self.date_window)
+
+        # WHEN
+        logs = LogFileData(path=self.path, index_every=5).get_data(
+            **self.date_window)
+
+        # THEN
+        self.assertTrue(expected_logs)
+        self.assertEqual(expected_logs, logs)
+
+    def test_should_read_only_part_of_file_for_date_window(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        index = LogFileIndex(path=self.path, every=5)
+
+        # WHEN
+        index.refresh()
+        ranges = index.get_ranges(date_from='2016-07-02T00:00:00.000Z',
+                                  date_to='2016-07-05T00:00:00.000Z')
+
+        # THEN
+        self.assertLess(sum(end - start for start, end in ranges),
+                        os.path.getsize(self.path) / 2)
+
+    def test_should_read_every_log_of_date_window_in_one_partition(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        source = LogFileData(path=self.path, index_every=5)
+        expected_logs = source.get_data(**self.date_window)
+
+        # WHEN
+        partitioned_logs = [source.get_data(partition=(index, 2),
+                                            **self.date_window)
+                            for index in range(2)]
+
+        # THEN
+        self.assertEqual(expected_logs, [log_entry for logs in partitioned_logs
+                                         for log_entry in logs])
+
+    def test_should_index_logs_appended_to_export(self):
+        # GIVEN
+        half = len(self.logs) // 2
+        write_logs_export(path=self.path, logs=self.logs[:half])
+        source = LogFileData(path=self.path, index_every=5)
+        source.get_data(date_from='2016-01-01')
+
+        # WHEN
+        write_logs_export(path=self.path, logs=self.logs)
+        logs = source.get_data(date_from='2016-01-01')
+
+        # THEN
+        self.assertEqual(len(self.logs), len(logs))
+
+    def test_should_not_report_rewritten_export_when_first_indexed(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        index = LogFileIndex(path=self.path, every=5)
+
+        # WHEN
+        with patch('lib.database.log_index.log') as mock_log:
+            index.refresh()
+
+        # THEN
+        messages = [call[0][0] for call in mock_log.info.call_args_list]
+        self.assertFalse([message for message in messages
+                          if 'rewritten' in message])
+        self.assertTrue(index.blocks)
+
+    def test_should_read_last_line_without_newline(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        last_log = {'eventId': Event111.eventId, 'userId': '111',
+                    'message': 'events', 'action': 'leave',
+                    'timestamp': '2016-07-03T10:00:00.000Z'}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(last_log))
+
+        # WHEN
+        logs = LogFileData(path=self.path, index_every=5).get_data(
+            **self.date_window)
+
+        # THEN
+        self.assertEqual(last_log['timestamp'], logs[-1]['timestamp'])
+        self.assertEqual(LogFileData(path=self.path).get_data(
+            **self.date_window), logs)
+
+    def test_should_rebuild_index_of_export_rewritten_in_place(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs)
+        source = LogFileData(path=self.path, index_every=5)
+        source.get_data(**self.date_window)
+        mtime = os.stat(self.path).st_mtime
+
+        # WHEN
+        # Same size, but from another year
+        write_logs_export(path=self.path, logs=self.get_earlier_logs())
+        os.utime(self.path, (mtime + 1, mtime + 1))
+        logs = source.get_data(**self.earlier_date_window)
+
+        # THEN
+        self.assertTrue(logs)
+        self.assertEqual(LogFileData(path=self.path).get_data(
+            **self.earlier_date_window), logs)
+
+    def test_should_rebuild_index_of_longer_export_written_anew(self):
+        # GIVEN
+        write_logs_export(path=self.path, logs=self.logs[:-1])
+        source = LogFileData(path=self.path, index_every=5)
+        source.get_data(**self.date_window)
+
+        # WHEN
+        write_logs_export(path=self.path, logs=self.get_earlier_logs())
+        logs = source.get_data(**self.earlier_date_window)
+
+        # THEN
+        self.assertTrue(logs)
+        self.assertEqual(LogFileData(path=self.path).get_data(
+            **self.earlier_date_window), logs)
+
+    earlier_date_window = {'date_from': '2015-07-02', 'date_to': '2015-07-05'}
+
+    def get_earlier_logs(self):
+        return [dict(log_entry, timestamp=log_entry['timestamp'].replace(
+            '2016-', '2015-')) for log_entry in self.logs]
+
+
+class TestLogFileRun(DbPatcherMixin, TestCase):
+    def setUp(self):
+        self.patcher_output_handler = patch.object(ca_analytics,
+                                                   'OutputHandler')
+        self.mock_output_handler = self.patcher_output_handler.start()
+        super().setUp()
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = j(tmp_dir.name, 'ca-analytics.log')
+        write_logs_export(path=self.path,
+                          logs=ResponseFactory.get_all_mongo_logs())
+
+    def test_should_get_same_events_from_logs_export(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--logs_export %s -e %s' % (self.path, ' '.join(
+            [str(e.eventId) for e in expected_events]))
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        self.mock_mongo_get_data.assert_not_called()
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
+
+    def test_should_get_same_events_with_parallel_engine(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        cli_cmd = '--logs_export %s --engine parallel --workers 2 -e %s' % (
+            self.path, ' '.join([str(e.eventId) for e in expected_events]))
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
@@ -0,0 +1,145 @@
+import io
+import logging
+import os
+import sys
+from contextlib import redirect_stdout
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import ca_analytics
+from helpers import DbPatcherMixin
+from lib.database import MongoData
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+EVENTS_INDEX, USERS_INDEX, DATES_INDEX, ID_INDEX = (
+    keys for _, keys in MongoData.RECOMMENDED_INDEXES)
+
+
+class TestMongoIndexes(TestCase):
+    def setUp(self):
+        self.patcher_mongo_init = patch.object(MongoData, '__init__',
+                                               return_value=None)
+        self.patcher_mongo_init.start()
+        self.addCleanup(patch.stopall)
+
+        self.mongo = MongoData()
+        self.mongo.db_mongo = MagicMock()
+        self.analytics = self.mongo.db_mongo.analytics
+        self.analytics.index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            # Recommended one, under other name
+            'by_event': {'key': EVENTS_INDEX},
+        }
+
+    def test_should_report_missing_indexes_by_keys(self):
+        # WHEN
+        missing = self.mongo.get_missing_indexes()
+
+        # THEN
+        self.assertEqual([USERS_INDEX, DATES_INDEX, ID_INDEX],
+                         [keys for _, keys in missing])
+
+    def test_should_create_only_missing_indexes_in_background(self):
+        # WHEN
+        created = self.mongo.create_indexes()
+
+        # THEN
+        self.assertEqual(['message_action_userId_timestamp',
+                          'message_action_timestamp', 'message_action__id'],
+                         created)
+        self.assertEqual(3, self.analytics.create_index.call_count)
+        for call in self.analytics.create_index.call_args_list:
+            self.assertTrue(call[1]['background'])
+
+    class FakeCursor:
+        def __init__(self, question):
+            self.question = question
+            self.keys = None
+
+        def sort(self, keys):
+            self.keys = keys
+            return self
+
+        def explain(self):
+            if self.keys == [('eventId', 1), ('timestamp', 1)]:
+                stage = {'stage': 'IXSCAN', 'indexName': 'by_event_order'}
+            elif 'eventId' in self.question:
+                stage = {'stage': 'IXSCAN', 'indexName': 'by_event'}
+            elif '_id' in self.question:
+                stage = {'stage': 'IXSCAN', 'indexName': '_id_'}
+            else:
+                stage = {'stage': 'COLLSCAN'}
+            return {'queryPlanner': {'winningPlan': {
+                'stage': 'PROJECTION',
+                'inputStage': {'stage': 'FETCH', 'inputStage': stage}}}}
+
+    def test_should_report_index_used_by_query_shape(self):
+        # GIVEN
+        cursors = []
+
+        def find(question, projection):
+            cursors.append(self.FakeCursor(question=question))
+            return cursors[-1]
+
+        self.analytics.find.side_effect = find
+
+        # WHEN
+        explained = dict(self.mongo.explain_questions())
+
+        # THEN
+        self.assertEqual('by_event', explained['events and dates'])
+        self.assertEqual('COLLSCAN', explained['users'])
+        self.assertEqual('_id_', explained['logs after checkpoint'])
+        self.assertEqual('by_event_order', explained['sorted by event'])
+        self.assertEqual(len(MongoData.QUERY_SHAPES), len(explained))
+        questions = {shape: cursor.question for (shape, _), cursor
+                     in zip(MongoData.QUERY_SHAPES, cursors)}
+        self.assertEqual({'$not': {'$type': 2}},
+                         questions['no string timestamp']['timestamp'])
+        self.assertEqual({'$type': 2},
+                         questions['timestamp bounds']['timestamp'])
+
+
+class TestMongoIndexesRun(DbPatcherMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.patcher_explain = patch.object(
+            MongoData, 'explain_questions',
+            return_value=[('events', 'message_action_eventId_timestamp')])
+        self.patcher_missing = patch.object(
+            MongoData, 'get_missing_indexes', return_value=[])
+        self.patcher_create = patch.object(
+            MongoData, 'create_indexes',
+            return_value=['message_action_eventId_timestamp'])
+        self.patcher_explain.start()
+        self.patcher_missing.start()
+        self.mock_create = self.patcher_create.start()
+        self.addCleanup(patch.stopall)
+
+    def run_script(self, cli_cmd):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            ca_analytics.main(start_cmd=cli_cmd)
+        return out.getvalue()
+
+    def test_should_only_report_when_checking(self):
+        # WHEN
+        out = self.run_script(cli_cmd=['--mongo_indexes', 'check'])
+
+        # THEN
+        self.mock_create.assert_not_called()
+        self.mock_mongo_get_data.assert_not_called()
+        self.assertIn('events uses message_action_eventId_timestamp', out)
+
+    def test_should_create_missing_indexes(self):
+        # WHEN
+        out = self.run_script(cli_cmd=['--mongo_indexes', 'create'])
+
+        # THEN
+        self.mock_create.assert_called_once_with()
+        self.assertIn('Created index message_action_eventId_timestamp', out)
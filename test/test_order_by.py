@@ -58,6 +58,67 @@ class TestOrderByEventsPresentInDB(DbPatcherMixin, TestCase):
             script_events_data=ca_events,
             expected_events_data=expected_events_sorted_by_start_time)
 
+    def test_should_stream_events_by_event_id_with_sorted_engine(self):
+        # GIVEN
+        expected_events_sorted_by_event_id = [Event111, Event222, Event333]
+
+        cli_cmd = '--engine sorted -e %s --order_by event_id' % ' '.join(
+            [str(evnt.eventId) for evnt
+             in reversed(expected_events_sorted_by_event_id)])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+        self.assertNotIsInstance(ca_events, list)
+        self.check_if_events_valid(
+            script_events_data=list(ca_events),
+            expected_events_data=expected_events_sorted_by_event_id)
+
+    def test_should_sort_events_by_start_time_with_sorted_engine(self):
+        # GIVEN
+        expected_events = [Event111, Event222, Event333]
+        expected_events_sorted_by_start_time = [Event333, Event111, Event222]
+
+        cli_cmd = '--engine sorted -e %s --order_by start_time' % ' '.join(
+            [str(evnt.eventId) for evnt in expected_events])
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = self.get_script_processed_data()
+        self.check_if_events_valid(
+            script_events_data=ca_events,
+            expected_events_data=expected_events_sorted_by_start_time)
+
+    def test_should_sort_spilled_events_by_start_time(self):
+        # GIVEN
+        expected_events = [Event111, Event222, Event333]
+        expected_events_sorted_by_start_time = [Event333, Event111, Event222]
+
+        cli_cmd = ('--engine sorted --memory_budget 0.000001 '
+                   '-e %s --order_by start_time join_time' % ' '.join(
+                       [str(evnt.eventId) for evnt in expected_events]))
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        ca_events = list(self.get_script_processed_data())
+        self.check_if_events_valid(
+            script_events_data=ca_events,
+            expected_events_data=expected_events_sorted_by_start_time)
+        for ca_event in ca_events:
+            join_times = [participant.timestamp for participant
+                          in ca_event.event_participants()]
+            self.assertTrue(join_times)
+            self.assertEqual(sorted(join_times), join_times)
+
     def test_should_sort_users_by_display_name(self):
         # GIVEN
         expected_event = Event111.eventId
@@ -0,0 +1,124 @@
+import csv
+import io
+import logging
+import os
+import sys
+import tempfile
+from os.path import join as j
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import ca_analytics
+from example_data import Event111, Event222
+from helpers import DbPatcherMixin
+from lib.extras import CSV_FIELDNAMES, OutputHandler
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+class TestOutputHandler(DbPatcherMixin, TestCase):
+    def setUp(self):
+        self.patcher_output_handler = patch.object(ca_analytics,
+                                                   'OutputHandler')
+        self.mock_output_handler = self.patcher_output_handler.start()
+        super().setUp()
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def get_events(self):
+        cli_cmd = '-e %s' % ' '.join(
+            [str(e.eventId) for e in (Event111, Event222)])
+        ca_analytics.main(start_cmd=cli_cmd.split())
+        return self.get_script_processed_data()
+
+    def write_file(self, ca_events_list, name):
+        path = j(self.tmp_dir, name)
+        OutputHandler(ca_events_list=ca_events_list).write_file(f_path=path)
+        with open(path) as f:
+            return f.read()
+
+    def test_should_write_same_file_from_event_stream(self):
+        # GIVEN
+        ca_events = self.get_events()
+
+        # WHEN
+        from_list = self.write_file(ca_events_list=ca_events,
+                                    name='list.txt')
+        from_stream = self.write_file(ca_events_list=iter(ca_events),
+                                      name='stream.txt')
+
+        # THEN
+        self.assertEqual(
+            '\n'.join(OutputHandler(ca_events_list=ca_events).lines),
+            from_list)
+        self.assertEqual(from_list, from_stream)
+
+    def write_csv(self, ca_events_list, name):
+        path = j(self.tmp_dir, name)
+        OutputHandler(ca_events_list=ca_events_list).write_csv(f_path=path)
+        with open(path, newline='') as f:
+            return f.read()
+
+    def test_should_write_row_per_participant_to_csv(self):
+        # GIVEN
+        ca_events = self.get_events()
+        expected = io.StringIO()
+        writer = csv.DictWriter(expected, fieldnames=CSV_FIELDNAMES,
+                                extrasaction='ignore',
+                                quoting=csv.QUOTE_NONNUMERIC)
+        writer.writeheader()
+        for ca_event in ca_events:
+            event_dict = OutputHandler.convert_to_dictionary(ca_event)
+            for user in event_dict['Users']:
+                writer.writerow(dict(event_dict, **user))
+
+        # WHEN
+        from_list = self.write_csv(ca_events_list=ca_events, name='list.csv')
+        from_stream = self.write_csv(ca_events_list=iter(ca_events),
+                                     name='stream.csv')
+
+        # THEN
+        self.assertEqual(expected.getvalue(), from_list)
+        self.assertEqual(from_list, from_stream)
+        self.assertEqual(
+            1 + sum(ca_event.participants_number for ca_event in ca_events),
+            len(from_list.splitlines()))
+
+    def test_should_skip_whole_event_broken_in_csv(self):
+        # GIVEN
+        ca_events = self.get_events()
+
+        class BrokenParticipant:
+            user_id = '111'
+            display_name = 'Broken'
+
+            @property
+            def timestamp_str(self):
+                raise RuntimeError('Broken timestamp')
+
+        broken_event = MagicMock(event_id=333, description='Broken',
+                                 calendar_id='', start_time_str='',
+                                 end_time_str='')
+        broken_event.event_participants.return_value = [
+            ca_events[0].event_participants()[0], BrokenParticipant()]
+
+        # WHEN
+        from_broken = self.write_csv(ca_events_list=[broken_event] + ca_events,
+                                     name='broken.csv')
+
+        # THEN
+        self.assertEqual(self.write_csv(ca_events_list=ca_events,
+                                        name='list.csv'), from_broken)
+
+    def test_should_tell_when_event_stream_is_empty(self):
+        # WHEN
+        lines = list(OutputHandler(ca_events_list=iter([])).iter_lines())
+
+        # THEN
+        self.assertEqual(['No data to print.'], lines)
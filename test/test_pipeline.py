@@ -0,0 +1,145 @@
+import logging
+import os
+import sys
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import ca_analytics
+from example_data import Event111, Event222
+from helpers import DbPatcherMixin
+from lib.pipeline import Pipeline
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+class TestPipeline(TestCase):
+    def test_should_pass_items_through_stages_in_order(self):
+        # GIVEN
+        pipeline = Pipeline(queue_size=2)
+        pipeline.add_stage(name='double',
+                           function=lambda items: (i * 2 for i in items))
+        pipeline.add_stage(name='increment',
+                           function=lambda items: (i + 1 for i in items))
+
+        # WHEN
+        ret = list(pipeline.run(source=range(100)))
+
+        # THEN
+        self.assertEqual([i * 2 + 1 for i in range(100)], ret)
+        self.assertEqual(['double', 'increment', 'output'],
+                         [stats.name for stats in pipeline.stats])
+        self.assertEqual([100, 100, 100],
+                         [stats.items for stats in pipeline.stats])
+
+    def test_should_hold_back_stages_before_slow_consumer(self):
+        # GIVEN
+        produced = []
+
+        def produce(items):
+            for item in items:
+                produced.append(item)
+                yield item
+
+        pipeline = Pipeline(queue_size=3)
+        pipeline.add_stage(name='produce', function=produce)
+
+        # WHEN
+        items = pipeline.run(source=range(100))
+        next(items)
+        time.sleep(0.3)
+        ahead = len(produced)
+        rest = list(items)
+
+        # THEN
+        # Consumed one, queue full and one waiting to be put
+        self.assertLessEqual(ahead, 1 + 3 + 1)
+        self.assertEqual(99, len(rest))
+        self.assertEqual(3, pipeline.stats[0].max_queue_depth)
+        self.assertGreater(pipeline.stats[0].output_wait, 0.2)
+
+    def test_should_raise_error_of_stage(self):
+        # GIVEN
+        def fail(items):
+            for item in items:
+                if item == 5:
+                    raise RuntimeError('Broken item')
+                yield item
+
+        pipeline = Pipeline(queue_size=2)
+        pipeline.add_stage(name='fail', function=fail)
+        pipeline.add_stage(name='copy', function=lambda items: items)
+
+        # WHEN/THEN
+        with self.assertRaisesRegex(RuntimeError, 'Broken item'):
+            list(pipeline.run(source=range(10)))
+
+    def test_should_stop_source_when_consumer_raises(self):
+        # GIVEN
+        read = []
+        closed = []
+
+        def source():
+            try:
+                for item in range(10000):
+                    read.append(item)
+                    yield item
+            finally:
+                closed.append(True)
+
+        pipeline = Pipeline(queue_size=2)
+        pipeline.add_stage(name='copy', function=lambda items: items)
+        pipeline.add_stage(name='increment',
+                           function=lambda items: (i + 1 for i in items))
+
+        def consume():
+            for item in pipeline.run(source=source()):
+                if item == 5:
+                    raise RuntimeError('Broken output')
+
+        # WHEN
+        with self.assertRaisesRegex(RuntimeError, 'Broken output'):
+            consume()
+
+        # THEN
+        self.assertEqual([True], closed)
+        self.assertLess(len(read), 20)
+        self.assertFalse(any(thread.name.startswith('pipeline-')
+                             for thread in threading.enumerate()))
+
+
+class TestPipelineRun(DbPatcherMixin, TestCase):
+    def setUp(self):
+        self.patcher_output_handler = patch.object(ca_analytics,
+                                                   'OutputHandler')
+        self.mock_output_handler = self.patcher_output_handler.start()
+        super().setUp()
+
+    def test_should_get_same_events_with_pipeline(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+
+        for engine in ('objects', 'sorted'):
+            cli_cmd = ('--pipeline --engine %s --mongo_batch_size 3 -e %s' % (
+                engine, ' '.join([str(e.eventId) for e in expected_events])))
+            cli_cmd = cli_cmd.split()
+
+            # WHEN
+            ca_analytics.main(start_cmd=cli_cmd)
+
+            # THEN
+            ca_events = list(self.get_script_processed_data())
+            self.check_if_events_valid(script_events_data=ca_events,
+                                       expected_events_data=expected_events)
+            for ca_event, expected_event in zip(ca_events, expected_events):
+                self.check_if_users_valid(
+                    script_events_users=ca_event.event_participants(),
+                    expected_events_users=expected_users[expected_event],
+                    event_id=expected_event.eventId
+                )
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from bson import ObjectId
+
+import ca_analytics
+from example_data import Event111, Event222, UserDateFilter
+from helpers import DbPatcherMixin, ResponseFactory
+from lib.extras import Setts
+from lib.segments import BloomFilter, LogSegments
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+def get_inserted_logs(inserted, after_id=None, before_id=None, **kwargs):
+    """ Logs as stored in MongoDB, first `inserted` of them. """
+    logs = ResponseFactory.get_all_mongo_logs()
+    for i, log_entry in enumerate(logs[:inserted]):
+        log_entry = dict(log_entry, userId=str(log_entry['userId']),
+                         _id=ObjectId('%024x' % (i + 1)))
+        if after_id is not None and log_entry['_id'] <= ObjectId(after_id):
+            continue
+        if before_id is not None and log_entry['_id'] >= ObjectId(before_id):
+            continue
+        yield log_entry
+
+
+def get_key(log_entry):
+    return (log_entry['eventId'], str(log_entry['userId']),
+            log_entry['action'])
+
+
+def get_record_keys(record_arrays):
+    actions = {1: 'join', 2: 'leave'}
+    return sorted((int(record['event_id']), record['user_id'].decode(),
+                   actions[int(record['action'])])
+                  for records in record_arrays for record in records)
+
+
+class TestLogSegments(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+        self.logs = [log_entry for log_entry in get_inserted_logs(
+            inserted=None) if log_entry.get('timestamp')]
+        self.db_logs = MagicMock()
+        self.db_logs.get_data.side_effect = (
+            lambda **kwargs: get_inserted_logs(inserted=self.inserted,
+                                               after_id=kwargs['after_id'],
+                                               before_id=kwargs['before_id']))
+        self.inserted = None
+
+    def test_should_select_same_logs_as_database(self):
+        # GIVEN
+        LogSegments(directory=self.directory).export(db_logs=self.db_logs,
+                                                     batch_size=7)
+        expected_logs = [
+            log_entry
+            for log_entry in ResponseFactory.mongo_get_data_side_effect(
+                user_ids=[UserDateFilter.userId], date_from='2016-07-02',
+                date_to='2016-07-05')
+            if log_entry.get('timestamp')]
+
+        # WHEN
+        record_arrays = LogSegments(directory=self.directory).read(
+            user_ids=[UserDateFilter.userId], date_from='2016-07-02',
+            date_to='2016-07-05')
+
+        # THEN
+        self.assertTrue(expected_logs)
+        self.assertEqual(sorted(get_key(log_entry)
+                                for log_entry in expected_logs),
+                         get_record_keys(record_arrays))
+
+    def test_should_export_only_new_logs(self):
+        # GIVEN
+        self.inserted = len(self.logs) // 2
+        LogSegments(directory=self.directory).export(db_logs=self.db_logs,
+                                                     batch_size=5)
+
+        # WHEN
+        self.inserted = None
+        segments = LogSegments(directory=self.directory)
+        exported = segments.export(db_logs=self.db_logs, batch_size=5)
+
+        # THEN
+        self.assertEqual(str(self.logs[-1]['_id']), segments.high_water)
+        self.assertEqual(len(self.logs) - self.inserted_before(), exported)
+        self.assertEqual(sorted(get_key(log_entry) for log_entry in self.logs),
+                         get_record_keys(segments.read()))
+
+    def test_should_leave_logs_from_before_id_to_next_export(self):
+        # GIVEN
+        before_id = self.logs[len(self.logs) // 2]['_id']
+        segments = LogSegments(directory=self.directory)
+        first_exported = segments.export(db_logs=self.db_logs, batch_size=5,
+                                         before_id=before_id)
+
+        # WHEN
+        segments = LogSegments(directory=self.directory)
+        exported = segments.export(db_logs=self.db_logs, batch_size=5)
+
+        # THEN
+        self.assertEqual(len(self.logs) // 2, first_exported)
+        self.assertEqual(len(self.logs), first_exported + exported)
+        self.assertEqual(sorted(get_key(log_entry) for log_entry in self.logs),
+                         get_record_keys(segments.read()))
+
+    def inserted_before(self):
+        return len([log_entry for log_entry in get_inserted_logs(
+            inserted=len(self.logs) // 2) if log_entry.get('timestamp')])
+
+    def test_should_ignore_records_not_committed(self):
+        # GIVEN
+        segments = LogSegments(directory=self.directory)
+        segments.export(db_logs=self.db_logs, batch_size=100)
+        day, count = sorted(segments._manifest['segments'].items())[0]
+        with open(segments._get_path(day=day), 'ab') as f:
+            f.write(b'\0' * segments.dtype.itemsize * 3)
+
+        # WHEN
+        record_arrays = LogSegments(directory=self.directory).read()
+
+        # THEN
+        self.assertEqual(sorted(get_key(log_entry) for log_entry in self.logs),
+                         get_record_keys(record_arrays))
+
+    def test_should_skip_segments_without_user(self):
+        # GIVEN
+        LogSegments(directory=self.directory).export(db_logs=self.db_logs,
+                                                     batch_size=10)
+        user_days = {log_entry['timestamp'][:10] for log_entry in self.logs
+                     if log_entry['userId'] == str(UserDateFilter.userId)}
+
+        # WHEN
+        segments = LogSegments(directory=self.directory)
+        record_arrays = list(segments.read(user_ids=[UserDateFilter.userId]))
+
+        # THEN
+        self.assertEqual(len(user_days), segments.stats['read'])
+        self.assertEqual(segments.stats['segments'] - len(user_days),
+                         segments.stats['pruned_by_bloom'])
+        self.assertTrue(all(len(records) for records in record_arrays))
+
+    def test_should_skip_segments_outside_event_range(self):
+        # GIVEN
+        LogSegments(directory=self.directory).export(db_logs=self.db_logs,
+                                                     batch_size=10)
+        expected_logs = [log_entry for log_entry in self.logs
+                         if log_entry['eventId'] == Event222.eventId]
+
+        # WHEN
+        segments = LogSegments(directory=self.directory)
+        record_arrays = list(segments.read(event_ids=[Event222.eventId]))
+
+        # THEN
+        self.assertEqual(sorted(get_key(log_entry)
+                                for log_entry in expected_logs),
+                         get_record_keys(record_arrays))
+        self.assertEqual(1, segments.stats['read'])
+        self.assertEqual(
+            segments.stats['segments'] - 1,
+            segments.stats['pruned_by_event_range'] +
+            segments.stats['pruned_by_bloom'])
+
+    def test_should_add_metadata_to_old_segments(self):
+        # GIVEN
+        segments = LogSegments(directory=self.directory)
+        segments.export(db_logs=self.db_logs, batch_size=10)
+        manifest_path = os.path.join(self.directory, segments._MANIFEST)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest['version'] = 1
+        manifest['segments'] = {day: segment['count'] for day, segment
+                                in manifest['segments'].items()}
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+        # WHEN
+        upgraded = LogSegments(directory=self.directory)
+
+        # THEN
+        self.assertEqual(segments._manifest, upgraded._manifest)
+        self.assertEqual(sorted(get_key(log_entry) for log_entry in self.logs),
+                         get_record_keys(upgraded.read()))
+
+
+class TestBloomFilter(TestCase):
+    def test_should_contain_added_keys(self):
+        # GIVEN
+        keys = [str(i).encode() for i in range(1000)]
+        bloom = BloomFilter()
+
+        # WHEN
+        bloom.add(keys=keys)
+
+        # THEN
+        for key in keys:
+            self.assertTrue(bloom.may_contain_any(keys=[key]))
+        false_positives = sum(
+            bloom.may_contain_any(keys=[str(i).encode()])
+            for i in range(1000, 11000))
+        self.assertLess(false_positives, 100)
+
+
+class TestSegmentsRun(DbPatcherMixin, TestCase):
+    def setUp(self):
+        self.patcher_output_handler = patch.object(ca_analytics,
+                                                   'OutputHandler')
+        self.mock_output_handler = self.patcher_output_handler.start()
+        super().setUp()
+        self.mock_mongo_get_data.side_effect = (
+            lambda **kwargs: get_inserted_logs(inserted=None,
+                                               after_id=kwargs['after_id'],
+                                               before_id=kwargs['before_id']))
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+
+    def test_should_get_same_events_from_segments(self):
+        # GIVEN
+        expected_events = [Event111, Event222]
+        expected_users = self.get_expected_users(event_list=expected_events)
+        ca_analytics.main(
+            start_cmd=['--segments', self.directory, '--export_segments'])
+        Setts.refresh(reset=True)
+        self.mock_mongo_get_data.reset_mock()
+        self.mock_output_handler.reset_mock()
+
+        cli_cmd = '--segments %s -e %s' % (self.directory, ' '.join(
+            [str(e.eventId) for e in expected_events]))
+        cli_cmd = cli_cmd.split()
+
+        # WHEN
+        ca_analytics.main(start_cmd=cli_cmd)
+
+        # THEN
+        self.mock_mongo_get_data.assert_not_called()
+        ca_events = self.get_script_processed_data()
+
+        self.check_if_events_valid(script_events_data=ca_events,
+                                   expected_events_data=expected_events)
+        for ca_event, expected_event in zip(ca_events, expected_events):
+            self.check_if_users_valid(
+                script_events_users=ca_event.event_participants(),
+                expected_events_users=expected_users[expected_event],
+                event_id=expected_event.eventId
+            )
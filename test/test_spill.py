@@ -0,0 +1,45 @@
+import logging
+import os
+import random
+import sys
+from unittest import TestCase
+
+from lib.spill import ExternalSorter
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+class TestExternalSorter(TestCase):
+    def setUp(self):
+        self.items = [(random.randrange(100), i) for i in range(1000)]
+
+    def test_should_sort_in_memory_within_budget(self):
+        # GIVEN
+        sorter = ExternalSorter(key=lambda item: item[0],
+                                memory_budget=2 ** 20)
+
+        # WHEN
+        ret = sorter.sort(items=iter(self.items))
+
+        # THEN
+        self.assertIsInstance(ret, list)
+        self.assertEqual(sorted(self.items, key=lambda item: item[0]), ret)
+        self.assertEqual(0, sorter.runs)
+
+    def test_should_merge_spilled_runs_stable(self):
+        # GIVEN
+        sorter = ExternalSorter(key=lambda item: item[0], memory_budget=500)
+
+        # WHEN
+        ret = list(sorter.sort(items=iter(self.items)))
+
+        # THEN
+        self.assertEqual(sorted(self.items, key=lambda item: item[0]), ret)
+        self.assertGreater(sorter.runs, 1)
+        self.assertGreater(sorter.spilled_items, 0)
+        self.assertLess(sorter.spilled_items, len(self.items))
+        self.assertGreater(sorter.spilled_bytes, 0)
@@ -0,0 +1,112 @@
+import logging
+import os
+import sys
+from unittest import TestCase
+
+import dateutil.parser
+
+from lib import timestamps
+from lib.columnar import parse_timestamp_column
+from lib.timestamps import parse_timestamp, to_epoch_us
+
+rwd = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+if rwd not in sys.path:
+    sys.path.append(rwd)
+
+log = logging.getLogger(__name__)
+
+
+class TestParseTimestamp(TestCase):
+    def setUp(self):
+        timestamps.parser_stats.clear()
+
+    def test_should_parse_log_timestamp_same_as_dateutil(self):
+        for raw_value in ('2016-05-26T16:37:46.106Z',
+                          '2016-12-31T23:59:59.999Z',
+                          '2016-01-01T00:00:00.000Z'):
+            # GIVEN
+            expected = dateutil.parser.parse(raw_value)
+
+            # WHEN
+            actual = parse_timestamp(raw_value)
+
+            # THEN
+            self.assertEqual(expected, actual)
+            self.assertEqual(expected.utcoffset(), actual.utcoffset())
+        self.assertEqual(3, timestamps.parser_stats[timestamps.FAST])
+        self.assertEqual(0, timestamps.parser_stats[timestamps.FALLBACK])
+
+    def test_should_parse_event_timestamp_same_as_dateutil(self):
+        for raw_value in ('2016-05-12T19:00:00+00:00',
+                          '2016-05-12T19:00:00-05:30',
+                          '2016-05-12T19:00:00+02:00'):
+            # GIVEN
+            expected = dateutil.parser.parse(raw_value)
+
+            # WHEN
+            actual = parse_timestamp(raw_value)
+
+            # THEN
+            self.assertEqual(expected, actual)
+            self.assertEqual(expected.utcoffset(), actual.utcoffset())
+        self.assertEqual(0, timestamps.parser_stats[timestamps.FALLBACK])
+
+    def test_should_fall_back_to_dateutil_for_other_formats(self):
+        for raw_value in ('2016-05-26 16:37:46',
+                          'May 26 2016 16:37',
+                          '2016-05-26T16:37:46.1Z'):
+            # GIVEN
+            expected = dateutil.parser.parse(raw_value)
+
+            # WHEN
+            actual = parse_timestamp(raw_value)
+
+            # THEN
+            self.assertEqual(expected, actual)
+        self.assertEqual(3, timestamps.parser_stats[timestamps.FALLBACK])
+
+    def test_should_raise_like_dateutil_for_invalid_dates(self):
+        with self.assertRaises(ValueError):
+            parse_timestamp('2016-02-30T16:37:46.106Z')
+
+
+class TestParseTimestampColumn(TestCase):
+    def test_should_convert_timestamps_to_epoch_microseconds(self):
+        # GIVEN
+        raw_values = ['2016-05-26T16:37:46.106Z',
+                      '2000-02-29T00:00:00.000Z',
+                      '1999-12-31T23:59:59.999Z',
+                      '2016-05-12T19:00:00+02:00',
+                      '2016-05-26 16:37:46']
+        expected = [to_epoch_us(parse_timestamp(each)) for each in raw_values]
+
+        # WHEN
+        actual = parse_timestamp_column(raw_values)
+
+        # THEN
+        self.assertEqual(expected, actual.tolist())
+
+    def test_should_convert_timestamps_all_in_log_layout(self):
+        # GIVEN
+        raw_values = ['2016-05-26T16:37:46.106Z',
+                      '2000-02-29T00:00:00.000Z',
+                      '1999-12-31T23:59:59.999Z']
+        expected = [to_epoch_us(parse_timestamp(each)) for each in raw_values]
+
+        # WHEN
+        actual = parse_timestamp_column(raw_values)
+
+        # THEN
+        self.assertEqual(expected, actual.tolist())
+
+    def test_should_raise_like_dateutil_for_malformed_timestamps(self):
+        for raw_value in ('2016-13-45T99:99:99.999Z',
+                          '2016-0a-01T00:00:00.000Z',
+                          '2015-02-29T00:00:00.000Z',
+                          '2016-05-26T24:00:00.000Z'):
+            # WHEN/THEN
+            with self.assertRaises(ValueError):
+                parse_timestamp(raw_value)
+            with self.assertRaises(ValueError):
+                parse_timestamp_column(['2016-05-26T16:37:46.106Z',
+                                        raw_value])